@@ -12,6 +12,7 @@ use_plugin("python.install_dependencies")
 use_plugin("python.flake8")
 use_plugin("pypi:pybuilder_aws_plugin")
 use_plugin("python.coverage")
+use_plugin("filter_resources")
 
 name = 'crassus'
 summary = 'AWS lambda function for deployment automation'
@@ -33,7 +34,11 @@ def set_properties(project):
     project.build_depends_on("mock")
     project.build_depends_on("cfn-sphere")
     project.build_depends_on("gaius")
+    project.build_depends_on("hypothesis")
     project.set_property('coverage_break_build', False)
+    # Embed the version at build time instead of looking it up on import
+    project.get_property('filter_resources_glob').append(
+        '**/crassus/version.py')
     project.set_property(
         'bucket_name', os.environ.get('BUCKET_NAME_FOR_UPLOAD'))
     project.set_property(
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generator of synthetic CloudFormation SNS notification streams, as the
+cfn_output_converter Lambda receives them, for load tests and for
+reproducing bursts offline with cfn_event_replay.py.
+
+Every stack goes through a full update: the stack and every resource
+go from UPDATE_IN_PROGRESS to UPDATE_COMPLETE, nested stacks send their
+own events in between, and some updates fail and roll back. The
+notifications have large ResourceProperties, reasons and properties
+with quotes, and a part of them leave their last line unterminated.
+
+Writes one Lambda event per line, as JSON.
+
+Usage: cfn_event_generator.py [--stacks N] [--resources N] [--nested N]
+                              [--properties-size N] [--seed N] ...
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import random
+import sys
+import uuid
+
+REGION = 'eu-west-1'
+ACCOUNT = '123456789012'
+TOPIC_ARN = 'arn:aws:sns:{0}:{1}:crassus-cfn-events'.format(REGION, ACCOUNT)
+RESOURCE_TYPE_STACK = 'AWS::CloudFormation::Stack'
+RESOURCE_TYPES = [
+    'AWS::AutoScaling::LaunchConfiguration',
+    'AWS::AutoScaling::AutoScalingGroup', 'AWS::EC2::SecurityGroup',
+    'AWS::IAM::Role', 'AWS::Lambda::Function',
+    'AWS::S3::Bucket', 'AWS::SNS::Topic', 'AWS::SQS::Queue',
+]
+# Reasons as CloudFormation sends them, some with quotes
+REASON_REPLACEMENT = ('Requested update requires the creation of a new '
+                      'physical resource; hence creating one.')
+REASON_FAILED = ('Value \'it\'\'s-invalid\' at \'instanceType\' failed to '
+                 'satisfy constraint: Member must satisfy enum value set')
+REASON_ROLLBACK = ('The following resource(s) failed to update: '
+                   '[{0}]. ')
+REASON_USER = 'User Initiated'
+
+# The lines of a notification, in the order CloudFormation sends them
+NOTIFICATION_FIELDS = (
+    'StackId', 'Timestamp', 'EventId', 'LogicalResourceId', 'Namespace',
+    'PhysicalResourceId', 'PrincipalId', 'ResourceProperties',
+    'ResourceStatus', 'ResourceStatusReason', 'ResourceType', 'StackName',
+    'ClientRequestToken')
+
+
+class StackUpdateStream(object):
+
+    """
+    Generates the notifications of stack updates with a random number
+    generator, so that a seed reproduces the same stream.
+    """
+
+    def __init__(self, rng, resources=20, nested=1, properties_size=10,
+                 failure_ratio=0.1, unterminated_ratio=0.5):
+        self.rng = rng
+        self.resources = resources
+        self.nested = nested
+        self.properties_size = properties_size
+        self.failure_ratio = failure_ratio
+        self.unterminated_ratio = unterminated_ratio
+        self.time = datetime.datetime(2015, 11, 23, 16, 53, 46)
+
+    def stack_update(self, stack_name, depth=0):
+        """
+        Return the notifications of one update of the stack and of its
+        nested stacks, in the order CloudFormation sends them.
+        """
+        stack_id = self._stack_id(stack_name)
+        token = 'crassus-{0:040x}'.format(self.rng.getrandbits(160))
+        notifications = []
+
+        def notify(logical_id, physical_id, resource_type, status, reason,
+                   properties=None):
+            notifications.append(self.notification(
+                stack_id, stack_name, logical_id, physical_id,
+                resource_type, status, reason, properties, token))
+
+        notify(stack_name, stack_id, RESOURCE_TYPE_STACK,
+               'UPDATE_IN_PROGRESS', REASON_USER)
+        resources = [
+            ('{0}{1}'.format(resource_type.rsplit('::', 1)[-1], number),
+             resource_type)
+            for number, resource_type in enumerate(
+                self.rng.choice(RESOURCE_TYPES)
+                for _ in range(self.resources))]
+        failed = self.rng.random() < self.failure_ratio
+        failing = self.rng.randrange(len(resources)) if resources else None
+        for number, (logical_id, resource_type) in enumerate(resources):
+            physical_id = '{0}-{1}-{2}'.format(
+                stack_name, logical_id, self._random_suffix())
+            notify(logical_id, physical_id, resource_type,
+                   'UPDATE_IN_PROGRESS',
+                   self.rng.choice(['', REASON_REPLACEMENT]),
+                   self.resource_properties(stack_name, logical_id))
+            if failed and number == failing:
+                notify(logical_id, physical_id, resource_type,
+                       'UPDATE_FAILED', REASON_FAILED,
+                       self.resource_properties(stack_name, logical_id))
+                break
+            notify(logical_id, physical_id, resource_type,
+                   'UPDATE_COMPLETE', '',
+                   self.resource_properties(stack_name, logical_id))
+        if not failed and depth == 0:
+            for number in range(self.nested):
+                logical_id = 'Nested{0}'.format(number)
+                nested_name = '{0}-{1}-{2}'.format(
+                    stack_name, logical_id, self._random_suffix())
+                nested_id = self._stack_id(nested_name)
+                notify(logical_id, nested_id, RESOURCE_TYPE_STACK,
+                       'UPDATE_IN_PROGRESS', '')
+                notifications.extend(
+                    self.stack_update(nested_name, depth + 1))
+                notify(logical_id, nested_id, RESOURCE_TYPE_STACK,
+                       'UPDATE_COMPLETE', '')
+        if failed:
+            notify(stack_name, stack_id, RESOURCE_TYPE_STACK,
+                   'UPDATE_ROLLBACK_IN_PROGRESS',
+                   REASON_ROLLBACK.format(resources[failing][0]))
+            notify(stack_name, stack_id, RESOURCE_TYPE_STACK,
+                   'UPDATE_ROLLBACK_COMPLETE', '')
+        else:
+            notify(stack_name, stack_id, RESOURCE_TYPE_STACK,
+                   'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', '')
+            notify(stack_name, stack_id, RESOURCE_TYPE_STACK,
+                   'UPDATE_COMPLETE', '')
+        return notifications
+
+    def resource_properties(self, stack_name, logical_id):
+        """Return the properties of a resource, with awkward values."""
+        properties = {
+            'Description': 'Resource {0} of stack {1}, it\'s "{2}"'.format(
+                logical_id, stack_name, 'managed'),
+            'UserData': 'IyEvYmluL2Jhc2gK' * self.properties_size,
+            'Expression': 'key=\'value\' and other=\'value\'',
+            'Tags': [
+                {'Key': 'tag{0}'.format(number),
+                 'Value': 'value {0}\'s'.format(number)}
+                for number in range(self.properties_size)],
+        }
+        return properties
+
+    def notification(self, stack_id, stack_name, logical_id, physical_id,
+                     resource_type, status, reason, properties, token):
+        """Return the SNS message CloudFormation sends for an event."""
+        self.time += datetime.timedelta(
+            milliseconds=self.rng.randrange(50, 5000))
+        timestamp = self.time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        values = {
+            'StackId': stack_id,
+            'Timestamp': timestamp,
+            'EventId': (
+                str(uuid.UUID(int=self.rng.getrandbits(128)))
+                if resource_type == RESOURCE_TYPE_STACK and
+                physical_id == stack_id
+                else '{0}-{1}-{2}'.format(logical_id, status, timestamp)),
+            'LogicalResourceId': logical_id,
+            'Namespace': ACCOUNT,
+            'PhysicalResourceId': physical_id,
+            'PrincipalId': 'AROAEXAMPLEPRINCIPAL:crassus',
+            'ResourceProperties': (
+                'null' if properties is None
+                else json.dumps(properties) + '\n'),
+            'ResourceStatus': status,
+            'ResourceStatusReason': reason,
+            'ResourceType': resource_type,
+            'StackName': stack_name,
+            'ClientRequestToken': token,
+        }
+        message = ''.join(
+            "{0}='{1}'\n".format(field, values[field])
+            for field in NOTIFICATION_FIELDS)
+        if self.rng.random() < self.unterminated_ratio:
+            # The last line without its line break, as CloudFormation
+            # sometimes sends it
+            message = message[:-1]
+        return message
+
+    def _stack_id(self, stack_name):
+        return 'arn:aws:cloudformation:{0}:{1}:stack/{2}/{3}'.format(
+            REGION, ACCOUNT, stack_name,
+            uuid.UUID(int=self.rng.getrandbits(128)))
+
+    def _random_suffix(self):
+        return ''.join(
+            self.rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+            for _ in range(12))
+
+
+def sns_record(rng, message):
+    """Return the Lambda SNS record of a notification."""
+    return {
+        'EventVersion': '1.0',
+        'EventSubscriptionArn': '{0}:{1}'.format(
+            TOPIC_ARN, uuid.UUID(int=rng.getrandbits(128))),
+        'EventSource': 'aws:sns',
+        'Sns': {
+            'Type': 'Notification',
+            'MessageId': str(uuid.UUID(int=rng.getrandbits(128))),
+            'TopicArn': TOPIC_ARN,
+            'Subject': 'AWS CloudFormation Notification',
+            'Message': message,
+            'MessageAttributes': {},
+        },
+    }
+
+
+def generate_events(stacks=10, resources=20, nested=1, properties_size=10,
+                    records_per_event=1, failure_ratio=0.1,
+                    unterminated_ratio=0.5, seed=0):
+    """
+    Yield Lambda events with the notifications of updates of several
+    stacks, records_per_event notifications each. The updates of the
+    stacks are interleaved like concurrent updates.
+    """
+    rng = random.Random(seed)
+    stream = StackUpdateStream(
+        rng, resources, nested, properties_size, failure_ratio,
+        unterminated_ratio)
+    pending = [
+        stream.stack_update('crassus-load-{0}'.format(number))
+        for number in range(stacks)]
+    records = []
+    while pending:
+        notifications = rng.choice(pending)
+        records.append(sns_record(rng, notifications.pop(0)))
+        if not notifications:
+            pending.remove(notifications)
+        if len(records) == records_per_event:
+            yield {'Records': records}
+            records = []
+    if records:
+        yield {'Records': records}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--stacks', type=int, default=10)
+    parser.add_argument('--resources', type=int, default=20,
+                        help='resources per stack')
+    parser.add_argument('--nested', type=int, default=1,
+                        help='nested stacks per stack')
+    parser.add_argument('--properties-size', type=int, default=10)
+    parser.add_argument('--records-per-event', type=int, default=1)
+    parser.add_argument('--failure-ratio', type=float, default=0.1)
+    parser.add_argument('--unterminated-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    arguments = parser.parse_args()
+    for event in generate_events(
+            arguments.stacks, arguments.resources, arguments.nested,
+            arguments.properties_size, arguments.records_per_event,
+            arguments.failure_ratio, arguments.unterminated_ratio,
+            arguments.seed):
+        arguments.output.write(json.dumps(event) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Replay of CloudFormation SNS notification streams through
+OutputConverter.convert at a controlled rate, against stubbed AWS
+services, to see how the converter keeps up with bursts.
+
+The stream is read from a file with one Lambda event per line as JSON,
+as cfn_event_generator.py writes them or as recorded from the Lambda
+logs, or generated on the fly. Every line may also be a single SNS
+record. The events are converted at the given rate in events per
+second, or as fast as possible with a rate of 0. The replay reports
+the throughput, the p50 and p99 convert latency, the lag behind the
+schedule and the processed, skipped and failed records.
+
+Usage: cfn_event_replay.py [--input FILE] [--rate N] [--latency MS]
+                           [--event-mode MODE] [--stacks N] ...
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# Only warnings, the replay should not measure the console
+os.environ.setdefault('CRASSUS_LOG_LEVEL', 'WARNING')
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+src_dir = os.path.dirname(os.path.dirname(my_dir))
+sys.path.insert(0, os.path.join(src_dir, 'main', 'python'))
+
+from crassus.metrics import (  # noqa: E402
+    MemorySink, flush_metrics, set_metrics_sink, start_invocation_metrics)
+from crassus.output_converter import (  # noqa: E402
+    EVENT_MODES, ConversionError, OutputConverter)
+
+from cfn_event_generator import generate_events  # noqa: E402
+from end_to_end_benchmark import (  # noqa: E402
+    Context, StubbedAws, percentile)
+
+
+def read_events(stream):
+    """Yield the Lambda events of a recorded stream."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        event = json.loads(line)
+        if 'Records' not in event:
+            event = {'Records': [event]}
+        yield event
+
+
+def replay(events, rate, latency, event_mode):
+    """
+    Convert the events at rate events per second, return a dict of the
+    measured values.
+    """
+    stubbed_aws = StubbedAws(latency, 0)
+    description = json.loads(stubbed_aws.description)
+    description['cfn_event_mode'] = event_mode
+    stubbed_aws.description = json.dumps(description)
+    stubbed_aws.install()
+    set_metrics_sink(MemorySink())
+
+    counts = {'events': 0, 'records': 0, 'processed': 0, 'skipped': 0,
+              'failed': 0}
+    latencies = []
+    lags = []
+    start = time.time()
+    for number, event in enumerate(events):
+        if rate:
+            scheduled = start + float(number) / rate
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lags.append(-delay)
+        context = Context('replay-{0}'.format(number))
+        start_invocation_metrics(context)
+        convert_start = time.time()
+        try:
+            report = OutputConverter(event, context).convert()
+        except ConversionError as error:
+            report = error.report
+        finally:
+            flush_metrics()
+        latencies.append(time.time() - convert_start)
+        counts['events'] += 1
+        counts['records'] += len(event['Records'])
+        for outcome in ('processed', 'skipped', 'failed'):
+            counts[outcome] += len(report[outcome])
+    total_time = time.time() - start
+
+    result = dict(counts)
+    result.update({
+        'events/s': counts['events'] / total_time,
+        'records/s': counts['records'] / total_time,
+        'p50 ms': percentile(latencies, 0.5) * 1000 if latencies else 0,
+        'p99 ms': percentile(latencies, 0.99) * 1000 if latencies else 0,
+        'max lag ms': max(lags) * 1000 if lags else 0,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--input', type=argparse.FileType('r'),
+                        help='recorded stream, generated if not given')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='events per second, 0 for as fast as possible')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds per stubbed AWS request')
+    parser.add_argument('--event-mode', choices=EVENT_MODES, default='all')
+    parser.add_argument('--stacks', type=int, default=10)
+    parser.add_argument('--resources', type=int, default=20)
+    parser.add_argument('--nested', type=int, default=1)
+    parser.add_argument('--properties-size', type=int, default=10)
+    parser.add_argument('--records-per-event', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    if arguments.input is not None:
+        events = read_events(arguments.input)
+    else:
+        events = generate_events(
+            arguments.stacks, arguments.resources, arguments.nested,
+            arguments.properties_size, arguments.records_per_event,
+            seed=arguments.seed)
+    result = replay(events, arguments.rate, arguments.latency / 1000.0,
+                    arguments.event_mode)
+    for name in ('events', 'records', 'processed', 'skipped', 'failed'):
+        print('{0:<12} {1:>10}'.format(name, result[name]))
+    for name in ('events/s', 'records/s', 'p50 ms', 'p99 ms', 'max lag ms'):
+        print('{0:<12} {1:>10.2f}'.format(name, result[name]))
+
+
+if __name__ == '__main__':
+    main()
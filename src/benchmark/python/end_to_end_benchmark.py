@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of the crassus Lambda handlers against stubbed AWS
+services, to be run before and after changes of the hot path.
+
+handler and cfn_output_converter of crassus_deployer_lambda are invoked
+with synthetic SNS events. Their boto3 clients are real, but every HTTP
+request is answered locally with a canned response after the configured
+latency, in a botocore before-send hook. The Lambda description has the
+default configuration, only the queues are set. For every batch size and
+parameter count the benchmark reports the throughput, the p50 and p99
+invocation latency, the AWS calls per message and the memory per
+message. The memory is the tracemalloc peak of the invocations where
+tracemalloc exists. On Python 2.7, the Lambda runtime, it is the growth of
+the maximum resident set size, which only shows the invocations that
+raised the high-water mark of the process.
+
+The exit code is 1 if a result is outside of the given thresholds, so
+that the benchmark can fail a build.
+
+Usage: end_to_end_benchmark.py [--invocations N] [--latency MS]
+                               [--batch-sizes 1,10] [--parameters 10,100]
+                               [--min-throughput MSGS] [--max-p99 MS]
+                               [--max-calls-per-message CALLS]
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+# Only warnings, the benchmark should not measure the console
+os.environ.setdefault('CRASSUS_LOG_LEVEL', 'WARNING')
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+src_dir = os.path.dirname(os.path.dirname(my_dir))
+sys.path.insert(0, os.path.join(src_dir, 'main', 'python'))
+sys.path.insert(0, os.path.join(src_dir, 'main', 'scripts'))
+
+import boto3  # noqa: E402
+from botocore.awsrequest import AWSResponse  # noqa: E402
+from crassus import utils  # noqa: E402
+from crassus.metrics import (  # noqa: E402
+    METRIC_AWS_CALLS, MemorySink, instrument_client, set_metrics_sink)
+from crassus.retry import client_config  # noqa: E402
+
+import crassus_deployer_lambda  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REGION = 'eu-west-1'
+ACCOUNT = '123456789012'
+RESULT_QUEUE = 'https://sqs.{0}.amazonaws.com/{1}/crassus-results'.format(
+    REGION, ACCOUNT)
+CFN_NAMESPACE = 'http://cloudformation.amazonaws.com/doc/2010-05-15/'
+SQS_NAMESPACE = 'http://queue.amazonaws.com/doc/2012-11-05/'
+
+DESCRIBE_STACKS = (
+    '<DescribeStacksResponse xmlns="{namespace}"><DescribeStacksResult>'
+    '<Stacks><member><StackName>{stack_name}</StackName>'
+    '<StackId>{stack_id}</StackId>'
+    '<CreationTime>2015-11-23T16:53:46.443Z</CreationTime>'
+    '<StackStatus>UPDATE_COMPLETE</StackStatus>'
+    '<Parameters>{parameters}</Parameters></member></Stacks>'
+    '</DescribeStacksResult><ResponseMetadata><RequestId>1</RequestId>'
+    '</ResponseMetadata></DescribeStacksResponse>')
+STACK_PARAMETER = (
+    '<member><ParameterKey>{0}</ParameterKey>'
+    '<ParameterValue>previous</ParameterValue></member>')
+UPDATE_STACK = (
+    '<UpdateStackResponse xmlns="{namespace}"><UpdateStackResult>'
+    '<StackId>{stack_id}</StackId></UpdateStackResult><ResponseMetadata>'
+    '<RequestId>1</RequestId></ResponseMetadata></UpdateStackResponse>')
+DESCRIBE_STACK_EVENTS = (
+    '<DescribeStackEventsResponse xmlns="{namespace}">'
+    '<DescribeStackEventsResult><StackEvents/></DescribeStackEventsResult>'
+    '<ResponseMetadata><RequestId>1</RequestId></ResponseMetadata>'
+    '</DescribeStackEventsResponse>')
+SEND_MESSAGE_BATCH = (
+    '<SendMessageBatchResponse xmlns="{namespace}"><SendMessageBatchResult>'
+    '</SendMessageBatchResult><ResponseMetadata><RequestId>1</RequestId>'
+    '</ResponseMetadata></SendMessageBatchResponse>')
+
+# Message ids are unique across all runs, so that none of them is
+# dropped as already processed
+message_ids = itertools.count()
+
+
+class RawResponse(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class StubbedAws(object):
+
+    """
+    Answers the requests of the boto3 clients crassus uses, after
+    latency seconds, and installs them as the shared clients of crassus.
+    """
+
+    def __init__(self, latency, parameter_count):
+        self.latency = latency
+        self.stack_parameters = ''.join(
+            STACK_PARAMETER.format(parameter_name(number))
+            for number in range(parameter_count))
+        self.description = json.dumps({
+            'result_queue': [RESULT_QUEUE], 'cfn_events': []})
+        self.requests = 0
+
+    def install(self):
+        utils.clear_clients()
+        utils.invalidate_lambda_config_cache()
+        utils._clients[('lambda', None)] = self._client('lambda')
+        utils._clients[('sqs', None)] = self._client('sqs')
+        utils._clients[('cloudformation', REGION)] = self._client(
+            'cloudformation')
+        cloudformation = boto3.resource(
+            'cloudformation', region_name=REGION,
+            aws_access_key_id='BENCHMARK', aws_secret_access_key='BENCHMARK',
+            config=client_config())
+        self._stub(cloudformation.meta.client)
+        utils._resources[('cloudformation', REGION)] = cloudformation
+
+    def _client(self, service_name):
+        client = boto3.client(
+            service_name, region_name=REGION,
+            aws_access_key_id='BENCHMARK', aws_secret_access_key='BENCHMARK',
+            config=client_config())
+        return self._stub(client)
+
+    def _stub(self, client):
+        instrument_client(client)
+        client.meta.events.register('before-send', self._respond)
+        return client
+
+    def _respond(self, request, event_name, **kwargs):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        operation = event_name.rsplit('.', 1)[-1]
+        if operation == 'GetFunctionConfiguration':
+            body = json.dumps({'Description': self.description})
+        elif operation == 'DescribeStacks':
+            body = DESCRIBE_STACKS.format(
+                namespace=CFN_NAMESPACE, stack_name='benchmark-stack',
+                stack_id=stack_id(), parameters=self.stack_parameters)
+        elif operation == 'UpdateStack':
+            body = UPDATE_STACK.format(
+                namespace=CFN_NAMESPACE, stack_id=stack_id())
+        elif operation == 'DescribeStackEvents':
+            body = DESCRIBE_STACK_EVENTS.format(namespace=CFN_NAMESPACE)
+        elif operation == 'SendMessageBatch':
+            body = SEND_MESSAGE_BATCH.format(namespace=SQS_NAMESPACE)
+        else:
+            raise ValueError('No stub for {0}'.format(event_name))
+        return AWSResponse(
+            request.url, 200, {}, RawResponse(body.encode('utf-8')))
+
+
+class Context(object):
+
+    """Stand-in for the Lambda context."""
+
+    invoked_function_arn = 'arn:aws:lambda:{0}:{1}:function:crassus'.format(
+        REGION, ACCOUNT)
+    function_version = '$LATEST'
+    function_name = 'crassus'
+
+    def __init__(self, request_id):
+        self.aws_request_id = request_id
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def parameter_name(number):
+    return 'Parameter{0}'.format(number)
+
+
+def stack_id(stack_name='benchmark-stack'):
+    return 'arn:aws:cloudformation:{0}:{1}:stack/{2}/{3}'.format(
+        REGION, ACCOUNT, stack_name, 'd1834770-91e8-11e5-98ba-50d5026f660a')
+
+
+def update_event(batch_size, parameter_count):
+    """Return an SNS event with batch_size update messages."""
+    return {'Records': [
+        {'EventSource': 'aws:sns', 'Sns': {
+            'MessageId': 'message-{0}'.format(next(message_ids)),
+            'Message': json.dumps({
+                'version': '1',
+                'stackName': 'benchmark-stack-{0}'.format(number),
+                'region': REGION,
+                'parameters': dict(
+                    (parameter_name(key), 'value-{0}'.format(key))
+                    for key in range(parameter_count))})}}
+        for number in range(batch_size)]}
+
+
+def cfn_event(batch_size, parameter_count):
+    """Return an SNS event with batch_size CloudFormation events."""
+    properties = json.dumps(dict(
+        (parameter_name(key), 'value-{0}'.format(key))
+        for key in range(parameter_count)))
+    return {'Records': [
+        {'EventSource': 'aws:sns', 'Sns': {
+            'MessageId': 'message-{0}'.format(next(message_ids)),
+            'Message': (
+                "StackId='{stack_id}'\n"
+                "Timestamp='2015-11-23T16:53:46.443Z'\n"
+                "EventId='resource-UPDATE_COMPLETE-{number}'\n"
+                "LogicalResourceId='resource'\n"
+                "PhysicalResourceId='benchmark-resource'\n"
+                "ResourceProperties='{properties}\n'\n"
+                "ResourceStatus='UPDATE_COMPLETE'\n"
+                "ResourceStatusReason=''\n"
+                "ResourceType='AWS::EC2::Instance'\n"
+                "StackName='benchmark-stack'\n").format(
+                    stack_id=stack_id(), number=number,
+                    properties=properties)}}
+        for number in range(batch_size)]}
+
+
+HANDLERS = [
+    ('handler', crassus_deployer_lambda.handler, update_event),
+    ('cfn_output_converter', crassus_deployer_lambda.cfn_output_converter,
+     cfn_event),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def max_rss_kb():
+    """Return the maximum resident set size of the process in KB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, OS X bytes
+    return max_rss / 1024.0 if sys.platform == 'darwin' else max_rss
+
+
+def run(handler, make_event, batch_size, parameter_count, invocations,
+        latency):
+    """Invoke the handler, return a tuple of the measured values."""
+    stubbed_aws = StubbedAws(latency, parameter_count)
+    stubbed_aws.install()
+    sink = MemorySink()
+    set_metrics_sink(sink)
+    events = [
+        make_event(batch_size, parameter_count)
+        for _ in range(invocations)]
+    # A warm container, the first invocation only fills the caches
+    handler(make_event(batch_size, parameter_count),
+            Context('warm-up'))
+    del sink.emitted[:]
+
+    latencies = []
+    peaks = []
+    max_rss_before = max_rss_kb() if resource is not None else None
+    start = time.time()
+    for number, event in enumerate(events):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        invocation_start = time.time()
+        handler(event, Context('request-{0}'.format(number)))
+        latencies.append(time.time() - invocation_start)
+        if tracemalloc is not None:
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024.0)
+            tracemalloc.stop()
+    total_time = time.time() - start
+
+    messages = batch_size * invocations
+    aws_calls = sum(
+        metrics.counts.get(METRIC_AWS_CALLS, 0) for metrics in sink.emitted)
+    if peaks:
+        memory = '{0:.1f}'.format(sum(peaks) / messages)
+    elif max_rss_before is not None:
+        memory = '{0:.1f}'.format(
+            (max_rss_kb() - max_rss_before) / messages)
+    else:
+        memory = '-'
+    return (messages / total_time, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            float(aws_calls) / messages, memory)
+
+
+def violations(result, arguments):
+    """Return a description of every threshold the result exceeds."""
+    throughput, _, p99, calls_per_message, _ = result
+    found = []
+    if (arguments.min_throughput is not None and
+            throughput < arguments.min_throughput):
+        found.append('{0:.0f} msgs/s < {1:.0f}'.format(
+            throughput, arguments.min_throughput))
+    if arguments.max_p99 is not None and p99 > arguments.max_p99:
+        found.append('p99 {0:.2f} ms > {1:.2f}'.format(
+            p99, arguments.max_p99))
+    if (arguments.max_calls_per_message is not None and
+            calls_per_message > arguments.max_calls_per_message):
+        found.append('{0:.2f} calls/msg > {1:.2f}'.format(
+            calls_per_message, arguments.max_calls_per_message))
+    return found
+
+
+def comma_separated_numbers(value):
+    return [int(number) for number in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--invocations', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds per stubbed AWS request')
+    parser.add_argument('--batch-sizes', type=comma_separated_numbers,
+                        default=[1, 10])
+    parser.add_argument('--parameters', type=comma_separated_numbers,
+                        default=[10, 100])
+    parser.add_argument('--min-throughput', type=float,
+                        help='fail below this many messages per second')
+    parser.add_argument('--max-p99', type=float,
+                        help='fail above this p99 latency in milliseconds')
+    parser.add_argument('--max-calls-per-message', type=float,
+                        help='fail above this many AWS calls per message')
+    arguments = parser.parse_args()
+
+    print('{0:<22} {1:>6} {2:>6} {3:>10} {4:>9} {5:>9} {6:>10} {7:>9}'
+          .format('handler', 'batch', 'params', 'msgs/s', 'p50 ms',
+                  'p99 ms', 'calls/msg',
+                  'KB/msg' if tracemalloc is not None else 'RSS KB/msg'))
+    failed = False
+    for name, handler, make_event in HANDLERS:
+        for batch_size, parameter_count in itertools.product(
+                arguments.batch_sizes, arguments.parameters):
+            result = run(
+                handler, make_event, batch_size, parameter_count,
+                arguments.invocations, arguments.latency / 1000.0)
+            found = violations(result, arguments)
+            failed = failed or bool(found)
+            print('{0:<22} {1:>6} {2:>6} {3:>10.0f} {4:>9.2f} {5:>9.2f} '
+                  '{6:>10.2f} {7:>9}{8}'.format(
+                      name, batch_size, parameter_count, *result + (
+                          '  FAILED: ' + ', '.join(found) if found
+                          else '',)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cold start import time benchmark for the crassus Lambda handlers.
+
+Every run starts a fresh interpreter, so nothing is cached in
+sys.modules, and measures the time needed to import the handler module
+and the crassus modules the handler imports on its first invocation.
+
+Usage: import_time_benchmark.py [RUNS]
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+RUNS = 20
+
+# Handler of crassus_deployer_lambda -> module it imports on first call
+HANDLERS = {
+    'handler': 'crassus.deployer',
+    'cfn_output_converter': 'crassus.output_converter',
+}
+
+MEASURE = """
+import time
+start = time.time()
+import crassus_deployer_lambda
+import {module}
+print((time.time() - start) * 1000)
+"""
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+src_dir = os.path.dirname(os.path.dirname(my_dir))
+
+
+def measure(module, runs):
+    """Return the import times of the given number of cold runs in ms."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([
+        os.path.join(src_dir, 'main', 'python'),
+        os.path.join(src_dir, 'main', 'scripts')])
+    env.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+    return [
+        float(subprocess.check_output(
+            [sys.executable, '-c', MEASURE.format(module=module)], env=env))
+        for _ in range(runs)]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    print('{0:<22} {1:>9} {2:>9} {3:>9}'.format(
+        'handler', 'min ms', 'median ms', 'max ms'))
+    for handler, module in sorted(HANDLERS.items()):
+        timings = sorted(measure(module, runs))
+        print('{0:<22} {1:>9.1f} {2:>9.1f} {3:>9.1f}'.format(
+            handler, timings[0], timings[len(timings) // 2], timings[-1]))
+
+
+if __name__ == '__main__':
+    main()
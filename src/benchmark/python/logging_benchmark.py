@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of the logging path of the deployer: logging a large
+event eagerly formatted, lazily with the full repr and lazily with
+log_summary(), with the record dropped by the level or written as text
+or JSON to a null stream.
+
+Usage: logging_benchmark.py [NUMBER]
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import sys
+import timeit
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(my_dir)), 'main', 'python'))
+
+from crassus.utils import (  # noqa: E402
+    JsonLogFormatter, LogFieldsFilter, log_summary, set_log_fields,
+    start_invocation_logging)
+
+NUMBER = 2000
+
+
+class NullStream(object):
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def sns_event(size):
+    """Return an SNS event with size update messages."""
+    return {'Records': [
+        {'Sns': {
+            'MessageId': 'message-{0}'.format(number),
+            'Message': json.dumps({
+                'version': '1',
+                'stackName': 'benchmark-stack-{0}'.format(number),
+                'region': 'eu-west-1',
+                'parameters': dict(
+                    ('Parameter{0}'.format(key), 'value-{0}'.format(key))
+                    for key in range(20))})}}
+        for number in range(size)]}
+
+
+def benchmark_logger(level, formatter):
+    benchmark_logger = logging.getLogger('crassus-benchmark')
+    benchmark_logger.propagate = False
+    benchmark_logger.handlers = []
+    benchmark_logger.setLevel(level)
+    handler = logging.StreamHandler(NullStream())
+    handler.setFormatter(formatter)
+    handler.addFilter(LogFieldsFilter())
+    benchmark_logger.addHandler(handler)
+    return benchmark_logger
+
+
+CASES = [
+    ('eager', lambda logger, event: logger.debug(
+        'Received event: {0!r}'.format(event))),
+    ('lazy repr', lambda logger, event: logger.debug(
+        'Received event: %r', event)),
+    ('lazy summary', lambda logger, event: logger.debug(
+        'Received event: %s', log_summary(event))),
+]
+
+SETUPS = [
+    ('INFO', logging.INFO, logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')),
+    ('DEBUG text', logging.DEBUG, logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')),
+    ('DEBUG json', logging.DEBUG, JsonLogFormatter()),
+]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else NUMBER
+    start_invocation_logging(None)
+    set_log_fields(messageId='message-0', stackName='benchmark-stack-0')
+    event = sns_event(10)
+    print('{0:<12} {1}'.format('', ''.join(
+        '{0:>16}'.format(name + ' us') for name, _ in CASES)))
+    for setup_name, level, formatter in SETUPS:
+        logger = benchmark_logger(level, formatter)
+        times = [
+            min(timeit.repeat(
+                lambda: log(logger, event), number=number,
+                repeat=3)) / number * 1e6
+            for _, log in CASES]
+        print('{0:<12} {1}'.format(setup_name, ''.join(
+            '{0:>16.1f}'.format(case_time) for case_time in times)))
+
+
+if __name__ == '__main__':
+    main()
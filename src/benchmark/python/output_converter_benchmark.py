@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of OutputConverter._parse_sns_message against the former
+split based parser, on CloudFormation notifications with small and
+large ResourceProperties. The last column parses only the fields that
+convert() needs.
+
+Usage: output_converter_benchmark.py [NUMBER]
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import timeit
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(my_dir)), 'main', 'python'))
+
+from crassus.output_converter import (  # noqa: E402
+    REQUIRED_FIELDS, OutputConverter)
+
+NUMBER = 2000
+
+
+def split_parse_sns_message(sns_message):
+    """The former split based parser, as reference."""
+    splitted_list = sns_message.split('\'\n')
+    if splitted_list[-1] != '' and splitted_list[-1][-1] == '\'':
+        splitted_list[-1] = splitted_list[-1][:-1]
+    result_dict = {}
+    for line_item in splitted_list:
+        line_item = line_item.strip()
+        if '=\'' not in line_item:
+            continue
+        key, value = line_item.split('=\'', 1)
+        try:
+            result_dict[key] = json.loads(value)
+        except ValueError:
+            result_dict[key] = value
+    return result_dict
+
+
+def cfn_notification(resource_properties):
+    """Return a CloudFormation SNS notification with the properties."""
+    stack_id = ('arn:aws:cloudformation:eu-west-1:123456789012:stack/'
+                'benchmark-stack/d1834770-91e8-11e5-98ba-50d5026f660a')
+    return (
+        "StackId='{stack_id}'\n"
+        "Timestamp='2015-11-23T16:53:46.443Z'\n"
+        "EventId='resource-UPDATE_IN_PROGRESS-2015-11-23T16:53:46.443Z'\n"
+        "LogicalResourceId='resource'\n"
+        "Namespace='123456789012'\n"
+        "PhysicalResourceId='benchmark-stack-resource-R9ZUQEFM5L6G'\n"
+        "ResourceProperties='{properties}\n'\n"
+        "ResourceStatus='UPDATE_IN_PROGRESS'\n"
+        "ResourceStatusReason='Resource update Initiated'\n"
+        "ResourceType='AWS::EC2::LaunchConfiguration'\n"
+        "StackName='benchmark-stack'\n").format(
+            stack_id=stack_id, properties=json.dumps(resource_properties))
+
+
+def resource_properties(size):
+    """Return launch configuration like properties with size entries."""
+    return {
+        'ImageId': 'ami-12345678',
+        'InstanceType': 't2.micro',
+        'UserData': 'IyEvYmluL2Jhc2gK' * size,
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/xvd{0}'.format(number),
+             'Ebs': {'VolumeSize': number, 'VolumeType': 'gp2'}}
+            for number in range(size)],
+        'Tags': dict(('tag{0}'.format(number), 'value{0}'.format(number))
+                     for number in range(size)),
+    }
+
+
+PAYLOADS = [
+    ('no properties', cfn_notification({})),
+    ('10 properties', cfn_notification(resource_properties(10))),
+    ('200 properties', cfn_notification(resource_properties(200))),
+]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else NUMBER
+    parse = OutputConverter(None, None)._parse_sns_message
+    print('{0:<16} {1:>9} {2:>12} {3:>12} {4:>8} {5:>12}'.format(
+        'payload', 'bytes', 'split us', 'single us', 'speedup',
+        'fields us'))
+    for name, payload in PAYLOADS:
+        assert parse(payload) == split_parse_sns_message(payload)
+        split_time = min(timeit.repeat(
+            lambda: split_parse_sns_message(payload),
+            number=number, repeat=3)) / number * 1e6
+        single_time = min(timeit.repeat(
+            lambda: parse(payload), number=number, repeat=3)) / number * 1e6
+        fields_time = min(timeit.repeat(
+            lambda: parse(payload, REQUIRED_FIELDS),
+            number=number, repeat=3)) / number * 1e6
+        print('{0:<16} {1:>9} {2:>12.1f} {3:>12.1f} {4:>7.2f}x {5:>12.1f}'
+              .format(name, len(payload), split_time, single_time,
+                      split_time / single_time, fields_time))
+
+
+if __name__ == '__main__':
+    main()
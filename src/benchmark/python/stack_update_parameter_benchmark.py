@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of parsing and validating update messages into a
+StackUpdateParameter, and of converting them to the AWS format, on
+messages with small and large parameter maps.
+
+Usage: stack_update_parameter_benchmark.py [NUMBER]
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import timeit
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(my_dir)), 'main', 'python'))
+
+from crassus.deployer import Crassus  # noqa: E402
+
+NUMBER = 2000
+
+
+def sns_record(size):
+    """Return an SNS record with an update message of size parameters."""
+    return {'Sns': {
+        'MessageId': 'benchmark-message',
+        'Message': json.dumps({
+            'version': '1',
+            'stackName': 'benchmark-stack',
+            'region': 'eu-west-1',
+            'parameters': dict(
+                ('Parameter{0}'.format(number), 'value-{0}'.format(number))
+                for number in range(size))})}}
+
+
+RECORDS = [
+    ('1 parameter', sns_record(1)),
+    ('20 parameters', sns_record(20)),
+    ('200 parameters', sns_record(200)),
+]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else NUMBER
+    print('{0:<16} {1:>9} {2:>12} {3:>12} {4:>12}'.format(
+        'message', 'bytes', 'parse us', 'aws us', 'messages/s'))
+    for name, record in RECORDS:
+        parse_time = min(timeit.repeat(
+            lambda: Crassus.parse_record(record),
+            number=number, repeat=3)) / number
+        stack_update_parameters = Crassus.parse_record(record)
+        aws_time = min(timeit.repeat(
+            stack_update_parameters.to_aws_format,
+            number=number, repeat=3)) / number
+        print('{0:<16} {1:>9} {2:>12.1f} {3:>12.1f} {4:>12.0f}'.format(
+            name, len(record['Sns']['Message']), parse_time * 1e6,
+            aws_time * 1e6, 1 / parse_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,29 @@
-from deployer import Crassus
+"""
+Crassus is re-exported lazily, so that importing another module of the
+package, e.g. crassus.output_converter, does not import the deployer.
+"""
+
+import sys
+from types import ModuleType
 
 __all__ = ['Crassus']
+
+
+class _Package(ModuleType):
+
+    """The crassus package, importing the deployer on first use."""
+
+    def __getattr__(self, name):
+        if name == 'Crassus':
+            from crassus.deployer import Crassus
+            return Crassus
+        raise AttributeError(
+            'module {0!r} has no attribute {1!r}'.format(self.__name__, name))
+
+
+_package = _Package(__name__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+# Keeps the original module alive, Python 2 clears the globals of a
+# collected module
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
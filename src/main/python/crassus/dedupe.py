@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Stores for the keys of messages that were already processed."""
+
+import threading
+import time
+from collections import OrderedDict
+
+STORE_MEMORY = 'memory'
+STORE_SQLITE_PREFIX = 'sqlite:'
+
+# (store specification, ttl) -> store, kept for the warm container
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class DedupeStore(object):
+
+    """
+    Base class of the dedupe stores. Keys expire ttl seconds after they
+    were added, or never if ttl is None. Lookups are counted in stats.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def __contains__(self, key):
+        found = self._contains(key, time.time())
+        self.stats['hits' if found else 'misses'] += 1
+        return found
+
+    def add(self, key):
+        self._add(key, time.time())
+
+    @property
+    def hit_rate(self):
+        """The share of lookups that found their key, None without any."""
+        lookups = self.stats['hits'] + self.stats['misses']
+        if not lookups:
+            return None
+        return float(self.stats['hits']) / lookups
+
+    def _expired(self, added, now):
+        return self.ttl is not None and now - added >= self.ttl
+
+    def _contains(self, key, now):
+        raise NotImplementedError()
+
+    def _add(self, key, now):
+        raise NotImplementedError()
+
+
+class LruDedupeStore(DedupeStore):
+
+    """
+    In-process store of message keys, living as long as the warm
+    container. When full, the least recently added key is dropped.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        super(LruDedupeStore, self).__init__(ttl)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # key -> time it was added
+        self._keys = OrderedDict()
+
+    def _contains(self, key, now):
+        with self._lock:
+            added = self._keys.get(key)
+            if added is None:
+                return False
+            if self._expired(added, now):
+                del self._keys[key]
+                return False
+            return True
+
+    def _add(self, key, now):
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = now
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        self._keys.clear()
+
+
+class SqliteDedupeStore(DedupeStore):
+
+    """
+    Store of message keys in an SQLite database file, which can outlive
+    the container if it is on a shared file system.
+    """
+
+    def __init__(self, path, ttl=None):
+        super(SqliteDedupeStore, self).__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        # Imported here, so that the memory store does not load sqlite3
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS dedupe_keys '
+                '(key TEXT PRIMARY KEY, added REAL NOT NULL)')
+
+    def _contains(self, key, now):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT added FROM dedupe_keys WHERE key = ?',
+                (key,)).fetchone()
+        return row is not None and not self._expired(row[0], now)
+
+    def _add(self, key, now):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO dedupe_keys (key, added) '
+                'VALUES (?, ?)', (key, now))
+            if self.ttl is not None:
+                self._connection.execute(
+                    'DELETE FROM dedupe_keys WHERE added <= ?',
+                    (now - self.ttl,))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM dedupe_keys')
+
+
+def get_dedupe_store(specification, ttl=None):
+    """
+    Return the shared dedupe store for a specification, either 'memory'
+    for an LruDedupeStore or 'sqlite:<path>' for an SqliteDedupeStore.
+    """
+    key = (specification, ttl)
+    with _stores_lock:
+        if key not in _stores:
+            if specification.startswith(STORE_SQLITE_PREFIX):
+                _stores[key] = SqliteDedupeStore(
+                    specification[len(STORE_SQLITE_PREFIX):], ttl)
+            elif specification == STORE_MEMORY:
+                _stores[key] = LruDedupeStore(ttl=ttl)
+            else:
+                raise ValueError(
+                    'Unknown dedupe store \'{0}\''.format(specification))
+        return _stores[key]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Delay queues for updates that have to be retried later."""
+
+import time
+
+from crassus.retry import RetryPolicy
+from crassus.utils import get_client
+
+# SQS does not delay messages for longer than 15 minutes
+MAX_DELAY_SECONDS = 900
+BASE_DELAY_SECONDS = 30
+
+
+def backoff_delay(attempt, base=BASE_DELAY_SECONDS, cap=MAX_DELAY_SECONDS):
+    """
+    Return the delay in seconds before the given retry attempt (starting
+    with 1), doubling with every attempt up to cap.
+    """
+    return min(cap, base * 2 ** (attempt - 1))
+
+
+class SqsDelayQueue(object):
+
+    """
+    Delay queue backed by an SQS queue. Messages become visible after
+    their delay, and are delivered back to crassus by an SQS event
+    source mapping of the queue.
+    """
+
+    def __init__(self, queue_url, retry_policy=None):
+        self.queue_url = queue_url
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def put(self, message_body, delay_seconds):
+        self.retry_policy.call(
+            'sqs.SendMessage', get_client('sqs').send_message,
+            QueueUrl=self.queue_url, MessageBody=message_body,
+            DelaySeconds=min(int(delay_seconds), MAX_DELAY_SECONDS))
+
+
+class LocalDelayQueue(object):
+
+    """
+    In-process delay queue with the interface of SqsDelayQueue, for
+    tests and local runs. Due messages are taken with pop_due().
+    """
+
+    def __init__(self):
+        # List of (due time, message body)
+        self.messages = []
+
+    def put(self, message_body, delay_seconds):
+        self.messages.append((time.time() + delay_seconds, message_body))
+
+    def pop_due(self, now=None):
+        """Remove and return the bodies of all messages that are due."""
+        if now is None:
+            now = time.time()
+        due = [body for due_time, body in self.messages if due_time <= now]
+        self.messages = [
+            (due_time, body) for due_time, body in self.messages
+            if due_time > now]
+        return due
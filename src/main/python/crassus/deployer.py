@@ -1,34 +1,100 @@
+import copy
 import datetime
+import hashlib
+import itertools
 import json
+import time
+from collections import OrderedDict
 
-import boto3
 from botocore.exceptions import ClientError
-from crassus.utils import get_lambda_config_property, sqs_send_message, logger
-from crassus.deployment_response import DeploymentResponse
-from dateutil import tz
+from crassus.dedupe import STORE_MEMORY, get_dedupe_store
+from crassus.metrics import timed
+from crassus.delay_queue import SqsDelayQueue, backoff_delay
+from crassus.retry import (
+    RetryPolicy, deadline_from_context, outcome_fields)
+from crassus.tracking import get_pending_update_store
+from crassus.utils import (
+    SqsMessageBatch, fan_out, get_lambda_config_property, get_resource,
+    log_summary, set_log_fields, sqs_send_message, start_invocation_logging,
+    logger)
+from crassus.deployment_response import (
+    CLIENT_REQUEST_TOKEN_PREFIX, DeploymentResponse)
 
 NOTIFICATION_SUBJECT = 'Crassus deployer notification'
 MESSAGE_STACK_NOT_FOUND = 'Stack not found {stack_name}: {message}'
 MESSAGE_UPDATE_PROBLEM = 'Problem while updating stack {stack_name}: {message}'
+MESSAGE_NO_CHANGE = 'No updates are to be performed.'
+MESSAGE_SUPERSEDED = 'Update was superseded by message {message_id}.'
+MESSAGE_DEFERRED = ('Stack {stack_name} is in state {status}, update is '
+                    'retried in {delay} seconds (attempt {attempt}).')
+MESSAGE_STACK_BUSY = ('Stack {stack_name} is still in state {status} after '
+                      '{attempts} attempts, giving up.')
+MESSAGE_INVALID = 'Invalid update message: {reason}'
+
+# How often an update of a busy stack is deferred before it fails
+MAX_DEFER_ATTEMPTS = 8
+
+# Seconds for which processed update messages are remembered
+DEDUPE_TTL = 300
+
+# Seconds to wait for the updates of one region when an event covers
+# several regions, if the Lambda context does not tell the remaining
+# time, and seconds of the invocation kept for sending the responses
+REGION_DEPLOY_TIMEOUT = 10
+RESPONSE_TIME_RESERVE = 3
+
+# (stack name, region, role ARN) -> (time, message id, parameters) of the
+# updates triggered by this container, to coalesce updates within a time
+# window
+_recent_updates = {}
+
+# Seconds for which a deferred update is remembered, longer than the
+# delay of any retry
+DEFERRED_UPDATE_TTL = 1800
+
+# (stack name, region, role ARN) -> {message id: [sequence, deferral time,
+# parameters, id of the superseding message or None]} of the updates this
+# container deferred, so that a newer update of the same stack supersedes
+# them before they are retried
+_deferred_updates = {}
+# The order in which this container received the updates
+_update_sequence = itertools.count()
 
 
 class Crassus(object):
 
     def __init__(self, event, context):
         self.event = event
-        logger.debug('Received event: %r', event)
         self.context = context
-        logger.debug('Received context: %r', context)
-
-        self.aws_cfn = boto3.resource('cloudformation')
-        self.aws_sns = boto3.resource('sns')
-        self.aws_lambda = boto3.client('lambda')
+        start_invocation_logging(context)
+        logger.debug('Received event: %s', log_summary(event))
 
         self._output_topics = None
         self._cfn_output_topics = None
+        self._coalesce_window = None
+        self._delay_queue = None
+        self._retry_max_attempts = None
+        self._dedupe_store = None
+        self._tracking_store = None
         self._stack_update_parameters = None
+        self._stack_update_parameters_list = None
+        self._rejected_messages = None
         self._stack_name = None
+        self._sequences = {}
         self.stack = None
+        self.retry_policy = RetryPolicy.for_context(context)
+        self.sqs_batch = SqsMessageBatch(self.retry_policy)
+
+    @property
+    def aws_cfn(self):
+        """
+        The CloudFormation resource of the region of the update, with the
+        credentials of its role if it names one.
+        """
+        return get_resource(
+            'cloudformation', self.stack_update_parameters.region,
+            role_arn=self.stack_update_parameters.role_arn,
+            retry_policy=self.retry_policy)
 
     @property
     def stack_name(self):
@@ -42,12 +108,316 @@ class Crassus(object):
             self.parse_event()
         return self._stack_update_parameters
 
+    @property
+    def stack_update_parameters_list(self):
+        if self._stack_update_parameters_list is None:
+            self.parse_event()
+        return self._stack_update_parameters_list
+
     def parse_event(self):
-        message = json.loads(self.event['Records'][0]['Sns']['Message'])
-        self._stack_update_parameters = StackUpdateParameter(message)
-        self._stack_name = self._stack_update_parameters.stack_name
-        logger.debug('Extracted Update Parameters: %r',
-                     self._stack_update_parameters)
+        """
+        Parse every record of the event into a StackUpdateParameter.
+        Records with an invalid message are kept aside as
+        InvalidMessageErrors, to be rejected by deploy().
+
+        The first parsed record becomes the current one, so that single
+        record events behave as before.
+        """
+        self._stack_update_parameters_list = []
+        self._rejected_messages = []
+        allowed_roles = self.allowed_roles
+        for record in self.event['Records']:
+            try:
+                self._stack_update_parameters_list.append(
+                    self.parse_record(record, allowed_roles))
+            except InvalidMessageError as error:
+                logger.error(error.message)
+                self._rejected_messages.append(error)
+        if self._stack_update_parameters_list:
+            self._select(self._stack_update_parameters_list[0])
+        logger.debug('Extracted Update Parameters: %s',
+                     log_summary(self._stack_update_parameters_list))
+
+    @staticmethod
+    def parse_record(record, allowed_roles=None):
+        """
+        Parse an SNS record with an update message, or an SQS record with
+        a deferred update delivered back from the retry queue.
+
+        Raise an InvalidMessageError if the message is not valid, or if
+        its roleArn is not in allowed_roles (not checked if None).
+        """
+        if 'Sns' in record:
+            message_id = record['Sns'].get('MessageId')
+            body = record['Sns']['Message']
+        else:
+            message_id = record.get('messageId')
+            body = record['body']
+        try:
+            message = json.loads(body)
+        except ValueError as error:
+            raise InvalidMessageError(
+                MESSAGE_INVALID.format(reason=error.message),
+                message_id=message_id)
+        attempt = 0
+        if 'Sns' not in record and isinstance(message, dict):
+            message_id = message.get('messageId', message_id)
+            attempt = message.get('attempt', 0)
+        try:
+            validate_message(message, allowed_roles)
+        except InvalidMessageError as error:
+            error.message_id = message_id
+            raise
+        return StackUpdateParameter(
+            message, message_id=message_id, attempt=attempt, validate=False)
+
+    @property
+    def allowed_roles(self):
+        """
+        The roles update messages may name, role_arns property of the
+        Lambda description: a list of role ARNs and account ids, whose
+        roles are all allowed. Messages with any other roleArn are
+        rejected, none is allowed by default.
+        """
+        return get_lambda_config_property(
+            self.context, 'role_arns', None) or []
+
+    @property
+    def rejected_messages(self):
+        """The InvalidMessageErrors of the records that failed to parse."""
+        if self._rejected_messages is None:
+            self.parse_event()
+        return self._rejected_messages
+
+    def notify_rejected(self):
+        """
+        Send a failure response for every invalid message, with the stack
+        name and message id the message had, if any.
+        """
+        for error in self.rejected_messages:
+            set_log_fields(messageId=error.message_id,
+                           stackName=error.stack_name)
+            self.notify(DeploymentResponse.STATUS_FAILURE, error.message,
+                        stackName=error.stack_name,
+                        requestMessageId=error.message_id)
+
+    def _select(self, stack_update_parameters):
+        """Make the given update the one to load, update and notify."""
+        self._stack_update_parameters = stack_update_parameters
+        self._stack_name = stack_update_parameters.stack_name
+        self.stack = None
+        set_log_fields(messageId=stack_update_parameters.message_id,
+                       stackName=stack_update_parameters.stack_name)
+
+    @property
+    def dedupe_store(self):
+        """
+        The store of processed update messages, for the dedupe_store and
+        dedupe_ttl properties of the Lambda description. None if the
+        dedupe_store property is set to null.
+        """
+        if self._dedupe_store is not None:
+            return self._dedupe_store
+        specification = get_lambda_config_property(
+            self.context, 'dedupe_store', STORE_MEMORY)
+        if specification is not None:
+            self._dedupe_store = get_dedupe_store(
+                specification, get_lambda_config_property(
+                    self.context, 'dedupe_ttl', DEDUPE_TTL))
+        return self._dedupe_store
+
+    def drop_duplicates(self):
+        """
+        Return the updates of the event whose message was not processed
+        before.
+
+        Redelivered messages, with a known SNS MessageId, are dropped
+        silently, their first delivery already got a response. A new
+        message with the content of a processed one is deployed again,
+        the stack may have changed meanwhile. update() skips it if the
+        stack already has its values.
+        """
+        store = self.dedupe_store
+        if store is None:
+            return self.stack_update_parameters_list
+        updates = []
+        for stack_update_parameters in self.stack_update_parameters_list:
+            if (stack_update_parameters.message_id is not None and
+                    stack_update_parameters.message_key() in store):
+                logger.info('Dropped redelivered message %s',
+                            stack_update_parameters.message_id)
+            else:
+                updates.append(stack_update_parameters)
+        logger.debug('Dedupe store stats: %r', store.stats)
+        return updates
+
+    def remember_processed(self, updates):
+        """Record the updates in the dedupe store, if there is one."""
+        store = self.dedupe_store
+        if store is None:
+            return
+        for stack_update_parameters in updates:
+            if stack_update_parameters.message_id is not None:
+                store.add(stack_update_parameters.message_key())
+
+    def coalesce(self, updates=None):
+        """
+        Merge the given updates, all updates of the event by default, for
+        the same stack, region and role into one update, the last message
+        wins per parameter.
+
+        Return a list of (update, superseded updates) tuples, in the order
+        in which the stacks first appeared in the event. The merged update
+        carries the message id of the last message and the highest retry
+        attempt of the merged ones.
+
+        Only the records of one event are merged here. SNS delivers one
+        record per invocation, so SNS messages are rarely merged by this
+        step. Deferred updates from the retry queue arrive in SQS
+        batches and are merged. Across invocations only
+        apply_recent_update() merges, and only within one warm
+        container. Updates for a busy stack are deferred, not failed,
+        if a retry queue is configured.
+        """
+        if updates is None:
+            updates = self.stack_update_parameters_list
+        groups = OrderedDict()
+        for stack_update_parameters in updates:
+            groups.setdefault(
+                stack_update_parameters.stack_key(), []).append(
+                    stack_update_parameters)
+        coalesced = []
+        for updates in groups.values():
+            if len(updates) == 1:
+                coalesced.append((updates[0], []))
+                continue
+            latest = updates[-1]
+            parameters = {}
+            for stack_update_parameters in updates:
+                parameters.update(stack_update_parameters.parameters)
+            message = latest.to_message()
+            message['parameters'] = parameters
+            # The most retried update counts, so that retries of a busy
+            # stack still give up after retry_max_attempts
+            merged = StackUpdateParameter(
+                message, message_id=latest.message_id,
+                attempt=max(update.attempt for update in updates),
+                validate=False)
+            coalesced.append((merged, updates[:-1]))
+        return coalesced
+
+    @property
+    def coalesce_window(self):
+        """
+        Seconds for which updates triggered by this container are merged
+        into later updates of the same stack, coalesce_window property of
+        the Lambda description. The window is container local state,
+        concurrent invocations in other containers do not see it.
+        """
+        if self._coalesce_window is not None:
+            return self._coalesce_window
+        self._coalesce_window = get_lambda_config_property(
+            self.context, 'coalesce_window', 0)
+        return self._coalesce_window
+
+    def apply_recent_update(self, stack_update_parameters):
+        """
+        Merge the update triggered by this container for the same stack
+        within the last coalesce_window seconds into the given update,
+        which wins per parameter.
+
+        The update is deployed even if the recent one had the same
+        values, the stack may have changed meanwhile, e.g. by a
+        rollback. update() skips it if the stack already has them.
+        """
+        key = stack_update_parameters.stack_key()
+        if key not in _recent_updates:
+            return
+        update_time, _, parameters = _recent_updates[key]
+        if time.time() - update_time >= self.coalesce_window:
+            del _recent_updates[key]
+            return
+        for update_key, update_value in parameters.items():
+            stack_update_parameters.parameters.setdefault(
+                update_key, update_value)
+
+    def sequence(self, stack_update_parameters):
+        """
+        Return the position of the update in the order in which this
+        container received the updates. A deferred update keeps the
+        position of its first delivery.
+        """
+        message_id = stack_update_parameters.message_id
+        if message_id not in self._sequences:
+            self._sequences[message_id] = next(_update_sequence)
+        return self._sequences[message_id]
+
+    def drop_superseded_deferrals(self, updates):
+        """
+        Return the updates that were not superseded while they waited on
+        the retry queue, see supersede_deferred(). The superseded ones
+        get a response that points to the newer update.
+
+        Only the updates deferred by this container are known, a
+        deferred update retried in another container is deployed.
+        """
+        kept = []
+        for stack_update_parameters in updates:
+            deferred = _deferred_updates.get(
+                stack_update_parameters.stack_key(), {}).pop(
+                    stack_update_parameters.message_id, None)
+            if deferred is None:
+                kept.append(stack_update_parameters)
+                continue
+            sequence, _, _, superseded_by = deferred
+            if superseded_by is None:
+                self._sequences[stack_update_parameters.message_id] = \
+                    sequence
+                kept.append(stack_update_parameters)
+                continue
+            logger.info('Dropped deferred message %s, superseded by %s',
+                        stack_update_parameters.message_id, superseded_by)
+            self.notify_superseded([stack_update_parameters], superseded_by)
+            self.remember_processed([stack_update_parameters])
+        return kept
+
+    def supersede_deferred(self, stack_update_parameters, sequence):
+        """
+        Mark the updates of the same stack that this container deferred
+        and received before the given one as superseded by it, and merge
+        their parameters into it, the given update wins per parameter.
+        The deferred updates are dropped when they are retried, so that
+        an older update does not overwrite a newer one.
+        """
+        deferred_updates = _deferred_updates.get(
+            stack_update_parameters.stack_key(), {})
+        now = time.time()
+        for message_id, deferred in deferred_updates.items():
+            deferred_sequence, deferral_time, parameters, superseded_by = \
+                deferred
+            if now - deferral_time >= DEFERRED_UPDATE_TTL:
+                del deferred_updates[message_id]
+                continue
+            if superseded_by is None and deferred_sequence < sequence:
+                deferred[3] = stack_update_parameters.message_id
+                for update_key, update_value in parameters.items():
+                    stack_update_parameters.parameters.setdefault(
+                        update_key, update_value)
+
+    def remember_deferred(self, stack_update_parameters):
+        if stack_update_parameters.message_id is None:
+            return
+        _deferred_updates.setdefault(
+            stack_update_parameters.stack_key(), {})[
+                stack_update_parameters.message_id] = [
+                    self.sequence(stack_update_parameters), time.time(),
+                    dict(stack_update_parameters.parameters), None]
+
+    def remember_update(self, stack_update_parameters):
+        if self.coalesce_window:
+            _recent_updates[stack_update_parameters.stack_key()] = (
+                time.time(), stack_update_parameters.message_id,
+                dict(stack_update_parameters.parameters))
 
     @property
     def output_topics(self):
@@ -65,87 +435,472 @@ class Crassus(object):
             self.context, 'cfn_events')
         return self._cfn_output_topics
 
-    def notify(self, status, message):
+    @property
+    def delay_queue(self):
+        """
+        The queue deferred updates are put on, an SqsDelayQueue for the
+        retry_queue property of the Lambda description. None if no retry
+        queue is configured.
+        """
+        if self._delay_queue is not None:
+            return self._delay_queue
+        retry_queue = get_lambda_config_property(
+            self.context, 'retry_queue', None)
+        if retry_queue is not None:
+            self._delay_queue = SqsDelayQueue(retry_queue, self.retry_policy)
+        return self._delay_queue
+
+    @property
+    def retry_max_attempts(self):
+        if self._retry_max_attempts is not None:
+            return self._retry_max_attempts
+        self._retry_max_attempts = get_lambda_config_property(
+            self.context, 'retry_max_attempts', MAX_DEFER_ATTEMPTS)
+        return self._retry_max_attempts
+
+    @property
+    def tracking_store(self):
+        """
+        The store of pending updates for the tracking_store property of
+        the Lambda description, see crassus.tracking. None if updates are
+        not tracked.
+        """
+        if self._tracking_store is not None:
+            return self._tracking_store
+        specification = get_lambda_config_property(
+            self.context, 'tracking_store', None)
+        if specification is not None:
+            self._tracking_store = get_pending_update_store(specification)
+        return self._tracking_store
+
+    def track_update(self):
+        """
+        Record the triggered update of the loaded stack as pending, for
+        the output converter to report its outcome. The update was
+        triggered anyway, so a failing store is only logged.
+        """
+        try:
+            if self.tracking_store is None:
+                return
+            self.tracking_store.put({
+                'stackId': self.stack.stack_id,
+                'stackName': self.stack_name,
+                'messageId': self.stack_update_parameters.message_id,
+                'clientRequestToken':
+                    self.stack_update_parameters.client_request_token(),
+                'startTime': time.time()})
+        except Exception as error:
+            logger.error('Unable to track update of stack {0}: {1}'.format(
+                self.stack_name, error))
+
+    @timed('Notify')
+    def notify(self, status, message, **extra_fields):
+        """
+        Send a response for the current update. A stackName in the extra
+        fields replaces the stack name of the current update.
+        """
         if self.output_topics is None:
             return
+        if 'stackName' in extra_fields:
+            stack_name = extra_fields.pop('stackName')
+        else:
+            stack_name = self.stack_name
+        from dateutil import tz
         timestamp_str = datetime.datetime.now(tz=tz.tzutc()).isoformat()
         result_message = DeploymentResponse(
-            status, message, self.stack_name, timestamp_str,
+            status, message, stack_name, timestamp_str,
             DeploymentResponse.EMITTER_CRASSUS)
-        sqs_send_message(self.output_topics, result_message)
+        result_message.update(extra_fields)
+        sqs_send_message(
+            self.output_topics, result_message, batch=self.sqs_batch)
+
+    def notify_superseded(self, superseded, message_id):
+        for stack_update_parameters in superseded:
+            self._select(stack_update_parameters)
+            self.notify(
+                DeploymentResponse.STATUS_SUPERSEDED,
+                MESSAGE_SUPERSEDED.format(message_id=message_id),
+                supersededBy=message_id)
 
+    @timed('Load')
     def load(self):
-        self.stack = self.aws_cfn.Stack(self.stack_name)
+        """
+        Load the stack of the current update.
+
+        Return True if the stack could be loaded and is ready for an
+        update, False otherwise. Updates of a stack with an operation in
+        progress are deferred if a retry queue is configured.
+        """
         try:
-            self.stack.load()
+            # Inside the try, assuming the role of the update can fail
+            self.stack = self.aws_cfn.Stack(self.stack_name)
+            self.retry_policy.call(
+                'cloudformation.DescribeStacks', self.stack.load)
             logger.debug('Loaded Stack: %r', self.stack)
+            if (self.stack.stack_status.endswith('_IN_PROGRESS') and
+                    self.delay_queue is not None):
+                self.defer()
+                return False
+            return True
         except ClientError as error:
             logger.error(MESSAGE_STACK_NOT_FOUND.format(
                 stack_name=self.stack_name, message=error.message))
+            self.notify(DeploymentResponse.STATUS_FAILURE, error.message,
+                        **outcome_fields(error))
+            return False
+
+    def defer(self):
+        """
+        Put the current update on the delay queue, to be retried after an
+        exponentially growing delay.
+        """
+        stack_update_parameters = self.stack_update_parameters
+        attempt = stack_update_parameters.attempt + 1
+        status = self.stack.stack_status
+        if attempt > self.retry_max_attempts:
+            message = MESSAGE_STACK_BUSY.format(
+                stack_name=self.stack_name, status=status,
+                attempts=stack_update_parameters.attempt)
+            logger.error(message)
+            self.notify(DeploymentResponse.STATUS_FAILURE, message)
+            return
+        delay = backoff_delay(attempt)
+        message_body = stack_update_parameters.to_message()
+        message_body['messageId'] = stack_update_parameters.message_id
+        message_body['attempt'] = attempt
+        try:
+            self.delay_queue.put(json.dumps(message_body), delay)
+        except ClientError as error:
+            logger.error(MESSAGE_UPDATE_PROBLEM.format(
+                stack_name=self.stack_name, message=error.message))
             self.notify(DeploymentResponse.STATUS_FAILURE, error.message)
+            return
+        self.remember_deferred(stack_update_parameters)
+        message = MESSAGE_DEFERRED.format(
+            stack_name=self.stack_name, status=status, delay=delay,
+            attempt=attempt)
+        logger.info(message)
+        self.notify(
+            DeploymentResponse.STATUS_DEFERRED, message,
+            retryAttempt=attempt, delaySeconds=delay)
 
+    @timed('Update')
     def update(self):
-        logger.debug('Parameters to be updated: %s', self.stack.parameters)
+        """
+        Update the loaded stack with the merged parameters.
+
+        The update carries a ClientRequestToken derived from the message
+        id, so that a retried update is not submitted twice, and the
+        CloudFormation events and the responses can be matched to the
+        message.
+
+        Return True if the stack was updated or already had the
+        requested values, False otherwise.
+        """
+        logger.debug('Parameters to be updated: %s',
+                     log_summary(self.stack.parameters))
         merged = self.stack_update_parameters.merge(self.stack.parameters)
-        logger.debug('Merged parameters: %s', merged)
+        logger.debug('Merged parameters: %s', log_summary(merged))
+        if not StackUpdateParameter.has_changes(merged):
+            # CloudFormation would reject the update, so skip the call
+            logger.debug(MESSAGE_NO_CHANGE)
+            self.notify(DeploymentResponse.STATUS_NO_CHANGE, MESSAGE_NO_CHANGE)
+            return True
+        update_kwargs = {}
+        token = self.stack_update_parameters.client_request_token()
+        if token is not None:
+            update_kwargs['ClientRequestToken'] = token
+            # Matches the final response of the output converter, which
+            # only knows the token
+            extra_fields = {
+                'clientRequestToken': token,
+                'requestMessageId': self.stack_update_parameters.message_id}
+        else:
+            extra_fields = {}
         try:
             logger.debug('Will try to update Cloudformation')
-            self.stack.update(
+            self.retry_policy.call(
+                'cloudformation.UpdateStack', self.stack.update,
                 UsePreviousTemplate=True,
                 Parameters=merged,
                 Capabilities=['CAPABILITY_IAM'],
-                NotificationARNs=self.cfn_output_topics)
+                NotificationARNs=self.cfn_output_topics,
+                **update_kwargs)
+            self.track_update()
             message = 'Cloudformation was triggered successfully.'
             logger.debug(message)
-            self.notify(DeploymentResponse.STATUS_SUCCESS, message)
+            extra_fields.update(outcome_fields(
+                attempts=self.retry_policy.last_attempts))
+            self.notify(
+                DeploymentResponse.STATUS_SUCCESS, message, **extra_fields)
+            return True
         except ClientError as error:
             logger.error(MESSAGE_UPDATE_PROBLEM.format(
                 stack_name=self.stack_name, message=error.message))
-            self.notify(DeploymentResponse.STATUS_FAILURE, error.message)
+            extra_fields.update(outcome_fields(error))
+            self.notify(
+                DeploymentResponse.STATUS_FAILURE, error.message,
+                **extra_fields)
+            return False
 
+    @timed('Deploy')
     def deploy(self):
-        self.load()
-        self.update()
+        """
+        Deploy every update message of the event in one invocation.
 
+        Invalid messages get a failure response and messages that were
+        processed before are dropped, both before any CloudFormation
+        call. Updates for the same stack are coalesced into one stack
+        update, every message gets its own DeploymentResponse.
+        Superseded messages get one that points to the message of the
+        update that replaced them. The updates of different regions are
+        deployed concurrently. The responses are sent in SQS batches at
+        the end of the invocation.
+        """
+        try:
+            self.notify_rejected()
+            updates = self.drop_superseded_deferrals(self.drop_duplicates())
+            for stack_update_parameters in updates:
+                self.sequence(stack_update_parameters)
+            regions = OrderedDict()
+            for coalesced in self.coalesce(updates):
+                regions.setdefault(coalesced[0].region, []).append(coalesced)
+            if len(regions) <= 1:
+                for coalesced in regions.values():
+                    self.deploy_region(coalesced)
+                return
+            # Every region gets its own worker, sharing the responses batch
+            results = fan_out(
+                lambda region: copy.copy(self).deploy_region(
+                    regions[region]),
+                list(regions), timeout=self.region_deploy_timeout())
+            errors = [error for error in results.values() if error]
+            for region, error in results.items():
+                if error is not None:
+                    logger.error('Deployment in region {0} failed: {1}'
+                                 .format(region, error))
+            if errors:
+                raise errors[0]
+        finally:
+            # Workers that timed out must not add responses any more
+            self.sqs_batch.close()
 
-class StackUpdateParameter(dict):
+    def region_deploy_timeout(self):
+        """
+        Return the seconds to wait for the workers of the regions, the
+        remaining time of the invocation without the time to send the
+        responses.
+        """
+        deadline = deadline_from_context(self.context, RESPONSE_TIME_RESERVE)
+        if deadline is None:
+            return REGION_DEPLOY_TIMEOUT
+        return max(0, deadline - time.time())
 
-    def __init__(self, message):
+    def deploy_region(self, coalesced):
+        """
+        Deploy coalesced updates, a list of (update, superseded updates)
+        tuples, one after the other. Stops once the responses of the
+        invocation were sent, the invocation ran out of time.
+        """
+        for stack_update_parameters, superseded in coalesced:
+            if self.sqs_batch.closed:
+                logger.error(
+                    'Update of stack %s not started, the invocation ran '
+                    'out of time', stack_update_parameters.stack_name)
+                return
+            self.supersede_deferred(stack_update_parameters, max(
+                self.sequence(update)
+                for update in superseded + [stack_update_parameters]))
+            self.apply_recent_update(stack_update_parameters)
+            self.notify_superseded(
+                superseded, stack_update_parameters.message_id)
+            self._select(stack_update_parameters)
+            if self.load() and self.update():
+                self.remember_update(stack_update_parameters)
+                self.remember_processed(
+                    superseded + [stack_update_parameters])
+
+
+class InvalidMessageError(ValueError):
+
+    """
+    Raised for update messages that do not match the message schema,
+    before any call to AWS is made for them.
+    """
+
+    def __init__(self, message, message_id=None, stack_name=None):
+        super(InvalidMessageError, self).__init__(message)
+        self.message_id = message_id
+        self.stack_name = stack_name
+
+
+def validate_message(message, allowed_roles=None):
+    """
+    Check that an update message has a version, a stackName and a region
+    and that its parameters map names to string values. The roleArn, the
+    role to update the stack with, is optional and must be allowed by
+    allowed_roles, if given, see is_role_allowed(). Raise an
+    InvalidMessageError otherwise.
+    """
+    if not isinstance(message, dict):
+        raise InvalidMessageError(MESSAGE_INVALID.format(
+            reason='not an object'))
+    stack_name = message.get('stackName')
+    if not isinstance(stack_name, basestring):
+        stack_name = None
+    for key in ('version', 'stackName', 'region', 'parameters'):
+        if key not in message:
+            raise InvalidMessageError(MESSAGE_INVALID.format(
+                reason='missing {0}'.format(key)), stack_name=stack_name)
+    version = message['version']
+    if (isinstance(version, bool) or
+            not isinstance(version, (basestring, int, long))):
+        raise InvalidMessageError(MESSAGE_INVALID.format(
+            reason='version is not a string'), stack_name=stack_name)
+    for key in ('stackName', 'region'):
+        if not isinstance(message[key], basestring) or not message[key]:
+            raise InvalidMessageError(MESSAGE_INVALID.format(
+                reason='{0} is not a non-empty string'.format(key)),
+                stack_name=stack_name)
+    role_arn = message.get('roleArn')
+    if role_arn is not None and (
+            not isinstance(role_arn, basestring) or not role_arn):
+        raise InvalidMessageError(MESSAGE_INVALID.format(
+            reason='roleArn is not a non-empty string'),
+            stack_name=stack_name)
+    if (role_arn is not None and allowed_roles is not None and
+            not is_role_allowed(role_arn, allowed_roles)):
+        raise InvalidMessageError(MESSAGE_INVALID.format(
+            reason='roleArn {0} is not allowed'.format(role_arn)),
+            stack_name=stack_name)
+    parameters = message['parameters']
+    if not isinstance(parameters, dict):
+        raise InvalidMessageError(MESSAGE_INVALID.format(
+            reason='parameters is not an object'), stack_name=stack_name)
+    for key, value in parameters.items():
+        if not isinstance(value, basestring):
+            raise InvalidMessageError(MESSAGE_INVALID.format(
+                reason='value of parameter {0} is not a string'.format(
+                    key)), stack_name=stack_name)
+
+
+def is_role_allowed(role_arn, allowed_roles):
+    """
+    Return whether the role is in allowed_roles, a list of role ARNs and
+    account ids that allow every role of their account.
+    """
+    if role_arn in allowed_roles:
+        return True
+    arn_fields = role_arn.split(':')
+    return (len(arn_fields) == 6 and arn_fields[2] == 'iam' and
+            arn_fields[4] in allowed_roles)
+
+
+class StackUpdateParameter(object):
+
+    """
+    A validated update message: the stack to update, the role to update
+    it with (None for the role of the Lambda) and the parameters to set,
+    a map of parameter name to value.
+
+    The message is validated, unless validate is False for a message
+    that already was, e.g. by Crassus.parse_record().
+    """
+
+    __slots__ = ('version', 'stack_name', 'region', 'role_arn',
+                 'parameters', 'message_id', 'attempt')
+
+    def __init__(self, message, message_id=None, attempt=0, validate=True):
+        if validate:
+            validate_message(message)
+        self.message_id = message_id
+        self.attempt = attempt
         self.version = message['version']
         self.stack_name = message['stackName']
         self.region = message['region']
-        self.update(message['parameters'])
+        self.role_arn = message.get('roleArn')
+        self.parameters = dict(message['parameters'])
+
+    def __repr__(self):
+        return 'StackUpdateParameter({0!r}, message_id={1!r})'.format(
+            self.to_message(), self.message_id)
+
+    def to_message(self):
+        """Return the update message this update was parsed from."""
+        message = {
+            'version': self.version,
+            'stackName': self.stack_name,
+            'region': self.region,
+            'parameters': dict(self.parameters)}
+        if self.role_arn is not None:
+            message['roleArn'] = self.role_arn
+        return message
+
+    def stack_key(self):
+        """Identify the stack, the same stack name can exist elsewhere."""
+        return self.stack_name, self.region, self.role_arn
+
+    def client_request_token(self):
+        """
+        Return the ClientRequestToken of the update, the same for every
+        delivery of its message. None if the message has no id.
+        """
+        if self.message_id is None:
+            return None
+        return CLIENT_REQUEST_TOKEN_PREFIX + hashlib.sha1(
+            self.message_id.encode('utf-8')).hexdigest()
+
+    def message_key(self):
+        """The dedupe key of the message this update was parsed from."""
+        return 'message:{0}'.format(self.message_id)
 
     def to_aws_format(self):
         return [
             {'ParameterKey': key, 'ParameterValue': value}
-            for key, value in self.items()]
+            for key, value in self.parameters.iteritems()]
 
     def merge(self, stack_parameters):
-        merged_stack_parameters = []
+        """
+        Merge the update into the current stack parameters.
+
+        Return the changed parameters with their new value, followed by
+        all other stack parameters in their original order, set to
+        UsePreviousValue. Update keys that are not stack parameters are
+        ignored.
+        """
+        # ParameterKey -> current value, the first one wins for duplicates
+        current_values = {}
+        for parameter in stack_parameters:
+            current_values.setdefault(
+                parameter.get('ParameterKey'), parameter.get('ParameterValue'))
 
-        for update_key in self:
-            update_value = self[update_key]
-            filtered_list = filter(
-                lambda x: x.get('ParameterKey') == update_key,
-                stack_parameters)
-            if not filtered_list:
+        merged_stack_parameters = []
+        changed_keys = set()
+        for update_key, update_value in self.parameters.iteritems():
+            if update_key not in current_values:
                 # No such parameter in stack parameters
                 continue
-            if filtered_list[0].get('ParameterValue') != update_value:
+            if current_values[update_key] != update_value:
                 merged_stack_parameters.append({
                     'ParameterKey': update_key,
                     'ParameterValue': update_value})
-                stack_parameters = filter(
-                    lambda x: x.get('ParameterKey') != update_key,
-                    stack_parameters)
+                changed_keys.add(update_key)
 
         # Turn all remaining key-values to UsePreviousValue = True
-        stack_parameters = map(
-            lambda x: {
-                'ParameterKey': x.get('ParameterKey'),
-                'UsePreviousValue': True},
-            stack_parameters)
-        merged_stack_parameters.extend(stack_parameters)
+        merged_stack_parameters.extend(
+            {'ParameterKey': parameter.get('ParameterKey'),
+             'UsePreviousValue': True}
+            for parameter in stack_parameters
+            if parameter.get('ParameterKey') not in changed_keys)
 
         return merged_stack_parameters
+
+    @staticmethod
+    def has_changes(merged_stack_parameters):
+        """
+        Tell whether merged parameters (see merge()) change any value of
+        the stack.
+        """
+        return any(
+            'ParameterValue' in parameter
+            for parameter in merged_stack_parameters)
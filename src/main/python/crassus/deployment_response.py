@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+# Start of the ClientRequestToken of the stack updates Crassus triggers
+CLIENT_REQUEST_TOKEN_PREFIX = 'crassus-'
+
 
 class DeploymentResponse(dict):
 
@@ -9,7 +12,11 @@ class DeploymentResponse(dict):
     transmitted as JSON encoded strings, used by Gaius.
 
     It is initialized with the following parameters:
-    - status: STATUS_FAILURE or STATUS_SUCCESS, if crassus emitted,
+    - status: STATUS_FAILURE, STATUS_SUCCESS, STATUS_NO_CHANGE (the
+      stack already has the requested values, no update was made) or
+      STATUS_SUPERSEDED (the update was merged into the one of the
+      message in 'supersededBy') or STATUS_DEFERRED (the stack was busy,
+      the update is retried after 'delaySeconds'), if crassus emitted,
       if cloudformation, then the respective CFN status
 
     - emitter: tells which direction the response comes from:
@@ -24,11 +31,18 @@ class DeploymentResponse(dict):
       self.version
 
     - message: the textual message for the notification.
+
+    Responses for failed AWS calls also have the 'errorClass' of the
+    error (see crassus.retry), and responses for calls that were retried
+    the number of 'awsAttempts'.
     """
 
     version = '1.1'
     STATUS_SUCCESS = 'success'
     STATUS_FAILURE = 'failure'
+    STATUS_NO_CHANGE = 'no_change'
+    STATUS_SUPERSEDED = 'superseded'
+    STATUS_DEFERRED = 'deferred'
 
     EMITTER_CRASSUS = 'crassus'
     EMITTER_CFN = 'cloudformation'
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per invocation timing of the phases of deploy and convert, and counts of
+the AWS calls made, emitted as CloudWatch Embedded Metric Format (EMF)
+log lines at the end of the invocation. CloudWatch extracts the metrics
+from the logs, no API call is made for them.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+METRICS_NAMESPACE = os.environ.get('CRASSUS_METRICS_NAMESPACE', 'Crassus')
+UNIT_MILLISECONDS = 'Milliseconds'
+UNIT_COUNT = 'Count'
+
+# Counters of the AWS calls, an API call counts once, every attempt of
+# crassus.retry.RetryPolicy beyond the first one of a call counts as a
+# retry (botocore itself does not retry)
+METRIC_AWS_CALLS = 'AwsCalls'
+METRIC_AWS_RETRIES = 'AwsRetries'
+
+# The metrics of the running invocation, None outside of an invocation
+_metrics = None
+# Whether the current thread is retrying a call, see counted_as_retry()
+_aws_retry = threading.local()
+
+
+class InvocationMetrics(object):
+
+    """
+    The durations of the phases of one invocation, in milliseconds per
+    call, and counters. Phases and counters can be recorded from
+    several threads.
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or {}
+        self.durations = OrderedDict()
+        self.counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add_duration(self, phase, milliseconds):
+        with self._lock:
+            self.durations.setdefault(phase, []).append(milliseconds)
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def to_emf(self, namespace=METRICS_NAMESPACE):
+        """Return the metrics as an EMF log entry."""
+        metric_definitions = [
+            {'Name': phase, 'Unit': UNIT_MILLISECONDS}
+            for phase in self.durations]
+        metric_definitions.extend(
+            {'Name': name, 'Unit': UNIT_COUNT} for name in self.counts)
+        emf_entry = {'_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [sorted(self.dimensions)],
+                'Metrics': metric_definitions}]}}
+        emf_entry.update(self.dimensions)
+        emf_entry.update(self.durations)
+        emf_entry.update(self.counts)
+        return emf_entry
+
+
+class EmfSink(object):
+
+    """Writes the metrics as an EMF log line to a stream, stdout."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def emit(self, metrics):
+        stream = self.stream or sys.stdout
+        stream.write(json.dumps(metrics.to_emf()) + '\n')
+        stream.flush()
+
+
+class MemorySink(object):
+
+    """Keeps the metrics of every invocation, for tests."""
+
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, metrics):
+        self.emitted.append(metrics)
+
+
+_sink = EmfSink()
+
+
+def set_metrics_sink(sink):
+    """Set where flush_metrics() emits to, None to drop the metrics."""
+    global _sink
+    _sink = sink
+
+
+def start_invocation_metrics(context):
+    """
+    Start collecting the metrics of an invocation, with the function
+    name of the Lambda context as dimension.
+    """
+    global _metrics
+    function_name = getattr(context, 'function_name', None)
+    dimensions = {}
+    if isinstance(function_name, basestring):
+        dimensions['FunctionName'] = function_name
+    _metrics = InvocationMetrics(dimensions)
+    return _metrics
+
+
+def flush_metrics():
+    """Emit the metrics of the invocation to the sink and stop collecting."""
+    global _metrics
+    metrics, _metrics = _metrics, None
+    if metrics is not None and _sink is not None:
+        _sink.emit(metrics)
+    return metrics
+
+
+def increment_metric(name, count=1):
+    """Increment a counter of the running invocation, if there is one."""
+    metrics = _metrics
+    if metrics is not None:
+        metrics.increment(name, count)
+
+
+def timed(phase):
+    """
+    Decorator recording the duration of every call of the function as
+    the given phase of the running invocation.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return function(*args, **kwargs)
+            metrics = _metrics
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.add_duration(phase, (time.time() - start) * 1000)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def counted_as_retry():
+    """
+    Context manager for a retry of an AWS call, which the caller counts
+    as AwsRetries: the calls of the block are not counted as AwsCalls.
+    """
+    _aws_retry.active = True
+    try:
+        yield
+    finally:
+        _aws_retry.active = False
+
+
+def _count_aws_call(**kwargs):
+    # botocore makes the call on the calling thread
+    if _metrics is not None and not getattr(_aws_retry, 'active', False):
+        _metrics.increment(METRIC_AWS_CALLS)
+
+
+def instrument_client(client):
+    """
+    Count the calls of a boto3 client with a botocore event hook.
+    """
+    client.meta.events.register('before-call', _count_aws_call)
+    return client
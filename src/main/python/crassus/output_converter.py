@@ -1,13 +1,164 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import calendar
+import hashlib
 import json
+import re
+import threading
+import time
+from collections import OrderedDict
 
-from crassus.utils import get_lambda_config_property, sqs_send_message, logger
-from deployment_response import DeploymentResponse
+from crassus.dedupe import LruDedupeStore
+from crassus.deployment_response import (
+    CLIENT_REQUEST_TOKEN_PREFIX, DeploymentResponse)
+from crassus.metrics import timed
+from crassus.retry import RetryPolicy
+from crassus.tracking import get_pending_update_store
+from crassus.utils import (
+    SqsMessageBatch, get_client, get_lambda_config_property,
+    set_log_fields, sqs_send_message, start_invocation_logging, logger)
 
 PATTERN_KEYSPLITTER = '=\''
 PATTERN_LINESPLITTER = '\'\n'
+# Values that can be JSON: objects, arrays, strings, numbers, true, false,
+# null, NaN and Infinity, possibly after JSON whitespace
+PATTERN_JSON_START = re.compile(r'[ \t\n\r]*[-{\["0-9tfnNI]')
+
+# Fields of a CloudFormation notification convert() always needs
+REQUIRED_FIELDS = (
+    'ResourceStatus', 'ResourceStatusReason', 'StackName', 'Timestamp',
+    'ResourceType')
+
+# Fields convert() forwards if the notification has them
+OPTIONAL_FIELDS = ('ClientRequestToken',)
+
+# Fields needed to correlate events with Crassus updates
+TRACKING_FIELDS = ('StackId', 'PhysicalResourceId')
+
+RESOURCE_TYPE_STACK = 'AWS::CloudFormation::Stack'
+STATUS_UPDATE_COMPLETE = 'UPDATE_COMPLETE'
+STATUS_UPDATE_IN_PROGRESS = 'UPDATE_IN_PROGRESS'
+# Pages of stack events searched for the start of an update, newest first
+MAX_STACK_EVENT_PAGES = 5
+MESSAGE_SUMMARY = '{count} resource events: {status_counts}'
+MESSAGE_COMPLETED = ('Update of stack {stack_name} ended with status '
+                     '{status} after {duration} seconds.')
+MESSAGE_ENDED = 'Update of stack {stack_name} ended with status {status}.'
+
+# Which events convert() forwards, set with the cfn_event_mode property
+# of the Lambda description:
+# - all: every event
+# - stack: only events of AWS::CloudFormation::Stack resources
+# - terminal: only events with a *_COMPLETE or *_FAILED status
+# - summary: stack events, resource events rolled up into one summary per
+#   stack across invocations, see OutputConverter._summarize()
+# - completion: no events, only the final responses of Crassus updates
+# The final responses of Crassus updates are sent in every mode.
+EVENT_MODE_ALL = 'all'
+EVENT_MODE_STACK = 'stack'
+EVENT_MODE_TERMINAL = 'terminal'
+EVENT_MODE_SUMMARY = 'summary'
+EVENT_MODE_COMPLETION = 'completion'
+EVENT_MODES = (
+    EVENT_MODE_ALL, EVENT_MODE_STACK, EVENT_MODE_TERMINAL, EVENT_MODE_SUMMARY,
+    EVENT_MODE_COMPLETION)
+
+
+MESSAGE_MALFORMED_RECORD = 'Unable to convert record {key}: {error}'
+
+# Keys of the records this container converted and sent, so that a
+# retried invocation only processes the records that failed
+processed_records = LruDedupeStore()
+
+# Seconds for which the summary mode collects the resource events of a
+# stack, set with the summary_interval property of the Lambda description
+SUMMARY_INTERVAL = 60
+SUMMARY_KEY = 'summary:{stack_name}'
+
+# stack name -> PendingSummary of the resource events this container
+# collected across invocations in the summary mode
+_pending_summaries = OrderedDict()
+_pending_summaries_lock = threading.Lock()
+
+
+class ConversionError(Exception):
+
+    """
+    Raised by convert() if some records could not be sent and should be
+    retried. The report tells which records were processed, skipped and
+    failed.
+    """
+
+    def __init__(self, report):
+        super(ConversionError, self).__init__(
+            '{0} record(s) could not be sent'.format(len(report['failed'])))
+        self.report = report
+
+
+class PendingSummary(object):
+
+    """
+    The resource events of one stack that the summary mode collected and
+    whose summary was not sent yet.
+    """
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.count = 0
+        self.status_counts = {}
+        self.latest = None
+
+    def add(self, deployment_response):
+        self.count += 1
+        status = deployment_response['status']
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+        self.latest = deployment_response
+
+    def merge(self, older):
+        """Add the events of an older pending summary of the stack."""
+        self.start_time = min(self.start_time, older.start_time)
+        self.count += older.count
+        for status, count in older.status_counts.items():
+            self.status_counts[status] = (
+                self.status_counts.get(status, 0) + count)
+
+    def summary(self):
+        """
+        Return the summary DeploymentResponse, with the status and time of
+        the latest event.
+        """
+        summary = DeploymentResponse(
+            self.latest['status'],
+            MESSAGE_SUMMARY.format(
+                count=self.count,
+                status_counts=', '.join(
+                    '{0}={1}'.format(status, count)
+                    for status, count in sorted(
+                        self.status_counts.items()))),
+            self.latest['stackName'], self.latest['timestamp'],
+            DeploymentResponse.EMITTER_CFN)
+        summary['statusCounts'] = dict(self.status_counts)
+        summary.record_keys = [
+            SUMMARY_KEY.format(stack_name=self.latest['stackName'])]
+        summary.pending_summary = self
+        return summary
+
+
+def restore_summary(pending_summary):
+    """Collect the events of a summary that could not be sent again."""
+    stack_name = pending_summary.latest['stackName']
+    with _pending_summaries_lock:
+        newer = _pending_summaries.get(stack_name)
+        if newer is None:
+            _pending_summaries[stack_name] = pending_summary
+        else:
+            newer.merge(pending_summary)
+
+
+def is_terminal_status(status):
+    """Tell whether a CloudFormation status ends an operation."""
+    return status.endswith('_COMPLETE') or status.endswith('_FAILED')
 
 
 class OutputConverter(object):
@@ -24,14 +175,22 @@ class OutputConverter(object):
         super(OutputConverter, self).__init__()
         self.event = event
         self.context = context
+        start_invocation_logging(context)
+        self._extra_fields = None
+        self._event_mode = None
+        self._tracking_store = None
+        self.retry_policy = RetryPolicy.for_context(context)
 
     def _cast_type(self, value):
         """
         Try to JSON cast the value. It can be parsed this way to dict,
         list or integers.
 
-        Return the string value, if nothing else succeeds.
+        Return the string value, if nothing else succeeds. Values which
+        cannot start a JSON document are returned without trying.
         """
+        if not PATTERN_JSON_START.match(value):
+            return value
         try:
             # Try to cast to integer, or JSON
             value = json.loads(value)
@@ -39,36 +198,320 @@ class OutputConverter(object):
         except ValueError:
             return value
 
-    def _parse_sns_message(self, sns_message):
+    def _iter_sns_message(self, sns_message):
         """
-        Parse the received SNS message from cloudformation.
+        Yield the key and the raw value of every line of the received SNS
+        message from cloudformation, in a single pass over the message.
 
         Beware: the lines are terminated with "'\n", so they must be
         split up along this pattern. There can be deviations sometimes,
         hence the workaround.
+        """
+        position = 0
+        while True:
+            end = sns_message.find(PATTERN_LINESPLITTER, position)
+            if end == -1:
+                line_item = sns_message[position:]
+                # Workaround for when the last parameter is not terminated
+                # with the same separator pattern, then a closing quote
+                # might remain.
+                if line_item.endswith('\''):
+                    line_item = line_item[:-1]
+            else:
+                line_item = sns_message[position:end]
+            line_item = line_item.strip()
+            separator = line_item.find(PATTERN_KEYSPLITTER)
+            # Lines without separator are unparseable, do not parse
+            if separator != -1:
+                yield (line_item[:separator],
+                       line_item[separator + len(PATTERN_KEYSPLITTER):])
+            if end == -1:
+                return
+            position = end + len(PATTERN_LINESPLITTER)
+
+    def _parse_sns_message(self, sns_message, fields=None):
+        """
+        Parse the received SNS message from cloudformation.
 
         Returns the parsed key-value pairs as a dictionary, while trying
-        to JSON sanitize the values.
-        """
-        splitted_list = sns_message.split(PATTERN_LINESPLITTER)
-        # Workaround for when the last parameter is not terminated with
-        # the same separator pattern, then a closing quote might remain.
-        if splitted_list[-1] != '' and splitted_list[-1][-1] == '\'':
-            # Cut the last character from the last item
-            splitted_list[-1] = splitted_list[-1][:-1]
+        to JSON sanitize the values. If fields are given, only these are
+        parsed and the parsing stops as soon as all of them were found,
+        other values are neither decoded nor kept.
+        """
         result_dict = {}
-        for line_item in splitted_list:
-            line_item = line_item.strip()
-            if PATTERN_KEYSPLITTER not in line_item:
-                # Unparseable line, do not parse
-                continue
-            key, value = line_item.split(PATTERN_KEYSPLITTER, 1)
-            result_dict[key] = self._cast_type(value)
+        if fields is None:
+            for key, value in self._iter_sns_message(sns_message):
+                result_dict[key] = self._cast_type(value)
+            return result_dict
+        missing_fields = set(fields)
+        for key, value in self._iter_sns_message(sns_message):
+            if key in missing_fields:
+                result_dict[key] = self._cast_type(value)
+                missing_fields.remove(key)
+                if not missing_fields:
+                    break
         return result_dict
 
+    @property
+    def extra_fields(self):
+        """
+        Additional notification fields to forward, configured with the
+        cfn_extra_fields property of the Lambda description.
+        """
+        if self._extra_fields is None:
+            self._extra_fields = get_lambda_config_property(
+                self.context, 'cfn_extra_fields', [])
+        return self._extra_fields
+
+    @property
+    def event_mode(self):
+        if self._event_mode is not None:
+            return self._event_mode
+        event_mode = get_lambda_config_property(
+            self.context, 'cfn_event_mode', EVENT_MODE_ALL)
+        if event_mode not in EVENT_MODES:
+            logger.warning(
+                'Unknown cfn_event_mode \'{0}\', forwarding all events.'
+                .format(event_mode))
+            event_mode = EVENT_MODE_ALL
+        self._event_mode = event_mode
+        return self._event_mode
+
+    def _select_responses(self, deployment_responses):
+        """
+        Return the DeploymentResponses to forward, according to the
+        event mode.
+        """
+        if self.event_mode == EVENT_MODE_STACK:
+            return [
+                deployment_response
+                for deployment_response in deployment_responses
+                if deployment_response['resourceType'] == RESOURCE_TYPE_STACK]
+        if self.event_mode == EVENT_MODE_TERMINAL:
+            return [
+                deployment_response
+                for deployment_response in deployment_responses
+                if is_terminal_status(deployment_response['status'])]
+        if self.event_mode == EVENT_MODE_SUMMARY:
+            return self._summarize(deployment_responses)
+        if self.event_mode == EVENT_MODE_COMPLETION:
+            return []
+        return deployment_responses
+
+    @property
+    def summary_interval(self):
+        """
+        Seconds for which the summary mode collects the resource events
+        of a stack, summary_interval property of the Lambda description.
+        """
+        return get_lambda_config_property(
+            self.context, 'summary_interval', SUMMARY_INTERVAL)
+
+    def _summarize(self, deployment_responses):
+        """
+        Roll the resource events up into one summary per stack. SNS
+        invokes the Lambda with one record at a time, so the events are
+        collected across the invocations of the container. The summary
+        of a stack is sent before the next event of the stack itself, or
+        by the first invocation after its oldest event is
+        summary_interval seconds old.
+
+        The events are container local state: a stack's events can be
+        summarized by several containers, and the counts a container
+        collected are lost when it is recycled before they were sent.
+        """
+        selected = []
+        now = time.time()
+        with _pending_summaries_lock:
+            for deployment_response in deployment_responses:
+                stack_name = deployment_response['stackName']
+                if deployment_response['resourceType'] != RESOURCE_TYPE_STACK:
+                    if stack_name not in _pending_summaries:
+                        _pending_summaries[stack_name] = PendingSummary(now)
+                    _pending_summaries[stack_name].add(deployment_response)
+                    continue
+                if stack_name in _pending_summaries:
+                    selected.append(
+                        _pending_summaries.pop(stack_name).summary())
+                selected.append(deployment_response)
+            for stack_name, pending_summary in list(
+                    _pending_summaries.items()):
+                if now - pending_summary.start_time >= self.summary_interval:
+                    selected.append(
+                        _pending_summaries.pop(stack_name).summary())
+        return selected
+
+    @staticmethod
+    def _record_key(event_item):
+        """
+        Return the idempotency key of a record, the SNS MessageId or a
+        hash of the message if it has none.
+        """
+        sns = event_item['Sns']
+        if sns.get('MessageId'):
+            return sns['MessageId']
+        return hashlib.sha1(sns['Message'].encode('utf-8')).hexdigest()
+
+    @property
+    def tracking_store(self):
+        """
+        The store of the updates the deployer tracks, for the
+        tracking_store property of the Lambda description. None if
+        updates are not tracked. Only a store on a file system that both
+        functions mount is shared with the deployer.
+        """
+        if self._tracking_store is not None:
+            return self._tracking_store
+        specification = get_lambda_config_property(
+            self.context, 'tracking_store', None)
+        if specification is not None:
+            self._tracking_store = get_pending_update_store(specification)
+        return self._tracking_store
+
+    def _completion_response(self, message):
+        """
+        Return the final DeploymentResponse of the Crassus update that
+        the event ends, None if it does not end one. The response has
+        the final stackStatus, the clientRequestToken that the success
+        response of the deployer also has, and the durationSeconds of
+        the update if its start is known.
+
+        The update is recognized by the ClientRequestToken of the event,
+        and its start is the UPDATE_IN_PROGRESS event of the stack with
+        the same token. If a tracking store is shared with the deployer,
+        its pending update also gives the requestMessageId.
+        """
+        status = message['ResourceStatus']
+        stack_id = message.get('StackId')
+        if (stack_id is None or
+                message['ResourceType'] != RESOURCE_TYPE_STACK or
+                message.get('PhysicalResourceId') != stack_id or
+                not is_terminal_status(status)):
+            return None
+        token = message.get('ClientRequestToken')
+        pending_update = None
+        if self.tracking_store is not None:
+            pending_update = self.tracking_store.get(stack_id)
+            if (pending_update is not None and token and
+                    pending_update.get('clientRequestToken') and
+                    token != pending_update['clientRequestToken']):
+                # The end of another operation on the stack
+                return None
+        if pending_update is not None:
+            start_time = pending_update['startTime']
+            token = pending_update.get('clientRequestToken') or token
+        elif token and token.startswith(CLIENT_REQUEST_TOKEN_PREFIX):
+            start_time = self._update_start_time(stack_id, token)
+        else:
+            return None
+        try:
+            from dateutil import parser
+            end_time = calendar.timegm(
+                parser.parse(message['Timestamp']).utctimetuple())
+        except ValueError:
+            end_time = time.time()
+        if start_time is None:
+            duration = None
+            completion_message = MESSAGE_ENDED.format(
+                stack_name=message['StackName'], status=status)
+        else:
+            duration = int(round(end_time - start_time))
+            completion_message = MESSAGE_COMPLETED.format(
+                stack_name=message['StackName'], status=status,
+                duration=duration)
+        completion_response = DeploymentResponse(
+            DeploymentResponse.STATUS_SUCCESS
+            if status == STATUS_UPDATE_COMPLETE
+            else DeploymentResponse.STATUS_FAILURE,
+            completion_message, message['StackName'], message['Timestamp'],
+            DeploymentResponse.EMITTER_CRASSUS)
+        completion_response['stackStatus'] = status
+        if duration is not None:
+            completion_response['durationSeconds'] = duration
+        if pending_update is not None:
+            completion_response['requestMessageId'] = pending_update[
+                'messageId']
+        if token:
+            completion_response['clientRequestToken'] = token
+        completion_response.stack_id = stack_id
+        completion_response.tracked = pending_update is not None
+        return completion_response
+
+    def _update_start_time(self, stack_id, token):
+        """
+        Return the time of the UPDATE_IN_PROGRESS event of the stack with
+        the ClientRequestToken, None if it is not among the latest events
+        or they cannot be read, e.g. for stacks of other accounts.
+        """
+        region = stack_id.split(':')[3]
+        describe_stack_events = get_client(
+            'cloudformation', region).describe_stack_events
+        kwargs = {'StackName': stack_id}
+        try:
+            for _ in range(MAX_STACK_EVENT_PAGES):
+                response = self.retry_policy.call(
+                    'cloudformation.DescribeStackEvents',
+                    describe_stack_events, **kwargs)
+                for stack_event in response['StackEvents']:
+                    if (stack_event.get('ClientRequestToken') == token and
+                            stack_event.get('PhysicalResourceId') ==
+                            stack_id and
+                            stack_event['ResourceStatus'] ==
+                            STATUS_UPDATE_IN_PROGRESS):
+                        return calendar.timegm(
+                            stack_event['Timestamp'].utctimetuple())
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+        except Exception as error:
+            logger.warning('Unable to read events of stack {0}: {1}'.format(
+                stack_id, error))
+        return None
+
+    def _to_deployment_response(self, message):
+        deployment_response = DeploymentResponse(
+            message['ResourceStatus'], message['ResourceStatusReason'],
+            message['StackName'], message['Timestamp'],
+            DeploymentResponse.EMITTER_CFN)
+        deployment_response['resourceType'] = message['ResourceType']
+        if message.get('ClientRequestToken'):
+            deployment_response['clientRequestToken'] = message[
+                'ClientRequestToken']
+        for field in self.extra_fields:
+            if field in message:
+                deployment_response[
+                    field[:1].lower() + field[1:]] = message[field]
+        return deployment_response
+
+    @timed('Convert')
     def convert(self):
+        """
+        Convert every record of the event and send the results to the
+        result queues in SQS batches.
+
+        Depending on the event mode, only some of the events, or
+        summaries of them, are sent. Only the needed fields of the
+        notifications are parsed. Extra fields are added to the
+        DeploymentResponse with a lower camel case key, e.g.
+        'logicalResourceId' for 'LogicalResourceId'. The
+        ClientRequestToken of the event, if any, is forwarded as
+        'clientRequestToken', to match the event with the update
+        message. The stack events that end an update Crassus triggered
+        also produce its final response.
+
+        A failing record does not stop the others. Records this
+        container already processed are skipped. Return a report with
+        the keys of the processed and skipped records, and the failed
+        ones with their error. Raise ConversionError with the report if
+        records could not be sent, so that the invocation is retried.
+        """
         queue_url_list = get_lambda_config_property(
             self.context, 'result_queue')
+        fields = REQUIRED_FIELDS + OPTIONAL_FIELDS + tuple(self.extra_fields)
+        fields += TRACKING_FIELDS
+        report = {'processed': [], 'skipped': [], 'failed': []}
+        deployment_responses = []
+        completion_responses = []
         for event_item in self.event['Records']:
             sns_message = event_item.get('Sns', {}).get('Message')
             if sns_message is None:
@@ -76,10 +519,79 @@ class OutputConverter(object):
                     'No \'Sns\' or \'Message\' in received event: {0}'
                     .format(event_item))
                 continue
-            message = self._parse_sns_message(sns_message)
-            deployment_response = DeploymentResponse(
-                message['ResourceStatus'], message['ResourceStatusReason'],
-                message['StackName'], message['Timestamp'],
-                DeploymentResponse.EMITTER_CFN)
-            deployment_response['resourceType'] = message['ResourceType']
-            sqs_send_message(queue_url_list, deployment_response)
+            record_key = self._record_key(event_item)
+            set_log_fields(messageId=record_key)
+            if record_key in processed_records:
+                report['skipped'].append(record_key)
+                continue
+            try:
+                message = self._parse_sns_message(sns_message, fields)
+                deployment_response = self._to_deployment_response(message)
+                completion_response = self._completion_response(message)
+            except (KeyError, ValueError, TypeError) as error:
+                if isinstance(error, KeyError):
+                    error_message = 'missing field {0}'.format(error)
+                else:
+                    error_message = 'malformed record: {0}'.format(error)
+                logger.error(MESSAGE_MALFORMED_RECORD.format(
+                    key=record_key, error=error_message))
+                report['failed'].append({
+                    'key': record_key, 'error': error_message,
+                    'retryable': False})
+                # Retrying a malformed record does not help
+                processed_records.add(record_key)
+                continue
+            except Exception as error:
+                # E.g. the tracking store is not available, the record is
+                # converted again when the invocation is retried
+                logger.error(MESSAGE_MALFORMED_RECORD.format(
+                    key=record_key, error=error))
+                report['failed'].append({
+                    'key': record_key, 'error': str(error),
+                    'retryable': True})
+                continue
+            deployment_response.record_keys = [record_key]
+            deployment_responses.append(deployment_response)
+            if completion_response is not None:
+                completion_response.record_keys = [record_key]
+                completion_responses.append(completion_response)
+
+        batch = SqsMessageBatch(self.retry_policy)
+        selected = self._select_responses(deployment_responses)
+        for deployment_response in selected + completion_responses:
+            sqs_send_message(
+                queue_url_list, deployment_response, batch=batch,
+                key=tuple(deployment_response.record_keys))
+        failed_keys = set(
+            record_key for record_keys in batch.flush()
+            for record_key in record_keys)
+        for deployment_response in selected:
+            pending_summary = getattr(
+                deployment_response, 'pending_summary', None)
+            if (pending_summary is not None and
+                    deployment_response.record_keys[0] in failed_keys):
+                # Sent with a later invocation
+                restore_summary(pending_summary)
+        for completion_response in completion_responses:
+            if (completion_response.tracked and
+                    completion_response.record_keys[0] not in failed_keys):
+                # The update is no longer pending once its end is sent
+                try:
+                    self.tracking_store.remove(completion_response.stack_id)
+                except Exception as error:
+                    logger.error(
+                        'Unable to remove pending update of {0}: {1}'
+                        .format(completion_response.stack_id, error))
+
+        for deployment_response in deployment_responses:
+            record_key = deployment_response.record_keys[0]
+            if record_key in failed_keys:
+                report['failed'].append({
+                    'key': record_key, 'error': 'could not be sent',
+                    'retryable': True})
+            else:
+                processed_records.add(record_key)
+                report['processed'].append(record_key)
+        if any(failure['retryable'] for failure in report['failed']):
+            raise ConversionError(report)
+        return report
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+"""
+Retries and client side rate limits for the CloudFormation, Lambda and
+SQS calls of crassus.
+
+Errors are classified as throttling, transient, validation, not found
+or other. Only throttling and transient errors are retried, with
+decorrelated jitter backoff, and only as long as the time budget of the
+invocation allows.
+
+Every API has a token bucket that is shared by the invocations of a warm
+container. It does not delay any call until the API throttled one: then
+its rate is halved with every throttled call and recovers slowly with
+successful calls, and once the rate is back at its limit the bucket
+stops pacing again. The buckets of different containers do not know of
+each other, they only keep one container from making the throttling
+worse.
+"""
+
+import random
+import threading
+import time
+
+from botocore.exceptions import (
+    ClientError, ConnectionError, EndpointConnectionError, ReadTimeoutError)
+from crassus.metrics import (
+    METRIC_AWS_RETRIES, counted_as_retry, increment_metric)
+
+ERROR_THROTTLING = 'throttling'
+ERROR_TRANSIENT = 'transient'
+ERROR_VALIDATION = 'validation'
+ERROR_NOT_FOUND = 'not_found'
+ERROR_OTHER = 'other'
+RETRYABLE_ERRORS = (ERROR_THROTTLING, ERROR_TRANSIENT)
+
+THROTTLING_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottled', 'RequestThrottledException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'SlowDown',
+    'AWS.SimpleQueueService.RequestThrottled'])
+TRANSIENT_CODES = frozenset([
+    'InternalFailure', 'InternalError', 'InternalServiceError',
+    'ServiceUnavailable', 'ServiceUnavailableException', 'RequestTimeout',
+    'RequestTimeoutException', 'ServiceException',
+    'AWS.SimpleQueueService.InternalError'])
+NOT_FOUND_CODES = frozenset([
+    'ResourceNotFoundException', 'NotFound', 'NoSuchEntity',
+    'AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist'])
+VALIDATION_CODES = frozenset([
+    'ValidationError', 'ValidationException', 'InvalidParameterValue',
+    'InvalidParameterValueException', 'InvalidParameterCombination',
+    'MissingParameter', 'InsufficientCapabilitiesException',
+    'InvalidRequestContentException'])
+
+# Decorrelated jitter: the delay before a retry is drawn between the
+# base and three times the previous delay, capped
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 5.0
+RETRY_MAX_ATTEMPTS = 5
+# Seconds of the invocation kept for sending the responses, retries stop
+# before
+RETRY_TIME_RESERVE = 5.0
+
+# Calls per second and burst size of the token buckets of a container
+# once the API throttled, by API, e.g. 'cloudformation.UpdateStack'
+DEFAULT_RATE_LIMIT = (10.0, 10)
+RATE_LIMITS = {
+    'cloudformation.DescribeStacks': (5.0, 10),
+    'cloudformation.UpdateStack': (2.0, 5),
+    'lambda.GetFunctionConfiguration': (10.0, 10),
+    'sqs.SendMessage': (50.0, 50),
+    'sqs.SendMessageBatch': (50.0, 50),
+}
+# The rate of a bucket is not lowered below this share of its limit
+MIN_RATE_FACTOR = 0.1
+# Calls per second a bucket regains with every successful call
+RATE_RECOVERY = 0.1
+
+METRIC_AWS_THROTTLES = 'AwsThrottles'
+
+# API -> TokenBucket, kept for the warm container
+_buckets = {}
+_buckets_lock = threading.Lock()
+# botocore Config of the clients, created with the first client
+_client_config = None
+
+
+def client_config():
+    """
+    Return the configuration of the boto3 clients of crassus: botocore
+    does not retry on its own, RetryPolicy retries within the limits
+    above.
+    """
+    global _client_config
+    if _client_config is None:
+        # Imported here, botocore.config is slow to import and only
+        # needed with the first client
+        from botocore.config import Config
+        _client_config = Config(retries={'max_attempts': 0})
+    return _client_config
+
+
+def classify_error(error):
+    """
+    Return the class of an error of a boto3 call. Errors of crassus can
+    give their class in an error_class attribute.
+    """
+    error_class = getattr(error, 'error_class', None)
+    if error_class is not None:
+        return error_class
+    if isinstance(error, (EndpointConnectionError, ConnectionError,
+                          ReadTimeoutError)):
+        return ERROR_TRANSIENT
+    if not isinstance(error, ClientError):
+        return ERROR_OTHER
+    details = error.response.get('Error', {})
+    code = details.get('Code', '')
+    if code in THROTTLING_CODES:
+        return ERROR_THROTTLING
+    if code in TRANSIENT_CODES:
+        return ERROR_TRANSIENT
+    if code in NOT_FOUND_CODES:
+        return ERROR_NOT_FOUND
+    if code in VALIDATION_CODES:
+        # CloudFormation reports a missing stack as validation error
+        if 'does not exist' in details.get('Message', ''):
+            return ERROR_NOT_FOUND
+        return ERROR_VALIDATION
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    if isinstance(status, int) and status >= 500:
+        return ERROR_TRANSIENT
+    return ERROR_OTHER
+
+
+def decorrelated_jitter(previous_delay, base=RETRY_BASE_DELAY,
+                        cap=RETRY_MAX_DELAY):
+    """Return the delay in seconds before the next retry."""
+    return min(cap, random.uniform(base, max(base, previous_delay * 3)))
+
+
+def deadline_from_context(context, reserve=RETRY_TIME_RESERVE):
+    """
+    Return the time until which calls may be retried in the invocation
+    of the Lambda context, None if the context does not tell.
+    """
+    get_remaining_time = getattr(
+        context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is None:
+        return None
+    remaining = get_remaining_time()
+    if isinstance(remaining, bool) or not isinstance(
+            remaining, (int, long, float)):
+        return None
+    return time.time() + remaining / 1000.0 - reserve
+
+
+class TokenBucket(object):
+
+    """
+    Client side rate limit of an API, rate tokens per second up to
+    capacity. The bucket is only active after the API throttled a call,
+    until the rate recovered to its limit.
+    """
+
+    def __init__(self, rate, capacity):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.active = False
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, max_wait=None):
+        """
+        Take a token, return the seconds to wait before the call, at most
+        max_wait. The token is taken even if the wait is cut, a call
+        over the limit is left to the service to throttle. An inactive
+        bucket never waits.
+        """
+        if not self.active:
+            return 0.0
+        with self._lock:
+            self._refill(time.time())
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if max_wait is not None:
+            wait = min(wait, max(0.0, max_wait))
+        return wait
+
+    def throttled(self):
+        """
+        Halve the rate after the API throttled a call, activating the
+        bucket without tokens.
+        """
+        with self._lock:
+            if not self.active:
+                self.active = True
+                self._tokens = 0.0
+                self._updated = time.time()
+            self.rate = max(self.max_rate * MIN_RATE_FACTOR, self.rate / 2)
+
+    def succeeded(self):
+        if not self.active:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_RECOVERY)
+            if self.rate >= self.max_rate:
+                self.active = False
+
+
+def get_token_bucket(api):
+    """Return the shared token bucket of an API."""
+    with _buckets_lock:
+        bucket = _buckets.get(api)
+        if bucket is None:
+            bucket = TokenBucket(*RATE_LIMITS.get(api, DEFAULT_RATE_LIMIT))
+            _buckets[api] = bucket
+        return bucket
+
+
+class RetryPolicy(object):
+
+    """
+    Makes the AWS calls of an invocation, with retries until deadline
+    (None for no time limit) and at most max_attempts attempts.
+
+    The number of attempts of the last successful call of the current
+    thread is kept in last_attempts, an error raised by call() has them
+    in its aws_attempts attribute.
+    """
+
+    def __init__(self, deadline=None, max_attempts=RETRY_MAX_ATTEMPTS,
+                 sleep=None):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.sleep = sleep or time.sleep
+        self._local = threading.local()
+
+    @classmethod
+    def for_context(cls, context):
+        """Return a policy with the time budget of the Lambda context."""
+        return cls(deadline_from_context(context))
+
+    @property
+    def last_attempts(self):
+        return getattr(self._local, 'attempts', 0)
+
+    def _remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def call(self, api, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) for the API, e.g.
+        'cloudformation.UpdateStack', within its rate limit. Throttling
+        and transient errors are retried while attempts and time are
+        left, any other error and the last one are raised. Every attempt
+        after the first one counts as AwsRetries, not as AwsCalls.
+        """
+        bucket = get_token_bucket(api)
+        delay = RETRY_BASE_DELAY
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = bucket.acquire(self._remaining())
+            if wait > 0:
+                self.sleep(wait)
+            try:
+                if attempt == 1:
+                    result = function(*args, **kwargs)
+                else:
+                    increment_metric(METRIC_AWS_RETRIES)
+                    with counted_as_retry():
+                        result = function(*args, **kwargs)
+            except Exception as error:
+                error.aws_attempts = attempt
+                error_class = classify_error(error)
+                if error_class == ERROR_THROTTLING:
+                    bucket.throttled()
+                    increment_metric(METRIC_AWS_THROTTLES)
+                if (error_class not in RETRYABLE_ERRORS or
+                        attempt >= self.max_attempts):
+                    raise
+                delay = decorrelated_jitter(delay)
+                remaining = self._remaining()
+                if remaining is not None and delay >= remaining:
+                    raise
+                self.sleep(delay)
+                continue
+            bucket.succeeded()
+            self._local.attempts = attempt
+            return result
+
+
+def outcome_fields(error=None, attempts=1):
+    """
+    Return the fields of a DeploymentResponse for the outcome of a call:
+    the errorClass of the error it failed with, if any, and its
+    awsAttempts if there was more than one.
+    """
+    fields = {}
+    if error is not None:
+        fields['errorClass'] = classify_error(error)
+        attempts = getattr(error, 'aws_attempts', 1)
+    if attempts > 1:
+        fields['awsAttempts'] = attempts
+    return fields
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stores for the stack updates Crassus triggered and whose outcome is not
+known yet, to correlate CloudFormation events with the update messages.
+
+The deployer and the output converter are separate Lambda functions, so
+only an SQLite file on a file system that both of them mount is shared.
+Without a shared store, the output converter still sends the final
+responses, correlated by the ClientRequestToken of the update.
+"""
+
+import threading
+
+STORE_MEMORY = 'memory'
+STORE_SQLITE_PREFIX = 'sqlite:'
+
+# Store specification -> store, kept for the warm container
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class MemoryPendingUpdateStore(object):
+
+    """
+    In-process store of pending updates, only useful if the deployer and
+    the output converter run in the same process, e.g. in tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # stack id -> pending update
+        self._updates = {}
+
+    def put(self, pending_update):
+        """
+        Record a pending update, a dict with the stackId, stackName,
+        messageId, clientRequestToken and startTime of the update.
+        """
+        with self._lock:
+            self._updates[pending_update['stackId']] = dict(pending_update)
+
+    def get(self, stack_id):
+        """Return the pending update of a stack, None if there is none."""
+        with self._lock:
+            return self._updates.get(stack_id)
+
+    def remove(self, stack_id):
+        with self._lock:
+            self._updates.pop(stack_id, None)
+
+
+class SqlitePendingUpdateStore(object):
+
+    """
+    Store of pending updates in an SQLite database file, which the
+    deployer and the output converter can share on a file system.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Imported here, so that the memory store does not load sqlite3
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending_updates '
+                '(stack_id TEXT PRIMARY KEY, stack_name TEXT, '
+                'message_id TEXT, client_request_token TEXT, '
+                'start_time REAL NOT NULL)')
+            columns = [
+                row[1] for row in self._connection.execute(
+                    'PRAGMA table_info(pending_updates)')]
+            if 'client_request_token' not in columns:
+                # Tables created before the column existed
+                self._connection.execute(
+                    'ALTER TABLE pending_updates '
+                    'ADD COLUMN client_request_token TEXT')
+
+    def put(self, pending_update):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO pending_updates '
+                '(stack_id, stack_name, message_id, client_request_token, '
+                'start_time) VALUES (?, ?, ?, ?, ?)', (
+                    pending_update['stackId'], pending_update['stackName'],
+                    pending_update['messageId'],
+                    pending_update.get('clientRequestToken'),
+                    pending_update['startTime']))
+
+    def get(self, stack_id):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT stack_id, stack_name, message_id, '
+                'client_request_token, start_time '
+                'FROM pending_updates WHERE stack_id = ?',
+                (stack_id,)).fetchone()
+        if row is None:
+            return None
+        return {'stackId': row[0], 'stackName': row[1],
+                'messageId': row[2], 'clientRequestToken': row[3],
+                'startTime': row[4]}
+
+    def remove(self, stack_id):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM pending_updates WHERE stack_id = ?',
+                (stack_id,))
+
+
+def get_pending_update_store(specification):
+    """
+    Return the shared pending update store for a specification, either
+    'memory' or 'sqlite:<path>'.
+    """
+    with _stores_lock:
+        if specification not in _stores:
+            if specification.startswith(STORE_SQLITE_PREFIX):
+                _stores[specification] = SqlitePendingUpdateStore(
+                    specification[len(STORE_SQLITE_PREFIX):])
+            elif specification == STORE_MEMORY:
+                _stores[specification] = MemoryPendingUpdateStore()
+            else:
+                raise ValueError(
+                    'Unknown tracking store \'{0}\''.format(specification))
+        return _stores[specification]
@@ -1,25 +1,81 @@
 # -*- coding: utf-8 -*-
 
+import calendar
 import json
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 
-import boto3
 from crassus.deployment_response import DeploymentResponse
+from crassus.metrics import instrument_client, timed
+from crassus.retry import ERROR_TRANSIENT, RetryPolicy, client_config
+from crassus.version import VERSION
 
 """Utility functions module."""
 
-aws_cf = boto3.client('cloudformation')
-aws_sqs = boto3.client('sqs')
-aws_lambda = boto3.client('lambda')
+# (service name, region name) -> boto3 client or resource. Kept for the
+# lifetime of the warm container, so that service models are only
+# loaded once and HTTP connection pools are reused.
+_clients = {}
+_resources = {}
+_clients_lock = threading.Lock()
+
+# role ARN -> (expiry time, boto3 session with the assumed role)
+_role_sessions = {}
+# (service name, region name, role ARN) -> (session, boto3 resource)
+_role_resources = {}
+
+# Seconds the credentials of an assumed role are requested for, and
+# seconds before their expiry after which the role is assumed again
+ROLE_SESSION_DURATION = 3600
+ROLE_SESSION_REFRESH_MARGIN = 300
+ROLE_SESSION_NAME = 'crassus'
+
+# Seconds a parsed Lambda description stays valid in a warm container
+LAMBDA_CONFIG_CACHE_TTL = float(
+    os.environ.get('CRASSUS_CONFIG_CACHE_TTL', 300))
+
+# (function ARN, qualifier) -> (fetch time, description, parsed JSON)
+_lambda_config_cache = {}
+lambda_config_cache_stats = {'hits': 0, 'misses': 0}
+
+_NO_DEFAULT = object()
+
+# Limits of a single SQS SendMessageBatch call
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+# Bounds for sending one message to several destinations concurrently
+FAN_OUT_MAX_WORKERS = 8
+FAN_OUT_TIMEOUT = 10
+
+# Logging is configured with environment variables of the Lambda:
+# CRASSUS_LOG_LEVEL is a level name, CRASSUS_LOG_FORMAT is 'text' or
+# 'json' for one JSON object per line with the correlation fields
+LOG_LEVEL = os.environ.get('CRASSUS_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('CRASSUS_LOG_FORMAT', 'text')
+LOG_FORMAT_JSON = 'json'
+# Characters of a value logged with log_summary()
+LOG_SUMMARY_LIMIT = 256
+
+# Correlation fields of the invocation, and of the update or record that
+# the current thread works on
+_log_fields = {}
+_thread_log_fields = threading.local()
 
 
 def _get_VERSION():
     """
-    Walk up the directory tree while trying to find a file named 'VERSION'.
+    Return the version embedded at build time.
 
-    If the file is found and readable, return its content, if not, return None.
+    In an unbuilt source tree, walk up the directory tree while trying to
+    find a file named 'VERSION'. If the file is found and readable, return
+    its content, if not, return 'NO_VERSION'.
     """
+    if not VERSION.startswith('$'):
+        return 'v{0}'.format(VERSION)
     actual_dir = os.path.dirname(os.path.realpath(__file__))
     while True:
         file_path = os.path.join(actual_dir, 'VERSION')
@@ -34,10 +90,332 @@ def _get_VERSION():
         actual_dir = os.path.dirname(actual_dir)
 
 
-def sqs_send_message(queue_url_list, message):
+def get_client(service_name, region_name=None):
+    """
+    Return the shared boto3 client for a service and region, creating it
+    on first use.
+    """
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        # Imported here to keep boto3 out of the import time of crassus
+        import boto3
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = instrument_client(boto3.client(
+                    service_name, region_name=region_name,
+                    config=client_config()))
+                _clients[key] = client
+    return client
+
+
+def get_resource(service_name, region_name=None, role_arn=None,
+                 retry_policy=None):
+    """
+    Return the shared boto3 resource for a service and region, creating
+    it on first use. With a role_arn, the resource uses the credentials
+    of that role, see get_role_session().
+    """
+    if role_arn is not None:
+        return _get_role_resource(
+            service_name, region_name, role_arn, retry_policy)
+    key = (service_name, region_name)
+    resource = _resources.get(key)
+    if resource is None:
+        import boto3
+        with _clients_lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = boto3.resource(
+                    service_name, region_name=region_name,
+                    config=client_config())
+                instrument_client(resource.meta.client)
+                _resources[key] = resource
+    return resource
+
+
+def _get_role_resource(service_name, region_name, role_arn, retry_policy):
+    session = get_role_session(role_arn, retry_policy)
+    key = (service_name, region_name, role_arn)
+    with _clients_lock:
+        cached = _role_resources.get(key)
+        if cached is None or cached[0] is not session:
+            # First use, or the session was refreshed meanwhile
+            cached = (session, session.resource(
+                service_name, region_name=region_name, config=client_config()))
+            instrument_client(cached[1].meta.client)
+            _role_resources[key] = cached
+    return cached[1]
+
+
+def get_role_session(role_arn, retry_policy=None):
+    """
+    Return a boto3 session with the credentials of the given role.
+
+    The role is assumed once, with the retries of the RetryPolicy of the
+    invocation, and the session reused until ROLE_SESSION_REFRESH_MARGIN
+    seconds before its credentials expire.
+    """
+    with _clients_lock:
+        cached = _role_sessions.get(role_arn)
+    if (cached is not None and
+            time.time() < cached[0] - ROLE_SESSION_REFRESH_MARGIN):
+        return cached[1]
+    import boto3
+    credentials = (retry_policy or RetryPolicy()).call(
+        'sts.AssumeRole', get_client('sts').assume_role,
+        RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME,
+        DurationSeconds=ROLE_SESSION_DURATION)['Credentials']
+    session = boto3.session.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'])
+    expiry_time = calendar.timegm(credentials['Expiration'].utctimetuple())
+    logger.debug('Assumed role %s until %s', role_arn,
+                 credentials['Expiration'])
+    with _clients_lock:
+        _role_sessions[role_arn] = (expiry_time, session)
+    return session
+
+
+def clear_clients():
+    """Forget all shared clients, resources and role sessions."""
+    with _clients_lock:
+        _clients.clear()
+        _resources.clear()
+        _role_sessions.clear()
+        _role_resources.clear()
+
+
+def fan_out(function, destinations, timeout=None):
+    """
+    Call function(destination) for every destination concurrently on a
+    bounded thread pool, waiting at most timeout seconds (default
+    FAN_OUT_TIMEOUT) for the destinations to finish.
+
+    Return an OrderedDict mapping each destination to None on success
+    or to the exception it failed with, so one slow or failing
+    destination does not hold up or break the others.
+    """
+    if timeout is None:
+        timeout = FAN_OUT_TIMEOUT
+    results = OrderedDict()
+    if not destinations:
+        return results
+    if len(destinations) == 1:
+        try:
+            function(destinations[0])
+            results[destinations[0]] = None
+        except Exception as error:
+            results[destinations[0]] = error
+        return results
+    # Imported here, only needed if there is more than one destination
+    from multiprocessing import TimeoutError
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(len(destinations), FAN_OUT_MAX_WORKERS))
+    try:
+        pending = [
+            (destination, pool.apply_async(function, (destination,)))
+            for destination in destinations]
+        deadline = time.time() + timeout
+        for destination, async_result in pending:
+            try:
+                async_result.get(max(0, deadline - time.time()))
+                results[destination] = None
+            except TimeoutError:
+                results[destination] = TimeoutError(
+                    'No result after {0} seconds'.format(timeout))
+            except Exception as error:
+                results[destination] = error
+    finally:
+        # Do not wait for destinations that timed out
+        pool.terminate()
+    return results
+
+
+class SqsEntriesFailed(Exception):
+
+    """
+    Raised while sending a batch if SQS failed some of its entries on
+    its side, so that the RetryPolicy sends them again.
+    """
+
+    error_class = ERROR_TRANSIENT
+
+    def __init__(self, failure):
+        super(SqsEntriesFailed, self).__init__(
+            'entries failed: {0}'.format(failure.get('Message')))
+
+
+class SqsMessageBatch(object):
+
+    """
+    Buffer for SQS messages, collected per queue and sent with
+    send_message_batch instead of one send_message call per message.
+
+    A queue buffer is sent as soon as it reaches SQS_MAX_BATCH_ENTRIES
+    messages or SQS_MAX_BATCH_BYTES payload, the rest when flush() is
+    called at the end of the invocation, to all queues concurrently.
+    Calls are retried with the RetryPolicy of the invocation, and entries
+    that failed on the SQS side are sent again within the same attempts,
+    the successful ones are not. Messages can be added from several
+    threads, full buffers are sent outside of the lock. A failed send
+    never raises, the keys of its messages are reported in failed_keys.
+    """
+
+    def __init__(self, retry_policy=None):
+        self._lock = threading.Lock()
+        # queue_url -> list of (entry id, message body, key)
+        self._buffers = OrderedDict()
+        self._buffer_sizes = {}
+        self._next_id = 0
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.closed = False
+        self.failed_keys = []
+        # queue_url -> exception of the last failed send to that queue
+        self.queue_errors = {}
+
+    def add(self, queue_url_list, message_str, key=None):
+        """
+        Queue a message body for every queue in queue_url_list. The key
+        is reported in failed_keys if sending to any queue failed.
+        """
+        size = len(message_str.encode('utf-8'))
+        with self._lock:
+            if self.closed:
+                logger.error(
+                    'Message not sent, the batch was already closed: {0}'
+                    .format(log_summary(message_str)))
+                if key is not None and key not in self.failed_keys:
+                    self.failed_keys.append(key)
+                return
+            full_buffers = self._add(queue_url_list, message_str, key, size)
+        for queue_url, entries in full_buffers:
+            self._send_or_fail(queue_url, entries)
+
+    def _add(self, queue_url_list, message_str, key, size):
+        """
+        Buffer the message, return the (queue_url, entries) buffers that
+        are full and have to be sent.
+        """
+        full_buffers = []
+        for queue_url in queue_url_list:
+            buffered = self._buffers.setdefault(queue_url, [])
+            if buffered and (
+                    len(buffered) >= SQS_MAX_BATCH_ENTRIES or
+                    self._buffer_sizes[queue_url] + size >
+                    SQS_MAX_BATCH_BYTES):
+                full_buffers.append((queue_url, self._pop(queue_url)))
+                buffered = self._buffers.setdefault(queue_url, [])
+            buffered.append((str(self._next_id), message_str, key))
+            self._buffer_sizes[queue_url] = \
+                self._buffer_sizes.get(queue_url, 0) + size
+            self._next_id += 1
+        return full_buffers
+
+    def _send_or_fail(self, queue_url, entries):
+        try:
+            self._send(queue_url, entries)
+        except Exception as error:
+            self._fail(queue_url, entries, error)
+
+    @timed('SqsFlush')
+    def flush(self):
+        """
+        Send all buffered messages.
+
+        Return the keys of the messages that could not be sent.
+        """
+        pending = OrderedDict(
+            (queue_url, self._pop(queue_url))
+            for queue_url in list(self._buffers))
+        results = fan_out(
+            lambda queue_url: self._send(queue_url, pending[queue_url]),
+            list(pending))
+        for queue_url, error in results.items():
+            if error is not None:
+                self._fail(queue_url, pending[queue_url], error)
+        return self.failed_keys
+
+    def close(self):
+        """
+        Send all buffered messages, like flush(), and refuse messages
+        added later, e.g. by workers that are still running after the
+        end of the invocation.
+        """
+        with self._lock:
+            self.closed = True
+        return self.flush()
+
+    def _pop(self, queue_url):
+        self._buffer_sizes.pop(queue_url, None)
+        return self._buffers.pop(queue_url, [])
+
+    def _fail(self, queue_url, entries, error):
+        logger.error('Unable to send {0} message(s) to {1}: {2}'.format(
+            len(entries), queue_url, error))
+        self.queue_errors[queue_url] = error
+        for _, _, key in entries:
+            self._fail_key(key)
+
+    def _fail_key(self, key):
+        if key is not None and key not in self.failed_keys:
+            self.failed_keys.append(key)
+
+    def _send(self, queue_url, entries):
+        """
+        Send the entries with one retry policy for the whole queue
+        buffer: every attempt sends the entries that are still pending,
+        a failed call or entries that failed on the SQS side without a
+        sender fault are retried. The entries left after the last
+        attempt are failed.
+        """
+        aws_sqs = get_client('sqs')
+        pending = list(entries)
+
+        def send_pending():
+            response = aws_sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {'Id': entry_id, 'MessageBody': body, 'DelaySeconds': 0}
+                    for entry_id, body, _ in pending])
+            failures = dict(
+                (failure['Id'], failure)
+                for failure in response.get('Failed', []))
+            retry_entries = []
+            for entry in pending:
+                failure = failures.get(entry[0])
+                if failure is None:
+                    continue
+                if not failure.get('SenderFault'):
+                    retry_entries.append(entry)
+                    continue
+                logger.error('Unable to send message to {0}: {1}'.format(
+                    queue_url, failure.get('Message')))
+                self._fail_key(entry[2])
+            pending[:] = retry_entries
+            if pending:
+                raise SqsEntriesFailed(failures[pending[0][0]])
+
+        try:
+            self.retry_policy.call('sqs.SendMessageBatch', send_pending)
+        except Exception as error:
+            self._fail(queue_url, pending, error)
+
+
+@timed('SqsSendMessage')
+def sqs_send_message(queue_url_list, message, batch=None, key=None,
+                     retry_policy=None):
     """
     Send an message to a given SQS queue. The function is not foolproof,
     you should have the rights to transmit to the SQS queue.
+
+    If a SqsMessageBatch is given, the message is only buffered there
+    and sent when the batch is flushed, the key is reported by the
+    batch if the message could not be sent. Otherwise it is sent to all
+    queues concurrently, with the retries of retry_policy, and the per
+    queue outcome of fan_out() is returned.
     """
     if type(message) is not DeploymentResponse:
         logger.error(
@@ -45,41 +423,165 @@ def sqs_send_message(queue_url_list, message):
             .format(type(message), repr(message)))
         return
     message_str = json.dumps(message)
-    for queue_url in queue_url_list:
-        aws_sqs.send_message(
-            QueueUrl=queue_url, MessageBody=message_str, DelaySeconds=0)
+    if batch is not None:
+        batch.add(queue_url_list, message_str, key)
+        return
+    aws_sqs = get_client('sqs')
+    retry_policy = retry_policy or RetryPolicy()
+    results = fan_out(
+        lambda queue_url: retry_policy.call(
+            'sqs.SendMessage', aws_sqs.send_message,
+            QueueUrl=queue_url, MessageBody=message_str, DelaySeconds=0),
+        list(queue_url_list))
+    for queue_url, error in results.items():
+        if error is not None:
+            logger.error('Unable to send message to {0}: {1}'.format(
+                queue_url, error))
+    return results
 
 
-def get_lambda_config_property(context, property_name):
+def invalidate_lambda_config_cache():
+    """Drop all cached Lambda descriptions, e.g. after a config change."""
+    _lambda_config_cache.clear()
+
+
+def _get_lambda_config(context):
     """
-    Extract JSON properties from the JSON encoded description.
+    Return the description of the invoked function and its parsed JSON
+    content (None if it is not valid JSON).
 
-    Return the value for the property, None if not found.
+    The result is cached per function ARN and qualifier for
+    LAMBDA_CONFIG_CACHE_TTL seconds.
     """
-    function_arn = context.invoked_function_arn
-    qualifier = context.function_version
-    description = aws_lambda.get_function_configuration(
-        FunctionName=function_arn,
-        Qualifier=qualifier
+    key = (context.invoked_function_arn, context.function_version)
+    now = time.time()
+    cached = _lambda_config_cache.get(key)
+    if cached is not None and now - cached[0] < LAMBDA_CONFIG_CACHE_TTL:
+        lambda_config_cache_stats['hits'] += 1
+        return cached[1], cached[2]
+    lambda_config_cache_stats['misses'] += 1
+    description = RetryPolicy.for_context(context).call(
+        'lambda.GetFunctionConfiguration',
+        get_client('lambda').get_function_configuration,
+        FunctionName=key[0],
+        Qualifier=key[1]
     )['Description']
     try:
         data = json.loads(description)
-        return_value = data[property_name]
-        logger.debug('Extracted {0} property: %{1}'.format(
-            property_name, repr(return_value)))
-        return return_value
     except ValueError:
+        data = None
+    _lambda_config_cache[key] = (now, description, data)
+    return description, data
+
+
+@timed('ConfigLookup')
+def get_lambda_config_property(context, property_name, default=_NO_DEFAULT):
+    """
+    Extract JSON properties from the JSON encoded description.
+
+    Return the value for the property, None if not found. If a default
+    is given, it is returned silently for a missing property.
+    """
+    description, data = _get_lambda_config(context)
+    if data is None:
         logger.error(
             'Description of function must contain JSON, but was "{0}"'
             .format(description))
+        return None if default is _NO_DEFAULT else default
+    try:
+        return_value = data[property_name]
+        logger.debug('Extracted %s property: %s', property_name,
+                     log_summary(return_value))
+        return return_value
     except KeyError:
+        if default is not _NO_DEFAULT:
+            return default
         logger.error(
             'Unable to find \'{0}\' property in the JSON description.'
             .format(property_name))
 
+
+class LogSummary(object):
+
+    """
+    Wraps a value to log, its repr is only built if the record is
+    emitted and is cut to limit characters.
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = LOG_SUMMARY_LIMIT if limit is None else limit
+
+    def __str__(self):
+        text = repr(self.value)
+        if len(text) <= self.limit:
+            return text
+        return '{0}... ({1} chars)'.format(text[:self.limit], len(text))
+
+    __repr__ = __str__
+
+
+def log_summary(value, limit=None):
+    """Return value wrapped for size capped, lazy logging."""
+    return LogSummary(value, limit)
+
+
+def start_invocation_logging(context):
+    """
+    Reset the correlation fields of the log records for a new invocation,
+    with the request id of the Lambda context.
+    """
+    _log_fields.clear()
+    _thread_log_fields.__dict__.clear()
+    request_id = getattr(context, 'aws_request_id', None)
+    if request_id is not None:
+        _log_fields['requestId'] = request_id
+
+
+def set_log_fields(**fields):
+    """
+    Set correlation fields, e.g. messageId and stackName, for the log
+    records of the current thread.
+    """
+    _thread_log_fields.__dict__.update(fields)
+
+
+class LogFieldsFilter(logging.Filter):
+
+    """Adds the correlation fields to every log record as log_fields."""
+
+    def filter(self, record):
+        log_fields = dict(_log_fields)
+        log_fields.update(_thread_log_fields.__dict__)
+        record.log_fields = log_fields
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+
+    """Formats log records as one JSON object per line."""
+
+    def format(self, record):
+        log_entry = {
+            'timestamp': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()}
+        log_entry.update(getattr(record, 'log_fields', {}))
+        if record.exc_info:
+            log_entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(log_entry, default=str)
+
+
 logger = logging.getLogger('crassus-{0}'.format(_get_VERSION()))
-logger.setLevel(logging.DEBUG)
+logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
 consoleLogger = logging.StreamHandler()
-consoleLogger.setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+if LOG_FORMAT == LOG_FORMAT_JSON:
+    consoleLogger.setFormatter(JsonLogFormatter())
+else:
+    consoleLogger.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+consoleLogger.addFilter(LogFieldsFilter())
 logger.addHandler(consoleLogger)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+"""
+Version of the crassus package. The placeholder is replaced with the
+project version by the filter_resources plugin at build time.
+"""
+
+VERSION = '${version}'
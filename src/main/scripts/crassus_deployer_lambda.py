@@ -1,11 +1,16 @@
 from __future__ import print_function
-from crassus import Crassus
-from crassus.output_converter import OutputConverter
 
 
 def handler(event, context):
-    crassus = Crassus(event, context)
-    crassus.deploy()
+    # Handlers import only what they need to keep the cold start short
+    from crassus.deployer import Crassus
+    from crassus.metrics import flush_metrics, start_invocation_metrics
+    start_invocation_metrics(context)
+    try:
+        crassus = Crassus(event, context)
+        crassus.deploy()
+    finally:
+        flush_metrics()
 
 
 def cfn_output_converter(event, context):
@@ -13,5 +18,11 @@ def cfn_output_converter(event, context):
     Convert an AWS CloudFormation output message to our defined
     ResultMessage format.
     """
-    output_converter = OutputConverter(event, context)
-    output_converter.convert()
+    from crassus.metrics import flush_metrics, start_invocation_metrics
+    from crassus.output_converter import OutputConverter
+    start_invocation_metrics(context)
+    try:
+        output_converter = OutputConverter(event, context)
+        return output_converter.convert()
+    finally:
+        flush_metrics()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from crassus.dedupe import (
+    LruDedupeStore, SqliteDedupeStore, _stores, get_dedupe_store)
+from mock import patch
+
+
+class TestLruDedupeStore(unittest.TestCase):
+
+    """
+    Tests for LruDedupeStore.
+    """
+
+    def test_contains_added_keys(self):
+        store = LruDedupeStore()
+        store.add('key1')
+        self.assertIn('key1', store)
+        self.assertNotIn('key2', store)
+
+    def test_drops_least_recently_added_key_when_full(self):
+        store = LruDedupeStore(max_size=2)
+        store.add('key1')
+        store.add('key2')
+        store.add('key1')
+        store.add('key3')
+        self.assertIn('key1', store)
+        self.assertNotIn('key2', store)
+        self.assertIn('key3', store)
+
+    @patch('crassus.dedupe.time')
+    def test_expires_keys_after_ttl(self, time_mock):
+        store = LruDedupeStore(ttl=60)
+        time_mock.time.return_value = 1000
+        store.add('key1')
+        time_mock.time.return_value = 1059
+        self.assertIn('key1', store)
+        time_mock.time.return_value = 1060
+        self.assertNotIn('key1', store)
+
+    def test_counts_hits_and_misses(self):
+        store = LruDedupeStore()
+        self.assertIsNone(store.hit_rate)
+        store.add('key1')
+        self.assertIn('key1', store)
+        self.assertNotIn('key2', store)
+        self.assertIn('key1', store)
+        self.assertEqual(store.stats, {'hits': 2, 'misses': 1})
+        self.assertAlmostEqual(store.hit_rate, 2.0 / 3)
+
+
+class TestSqliteDedupeStore(unittest.TestCase):
+
+    """
+    Tests for SqliteDedupeStore.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dedupe.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_keeps_keys_across_instances(self):
+        SqliteDedupeStore(self.path).add('key1')
+        store = SqliteDedupeStore(self.path)
+        self.assertIn('key1', store)
+        self.assertNotIn('key2', store)
+
+    @patch('crassus.dedupe.time')
+    def test_expires_keys_after_ttl(self, time_mock):
+        store = SqliteDedupeStore(self.path, ttl=60)
+        time_mock.time.return_value = 1000
+        store.add('key1')
+        time_mock.time.return_value = 1059
+        self.assertIn('key1', store)
+        time_mock.time.return_value = 1060
+        self.assertNotIn('key1', store)
+
+
+class TestGetDedupeStore(unittest.TestCase):
+
+    def tearDown(self):
+        _stores.clear()
+
+    def test_returns_shared_store(self):
+        store = get_dedupe_store('memory', 60)
+        self.assertIsInstance(store, LruDedupeStore)
+        self.assertEqual(store.ttl, 60)
+        self.assertIs(get_dedupe_store('memory', 60), store)
+
+    def test_returns_sqlite_store(self):
+        store = get_dedupe_store('sqlite::memory:')
+        self.assertIsInstance(store, SqliteDedupeStore)
+        self.assertEqual(store.path, ':memory:')
+
+    def test_rejects_unknown_store(self):
+        self.assertRaises(ValueError, get_dedupe_store, 'unknown')
@@ -0,0 +1,51 @@
+import unittest
+
+from crassus.delay_queue import (
+    LocalDelayQueue, SqsDelayQueue, backoff_delay)
+from mock import patch
+
+
+class TestBackoffDelay(unittest.TestCase):
+
+    """
+    Tests for backoff_delay().
+    """
+
+    def test_doubles_with_every_attempt(self):
+        self.assertEqual(
+            [backoff_delay(attempt) for attempt in range(1, 5)],
+            [30, 60, 120, 240])
+
+    def test_is_capped_at_sqs_maximum(self):
+        self.assertEqual(backoff_delay(10), 900)
+
+
+class TestSqsDelayQueue(unittest.TestCase):
+
+    """
+    Tests for SqsDelayQueue.
+    """
+
+    @patch('crassus.delay_queue.get_client')
+    def test_put_sends_delayed_message(self, get_client_mock):
+        SqsDelayQueue('ANY_QUEUE').put('message', 60)
+        get_client_mock.return_value.send_message.assert_called_once_with(
+            QueueUrl='ANY_QUEUE', MessageBody='message', DelaySeconds=60)
+
+
+class TestLocalDelayQueue(unittest.TestCase):
+
+    """
+    Tests for LocalDelayQueue.
+    """
+
+    @patch('crassus.delay_queue.time')
+    def test_pop_due_returns_only_due_messages(self, time_mock):
+        time_mock.time.return_value = 1000
+        queue = LocalDelayQueue()
+        queue.put('first', 30)
+        queue.put('second', 60)
+        self.assertEqual(queue.pop_due(1029), [])
+        self.assertEqual(queue.pop_due(1030), ['first'])
+        self.assertEqual(queue.pop_due(2000), ['second'])
+        self.assertEqual(queue.messages, [])
@@ -1,15 +1,28 @@
+import json
+import threading
+import time
 import unittest
 from textwrap import dedent
 
 from botocore.exceptions import ClientError
-from crassus.deployer import Crassus, StackUpdateParameter
+from crassus import retry
+from crassus.dedupe import _stores
+from crassus.delay_queue import LocalDelayQueue
+from crassus.deployer import (
+    Crassus, InvalidMessageError, StackUpdateParameter, _deferred_updates,
+    _recent_updates, validate_message)
 from crassus.deployment_response import DeploymentResponse
+from crassus.tracking import get_pending_update_store
+from crassus.utils import invalidate_lambda_config_cache
+from hypothesis import given
+from hypothesis import strategies as st
 from mock import ANY, Mock, call, patch
 
 PARAMETER = 'ANY_PARAMETER'
 ARN_ID = 'ANY_ARN'
 STACK_NAME = 'ANY_STACK'
 ANY_TOPIC = ['ANY_TOPIC']
+ROLE_ARN = 'arn:aws:iam::123456789012:role/crassus-target'
 
 CRASSUS_CFN_PARAMETERS = [
     {
@@ -38,10 +51,8 @@ SAMPLE_EVENT = {
                            '"stackName": "ANY_STACK", '
                            '"region": "eu-west-1", '
                            '"parameters": '
-                '[{"updateParameterKey": "ANY_NAME1", '
-                '"updateParameterValue": "ANY_VALUE1"}, '
-                '{"updateParameterKey": "ANY_NAME2", '
-                '"updateParameterValue": "ANY_VALUE2"}]}',
+                           '{"ANY_NAME1": "ANY_VALUE1", '
+                           '"ANY_NAME2": "ANY_VALUE2"}}',
                 'MessageAttributes': {
                 },
                 'Type': 'Notification',
@@ -54,17 +65,386 @@ SAMPLE_EVENT = {
 }
 
 
+def _sns_record(message_id, message):
+    return {
+        'EventSource': 'aws:sns',
+        'Sns': {
+            'MessageId': message_id,
+            'Message': json.dumps(message),
+            'Type': 'Notification',
+        }
+    }
+
+
+def _update_message(stack_name, value, key='ANY_NAME'):
+    return {
+        'version': '1',
+        'stackName': stack_name,
+        'region': 'eu-west-1',
+        'parameters': {key: value},
+    }
+
+
+BATCH_EVENT = {
+    'Records': [
+        _sns_record('MESSAGE_1', _update_message(
+            'STACK_A', 'VALUE_1', 'OTHER_NAME')),
+        _sns_record('MESSAGE_2', _update_message('STACK_B', 'VALUE_2')),
+        _sns_record('MESSAGE_0', _update_message('STACK_A', 'VALUE_0')),
+        _sns_record('MESSAGE_3', _update_message('STACK_A', 'VALUE_3')),
+    ]
+}
+
+
 class TestDeployStack(unittest.TestCase):
 
+    def setUp(self):
+        _recent_updates.clear()
+        _deferred_updates.clear()
+        _stores.clear()
+        self.config = {'coalesce_window': 0}
+        self.patch_getconfig = patch(
+            'crassus.deployer.get_lambda_config_property')
+        self.mock_getconfig = self.patch_getconfig.start()
+        self.mock_getconfig.side_effect = (
+            lambda context, name, default=None:
+            self.config.get(name, default))
+        self.patch_notify = patch('crassus.deployer.Crassus.notify')
+        self.mock_notify = self.patch_notify.start()
+
+    def tearDown(self):
+        self.patch_getconfig.stop()
+        self.patch_notify.stop()
+        _recent_updates.clear()
+        _deferred_updates.clear()
+        _stores.clear()
+
+    def _deploy(self, event, load_mock, update_mock):
+        """Deploy the event, return the (stack, parameters) updated."""
+        load_mock.return_value = True
+        deployed = []
+        crassus = Crassus(event, None)
+
+        def update():
+            deployed.append(
+                (crassus.stack_name,
+                 dict(crassus.stack_update_parameters.parameters)))
+            return True
+
+        update_mock.side_effect = update
+        crassus.deploy()
+        return deployed
+
     @patch('crassus.deployer.Crassus.load')
     @patch('crassus.deployer.Crassus.update')
     def test_should_call_all_necessary_stuff(self, load_mock, update_mock):
-        crassus = Crassus(None, None)
+        crassus = Crassus(SAMPLE_EVENT, None)
         crassus.deploy()
         load_mock.assert_called_once_with()
         update_mock.assert_called_once_with()
 
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_coalesce_updates_of_the_same_stack(
+            self, load_mock, update_mock):
+        deployed = self._deploy(BATCH_EVENT, load_mock, update_mock)
+        self.assertEqual(deployed, [
+            ('STACK_A', {'ANY_NAME': 'VALUE_3', 'OTHER_NAME': 'VALUE_1'}),
+            ('STACK_B', {'ANY_NAME': 'VALUE_2'})])
+        self.assertEqual(self.mock_notify.call_args_list, [
+            call(DeploymentResponse.STATUS_SUPERSEDED, ANY,
+                 supersededBy='MESSAGE_3')] * 2)
+
+    def test_coalesced_update_keeps_highest_attempt(self):
+        event = {'Records': [
+            {'eventSource': 'aws:sqs', 'messageId': 'SQS_{0}'.format(number),
+             'body': json.dumps(dict(
+                 _update_message('STACK_A', 'VALUE_{0}'.format(number)),
+                 messageId='MESSAGE_{0}'.format(number), attempt=attempt))}
+            for number, attempt in enumerate([7, 5])]}
+        [(merged, superseded)] = Crassus(event, None).coalesce()
+        self.assertEqual(merged.attempt, 7)
+        self.assertEqual(merged.message_id, 'MESSAGE_1')
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_not_coalesce_updates_with_other_roles(
+            self, load_mock, update_mock):
+        self.config['role_arns'] = [ROLE_ARN]
+        event = {'Records': [
+            _sns_record('MESSAGE_1', _update_message('STACK_A', 'VALUE_1')),
+            _sns_record('MESSAGE_2', dict(
+                _update_message('STACK_A', 'VALUE_2'), roleArn=ROLE_ARN)),
+        ]}
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [
+            ('STACK_A', {'ANY_NAME': 'VALUE_1'}),
+            ('STACK_A', {'ANY_NAME': 'VALUE_2'})])
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_not_update_when_stack_could_not_be_loaded(
+            self, load_mock, update_mock):
+        load_mock.return_value = False
+        crassus = Crassus(BATCH_EVENT, None)
+        crassus.deploy()
+        self.assertEqual(load_mock.call_count, 2)
+        self.assertEqual(update_mock.call_count, 0)
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_deploy_repeated_update_within_window(
+            self, load_mock, update_mock):
+        self.config['coalesce_window'] = 60
+        event = {'Records': [_sns_record(
+            'MESSAGE_1', _update_message('STACK_A', 'VALUE_1'))]}
+        self._deploy(event, load_mock, update_mock)
+        repeated_event = {'Records': [_sns_record(
+            'MESSAGE_2', _update_message('STACK_A', 'VALUE_1'))]}
+        deployed = self._deploy(repeated_event, load_mock, update_mock)
+        # The stack may have been rolled back, update() decides
+        self.assertEqual(deployed, [('STACK_A', {'ANY_NAME': 'VALUE_1'})])
+        self.assertFalse(self.mock_notify.called)
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_newer_update_supersedes_deferred_update(
+            self, load_mock, update_mock):
+        self.config['coalesce_window'] = 600
+        delay_queue = LocalDelayQueue()
+        deployed = []
+
+        def deploy(event, busy=False):
+            crassus = Crassus(event, None)
+            crassus._delay_queue = delay_queue
+
+            def load():
+                if not busy:
+                    return True
+                crassus.stack = Mock(stack_status='UPDATE_IN_PROGRESS')
+                crassus.defer()
+                return False
+
+            load_mock.side_effect = load
+            update_mock.side_effect = lambda: deployed.append(
+                dict(crassus.stack_update_parameters.parameters)) or True
+            crassus.deploy()
+
+        deploy({'Records': [_sns_record(
+            'MESSAGE_A', _update_message('STACK_A', '2'))]})
+        deploy({'Records': [_sns_record(
+            'MESSAGE_B', _update_message('STACK_A', '1'))]}, busy=True)
+        deploy({'Records': [_sns_record(
+            'MESSAGE_C', _update_message('STACK_A', '2'))]})
+        retried = delay_queue.pop_due(time.time() + 3600)
+        deploy({'Records': [{
+            'eventSource': 'aws:sqs', 'messageId': 'SQS_ID',
+            'body': retried[0]}]})
+
+        self.assertEqual(deployed, [{'ANY_NAME': '2'}, {'ANY_NAME': '2'}])
+        self.assertEqual(
+            self.mock_notify.call_args_list[-1],
+            call(DeploymentResponse.STATUS_SUPERSEDED, ANY,
+                 supersededBy='MESSAGE_C'))
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_merge_recent_update_within_window(
+            self, load_mock, update_mock):
+        self.config['coalesce_window'] = 60
+        event = {'Records': [_sns_record(
+            'MESSAGE_1', _update_message('STACK_A', 'VALUE_1'))]}
+        self._deploy(event, load_mock, update_mock)
+        next_event = {'Records': [_sns_record(
+            'MESSAGE_2', _update_message('STACK_A', 'VALUE_2', 'OTHER'))]}
+        deployed = self._deploy(next_event, load_mock, update_mock)
+        self.assertEqual(deployed, [
+            ('STACK_A', {'ANY_NAME': 'VALUE_1', 'OTHER': 'VALUE_2'})])
+
+    @patch('crassus.deployer.time')
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_not_coalesce_after_window(
+            self, load_mock, update_mock, time_mock):
+        self.config['coalesce_window'] = 60
+        self.config['dedupe_store'] = None
+        time_mock.time.return_value = 1000
+        event = {'Records': [_sns_record(
+            'MESSAGE_1', _update_message('STACK_A', 'VALUE_1'))]}
+        self._deploy(event, load_mock, update_mock)
+        time_mock.time.return_value = 1060
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [('STACK_A', {'ANY_NAME': 'VALUE_1'})])
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_reject_invalid_message_before_loading(
+            self, load_mock, update_mock):
+        invalid_message = _update_message('STACK_A', 1)
+        event = {'Records': [
+            _sns_record('MESSAGE_1', invalid_message),
+            _sns_record('MESSAGE_2', _update_message('STACK_B', 'VALUE'))]}
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [('STACK_B', {'ANY_NAME': 'VALUE'})])
+        self.assertEqual(load_mock.call_count, 1)
+        self.mock_notify.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE, ANY, stackName='STACK_A',
+            requestMessageId='MESSAGE_1')
+
+    @patch('crassus.deployer.logger')
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_reject_message_without_stack_name_as_is(
+            self, load_mock, update_mock, logger_mock):
+        event = {'Records': [
+            {'Sns': {'MessageId': 'MESSAGE_1', 'Message': '{"version'}},
+            _sns_record('MESSAGE_2', _update_message('STACK_B', 'VALUE'))]}
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [('STACK_B', {'ANY_NAME': 'VALUE'})])
+        self.mock_notify.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE, ANY, stackName=None,
+            requestMessageId='MESSAGE_1')
+        self.assertEqual(logger_mock.error.call_count, 1)
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_reject_role_that_is_not_allowed(
+            self, load_mock, update_mock):
+        self.config['role_arns'] = ['arn:aws:iam::123456789012:role/other']
+        event = {'Records': [_sns_record('MESSAGE_1', dict(
+            _update_message('STACK_A', 'VALUE_1'), roleArn=ROLE_ARN))]}
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [])
+        self.assertFalse(load_mock.called)
+        self.mock_notify.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE,
+            'Invalid update message: roleArn {0} is not allowed'.format(
+                ROLE_ARN),
+            stackName='STACK_A', requestMessageId='MESSAGE_1')
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_reject_roles_without_allowed_roles(
+            self, load_mock, update_mock):
+        event = {'Records': [_sns_record('MESSAGE_1', dict(
+            _update_message('STACK_A', 'VALUE_1'), roleArn=ROLE_ARN))]}
+        self.assertEqual(self._deploy(event, load_mock, update_mock), [])
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_allow_roles_of_allowed_account(
+            self, load_mock, update_mock):
+        self.config['role_arns'] = ['123456789012']
+        event = {'Records': [_sns_record('MESSAGE_1', dict(
+            _update_message('STACK_A', 'VALUE_1'), roleArn=ROLE_ARN))]}
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [('STACK_A', {'ANY_NAME': 'VALUE_1'})])
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_validate_each_message_once(self, load_mock, update_mock):
+        self.config['role_arns'] = ['123456789012']
+        event = {'Records': [
+            _sns_record('MESSAGE_1', dict(
+                _update_message('STACK_A', 'VALUE_1'), roleArn=ROLE_ARN)),
+            _sns_record('MESSAGE_2', dict(
+                _update_message('STACK_A', 'VALUE_2', key='OTHER_NAME'),
+                roleArn=ROLE_ARN))]}
+        with patch('crassus.deployer.validate_message',
+                   wraps=validate_message) as validate_mock:
+            deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [('STACK_A', {
+            'ANY_NAME': 'VALUE_1', 'OTHER_NAME': 'VALUE_2'})])
+        self.assertEqual(validate_mock.call_count, 2)
+
+    @patch('crassus.deployer.Crassus.update', autospec=True)
+    @patch('crassus.deployer.Crassus.load', Mock(return_value=True))
+    def test_should_deploy_regions_concurrently(self, update_mock):
+        def update_message(stack_name, region):
+            return dict(_update_message(stack_name, 'VALUE'), region=region)
+
+        event = {'Records': [
+            _sns_record('MESSAGE_1', update_message('STACK_A', 'eu-west-1')),
+            _sns_record('MESSAGE_2', update_message('STACK_B', 'us-east-1')),
+            _sns_record('MESSAGE_3', update_message('STACK_C', 'eu-west-1')),
+        ]}
+        crassus = Crassus(event, None)
+        deployed = []
+        us_east_1_deployed = threading.Event()
+
+        def update(worker):
+            region = worker.stack_update_parameters.region
+            if region == 'us-east-1':
+                us_east_1_deployed.set()
+            else:
+                # Only returns if the other region is deployed meanwhile
+                self.assertTrue(us_east_1_deployed.wait(5))
+            deployed.append((worker is crassus, region, worker.stack_name))
+            return True
+        update_mock.side_effect = update
+        crassus.deploy()
+
+        self.assertEqual(sorted(deployed), [
+            (False, 'eu-west-1', 'STACK_A'), (False, 'eu-west-1', 'STACK_C'),
+            (False, 'us-east-1', 'STACK_B')])
+
+    def test_region_timeout_leaves_time_for_the_responses(self):
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 15000
+        self.assertAlmostEqual(
+            Crassus(None, context).region_deploy_timeout(), 12, delta=1)
+        self.assertEqual(Crassus(None, None).region_deploy_timeout(), 10)
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_timed_out_worker_stops_after_responses_were_sent(
+            self, load_mock, update_mock):
+        crassus = Crassus(BATCH_EVENT, None)
+        crassus.sqs_batch.close()
+        crassus.deploy_region(crassus.coalesce())
+        self.assertFalse(load_mock.called)
+        self.assertFalse(self.mock_notify.called)
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_drop_redelivered_message(self, load_mock, update_mock):
+        event = {'Records': [_sns_record(
+            'MESSAGE_1', _update_message('STACK_A', 'VALUE_1'))]}
+        self._deploy(event, load_mock, update_mock)
+        load_mock.reset_mock()
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [])
+        self.assertFalse(load_mock.called)
+        self.assertFalse(self.mock_notify.called)
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_deploy_new_message_with_processed_content(
+            self, load_mock, update_mock):
+        event = {'Records': [_sns_record(
+            'MESSAGE_1', _update_message('STACK_A', 'VALUE_1'))]}
+        self._deploy(event, load_mock, update_mock)
+        repeated_event = {'Records': [_sns_record(
+            'MESSAGE_2', _update_message('STACK_A', 'VALUE_1'))]}
+        deployed = self._deploy(repeated_event, load_mock, update_mock)
+        # The stack may have been rolled back or changed meanwhile
+        self.assertEqual(deployed, [('STACK_A', {'ANY_NAME': 'VALUE_1'})])
+        self.assertEqual(_stores[('memory', 300)].stats,
+                         {'hits': 0, 'misses': 2})
+
+    @patch('crassus.deployer.Crassus.update')
+    @patch('crassus.deployer.Crassus.load')
+    def test_should_not_remember_failed_update(self, load_mock, update_mock):
+        event = {'Records': [_sns_record(
+            'MESSAGE_1', _update_message('STACK_A', 'VALUE_1'))]}
+        load_mock.return_value = False
+        Crassus(event, None).deploy()
+        deployed = self._deploy(event, load_mock, update_mock)
+        self.assertEqual(deployed, [('STACK_A', {'ANY_NAME': 'VALUE_1'})])
 
+
+@patch('crassus.deployer.get_lambda_config_property', Mock(
+    return_value=None))
 class TestParseParameters(unittest.TestCase):
 
     def setUp(self):
@@ -75,19 +455,35 @@ class TestParseParameters(unittest.TestCase):
         self.assertEqual(self.crassus.stack_update_parameters.stack_name,
                          STACK_NAME)
 
+    def test_parse_every_record(self):
+        crassus = Crassus(BATCH_EVENT, None)
+        self.assertEqual(
+            [sup.stack_name for sup in crassus.stack_update_parameters_list],
+            ['STACK_A', 'STACK_B', 'STACK_A', 'STACK_A'])
+
+
+class TestParseRecord(unittest.TestCase):
+
+    def test_rejects_malformed_json(self):
+        record = {'Sns': {'MessageId': 'MESSAGE_1', 'Message': '{"version'}}
+        with self.assertRaises(InvalidMessageError) as context:
+            Crassus.parse_record(record)
+        self.assertEqual(context.exception.message_id, 'MESSAGE_1')
+
+    def test_rejects_invalid_message_with_its_stack_name(self):
+        record = _sns_record('MESSAGE_1', {'stackName': 'STACK_A'})
+        with self.assertRaises(InvalidMessageError) as context:
+            Crassus.parse_record(record)
+        self.assertEqual(context.exception.message_id, 'MESSAGE_1')
+        self.assertEqual(context.exception.stack_name, 'STACK_A')
+
 
 class TestNotify(unittest.TestCase):
     STATUS = 'success'
     MESSAGE = 'ANY MESSAGE'
 
     @patch('crassus.deployer.sqs_send_message')
-    @patch('boto3.resource')
-    def test_should_notify_sns(self, resource_mock, mock_sqs):
-        topic_mock = Mock()
-        sns_mock = Mock()
-        sns_mock.Topic.return_value = topic_mock
-        resource_mock.return_value = sns_mock
-
+    def test_should_notify_sns(self, mock_sqs):
         self.crassus = Crassus(None, None)
         self.crassus._stack_name = STACK_NAME
         self.crassus._output_topics = ANY_TOPIC
@@ -103,7 +499,16 @@ class TestNotify(unittest.TestCase):
                 'stackName': 'ANY_STACK',
                 'version': '1.1',
                 'message': 'ANY MESSAGE',
-                'emitter': 'crassus'}))
+                'emitter': 'crassus'}, batch=self.crassus.sqs_batch))
+
+    @patch('crassus.deployer.sqs_send_message')
+    def test_stack_name_can_be_given(self, mock_sqs):
+        self.crassus = Crassus(None, None)
+        self.crassus._output_topics = ANY_TOPIC
+
+        self.crassus.notify(self.STATUS, self.MESSAGE, stackName=None)
+
+        self.assertIsNone(mock_sqs.call_args[0][1]['stackName'])
 
     @patch('crassus.deployer.Crassus.output_topics', None)
     def test_should_do_gracefully_nothing(self):
@@ -147,19 +552,13 @@ class TestUpdateStack(unittest.TestCase):
         self.crassus.stack = self.stack_mock
         self.crassus._stack_name = STACK_NAME
         self.crassus._output_topics = ANY_TOPIC
-        self.crassus.aws_lambda = Mock()
-        self.crassus.aws_lambda.get_function_configuration.return_value = {
-            'Description': dedent("""
-                {"result_queue":[
-                    "arn:aws:sns:eu-west-1:123456789012:crassus-output",
-                    "arn:aws:sns:eu-west-1:123456789012:random-topic"
-                    ],
-                    "cfn_events": ["CFN-SNS-TOPIC-1"]}""")}
 
     @patch('crassus.deployer.Crassus.notify', Mock())
     @patch('crassus.deployer.get_lambda_config_property')
     def test_update_stack_should_call_update(self, mock_lambda):
-        mock_lambda.return_value = ['CFN-SQS-QUEUE-1']
+        mock_lambda.side_effect = (
+            lambda context, name, default=None:
+            {'cfn_events': ['CFN-SQS-QUEUE-1']}.get(name, default))
         self.crassus.update()
         self.stack_mock.update.assert_called_once_with(
             UsePreviousTemplate=True,
@@ -168,6 +567,90 @@ class TestUpdateStack(unittest.TestCase):
             NotificationARNs=['CFN-SQS-QUEUE-1'])
         self.assertEqual(self.crassus.cfn_output_topics, ['CFN-SQS-QUEUE-1'])
 
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.get_lambda_config_property', Mock(
+        return_value=None))
+    def test_update_stack_passes_token_of_the_message(self, notify_mock):
+        self.crassus._stack_update_parameters.message_id = 'MESSAGE_1'
+        token = self.crassus._stack_update_parameters.client_request_token()
+        self.crassus.update()
+        self.stack_mock.update.assert_called_once_with(
+            UsePreviousTemplate=True,
+            Parameters=self.expected_parameters,
+            Capabilities=['CAPABILITY_IAM'],
+            NotificationARNs=None,
+            ClientRequestToken=token)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS, ANY, clientRequestToken=token,
+            requestMessageId='MESSAGE_1')
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.get_lambda_config_property', Mock(
+        return_value=None))
+    def test_throttled_update_is_retried(self, notify_mock):
+        # Later tests should not be paced by the throttled bucket
+        self.addCleanup(retry._buckets.clear)
+        self.crassus.retry_policy.sleep = Mock()
+        self.stack_mock.update.side_effect = [
+            ClientError(
+                {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}},
+                'UpdateStack'),
+            {}]
+        self.assertTrue(self.crassus.update())
+        self.assertEqual(self.stack_mock.update.call_count, 2)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS, ANY, awsAttempts=2)
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.get_lambda_config_property', Mock(
+        return_value=None))
+    def test_update_failure_reports_error_class(self, notify_mock):
+        self.stack_mock.update.side_effect = ClientError(
+            {'Error': {'Code': 'ValidationError',
+                       'Message': 'Parameter KeyOne is invalid'}},
+            'UpdateStack')
+        self.assertFalse(self.crassus.update())
+        self.assertEqual(self.stack_mock.update.call_count, 1)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE, ANY, errorClass='validation')
+
+    @patch('crassus.deployer.Crassus.notify', Mock())
+    @patch('crassus.deployer.get_lambda_config_property')
+    def test_update_stack_should_track_update(self, mock_lambda):
+        mock_lambda.side_effect = (
+            lambda context, name, default=None:
+            {'tracking_store': 'memory'}.get(name, default))
+        self.stack_mock.stack_id = 'ANY_STACK_ID'
+        self.crassus._stack_update_parameters.message_id = 'MESSAGE_1'
+        self.crassus.update()
+        pending_update = get_pending_update_store('memory').get(
+            'ANY_STACK_ID')
+        self.assertEqual(pending_update['stackName'], STACK_NAME)
+        self.assertEqual(pending_update['messageId'], 'MESSAGE_1')
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.get_lambda_config_property')
+    def test_failing_tracking_store_does_not_fail_update(
+            self, mock_lambda, notify_mock):
+        mock_lambda.side_effect = (
+            lambda context, name, default=None:
+            {'tracking_store': 'unknown'}.get(name, default))
+        self.assertTrue(self.crassus.update())
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_SUCCESS, ANY)
+
+    @patch('crassus.deployer.Crassus.notify')
+    @patch('crassus.deployer.get_lambda_config_property', Mock())
+    def test_update_stack_should_skip_update_without_changes(
+            self, notify_mock):
+        self.crassus._stack_update_parameters = StackUpdateParameter(
+            dict(self.update_parameters,
+                 parameters={"KeyOne": "OriginalValueOne"}))
+        self.crassus.update()
+        self.assertFalse(self.stack_mock.update.called)
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_NO_CHANGE, ANY)
+
     @patch('crassus.deployer.get_lambda_config_property', Mock())
     @patch('crassus.deployer.Crassus.notify', Mock())
     @patch('crassus.deployer.logger')
@@ -192,14 +675,16 @@ class TestUpdateStack(unittest.TestCase):
 class TestLoad(unittest.TestCase):
 
     def setUp(self):
-        self.patcher = patch('boto3.resource')
+        self.patcher = patch('crassus.deployer.get_resource')
         self.resource_mock = self.patcher.start()
 
         self.cloudformation_mock = Mock()
-        self.stack_mock = Mock()
+        self.stack_mock = Mock(stack_status='UPDATE_COMPLETE')
         self.resource_mock.return_value = self.cloudformation_mock
         self.cloudformation_mock.Stack.return_value = self.stack_mock
         self.crassus = Crassus(None, None)
+        self.crassus._stack_update_parameters = Crassus.parse_record(
+            SAMPLE_EVENT['Records'][0])
         self.crassus._stack_name = STACK_NAME
         self.crassus._output_topics = ANY_TOPIC
 
@@ -210,6 +695,29 @@ class TestLoad(unittest.TestCase):
         self.crassus.load()
         self.stack_mock.load.assert_called_once_with()
 
+    def test_loads_stack_in_region_of_the_message(self):
+        self.crassus._stack_update_parameters.region = 'us-east-1'
+        self.crassus.load()
+        self.resource_mock.assert_called_once_with(
+            'cloudformation', 'us-east-1', role_arn=None,
+            retry_policy=self.crassus.retry_policy)
+
+    def test_loads_stack_with_role_of_the_message(self):
+        self.crassus._stack_update_parameters.role_arn = ROLE_ARN
+        self.crassus.load()
+        self.resource_mock.assert_called_once_with(
+            'cloudformation', 'eu-west-1', role_arn=ROLE_ARN,
+            retry_policy=self.crassus.retry_policy)
+
+    @patch('crassus.deployer.Crassus.notify')
+    def test_failure_to_assume_role_is_notified(self, notify_mock):
+        self.resource_mock.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'Denied'}},
+            'AssumeRole')
+        self.assertFalse(self.crassus.load())
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE, ANY, errorClass='other')
+
     @patch('crassus.deployer.sqs_send_message')
     @patch('crassus.deployer.logger')
     def test_stack_load_throws_clienterror_exception(
@@ -221,6 +729,53 @@ class TestLoad(unittest.TestCase):
         logger_mock.error.assert_called_once_with(ANY)
         self.assertEquals(mock_sqs.call_count, 1)
 
+    @patch('crassus.deployer.get_lambda_config_property', Mock(
+        return_value=None))
+    def test_busy_stack_is_loaded_without_retry_queue(self):
+        self.stack_mock.stack_status = 'UPDATE_IN_PROGRESS'
+        self.assertTrue(self.crassus.load())
+
+    @patch('crassus.deployer.get_lambda_config_property', Mock(
+        return_value=8))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_busy_stack_update_is_deferred(self, notify_mock):
+        self.stack_mock.stack_status = 'UPDATE_IN_PROGRESS'
+        self.crassus._delay_queue = LocalDelayQueue()
+        self.crassus._stack_update_parameters = Crassus.parse_record(
+            SAMPLE_EVENT['Records'][0])
+
+        self.assertFalse(self.crassus.load())
+
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_DEFERRED, ANY,
+            retryAttempt=1, delaySeconds=30)
+        self.assertEqual(self.crassus._delay_queue.pop_due(), [])
+        redelivered = self.crassus._delay_queue.pop_due(time.time() + 30)
+        retried = Crassus.parse_record({
+            'eventSource': 'aws:sqs', 'messageId': 'ANY_SQS_ID',
+            'body': redelivered[0]})
+        self.assertEqual(retried.attempt, 1)
+        self.assertEqual(retried.message_id, '<MESSAGE ID>')
+        self.assertEqual(retried.stack_name, STACK_NAME)
+        self.assertEqual(retried.parameters,
+                         self.crassus._stack_update_parameters.parameters)
+
+    @patch('crassus.deployer.get_lambda_config_property', Mock(
+        return_value=8))
+    @patch('crassus.deployer.Crassus.notify')
+    def test_busy_stack_update_fails_after_max_attempts(self, notify_mock):
+        self.stack_mock.stack_status = 'UPDATE_ROLLBACK_IN_PROGRESS'
+        self.crassus._delay_queue = LocalDelayQueue()
+        self.crassus._stack_update_parameters = StackUpdateParameter(
+            json.loads(SAMPLE_EVENT['Records'][0]['Sns']['Message']),
+            attempt=8)
+
+        self.assertFalse(self.crassus.load())
+
+        notify_mock.assert_called_once_with(
+            DeploymentResponse.STATUS_FAILURE, ANY)
+        self.assertEqual(self.crassus._delay_queue.messages, [])
+
     """
     @patch('crassus.deployer.notify')
     def test_deploy_stack_should_notify_error_in_case_of_client_error(
@@ -252,10 +807,56 @@ class TestStackUpdateParameters(unittest.TestCase):
         self.assertEqual(sup.version, 1)
         self.assertEqual(sup.stack_name, "ANY_STACK")
         self.assertEqual(sup.region, "ANY_REGION")
-        self.assertEqual(sup.items(), [
+        self.assertEqual(sup.parameters.items(), [
             ("PARAMETER1", "VALUE1"),
             ("PARAMETER2", "VALUE2")])
 
+    def test_init_validates_message(self):
+        invalid_messages = [
+            [],
+            dict(self.input_message, version=None),
+            dict(self.input_message, version=True),
+            dict(self.input_message, stackName=''),
+            dict(self.input_message, region=['eu-west-1']),
+            dict(self.input_message, parameters=[
+                {'updateParameterKey': 'PARAMETER1',
+                 'updateParameterValue': 'VALUE1'}]),
+            dict(self.input_message, parameters={'PARAMETER1': 1}),
+        ]
+        for key in self.input_message:
+            message = dict(self.input_message)
+            del message[key]
+            invalid_messages.append(message)
+        for message in invalid_messages:
+            self.assertRaises(
+                InvalidMessageError, StackUpdateParameter, message)
+
+    def test_init_reads_optional_role(self):
+        self.assertIsNone(StackUpdateParameter(self.input_message).role_arn)
+        sup = StackUpdateParameter(
+            dict(self.input_message, roleArn=ROLE_ARN))
+        self.assertEqual(sup.role_arn, ROLE_ARN)
+        self.assertEqual(sup.to_message()['roleArn'], ROLE_ARN)
+        self.assertRaises(
+            InvalidMessageError, StackUpdateParameter,
+            dict(self.input_message, roleArn=''))
+
+    def test_client_request_token_is_derived_from_message_id(self):
+        sup = StackUpdateParameter(self.input_message, message_id='M1')
+        token = sup.client_request_token()
+        self.assertRegexpMatches(token, r'^[a-zA-Z0-9][-a-zA-Z0-9]{0,127}$')
+        self.assertEqual(
+            StackUpdateParameter(self.input_message, message_id='M1',
+                                 attempt=2).client_request_token(), token)
+        self.assertNotEqual(
+            StackUpdateParameter(self.input_message, message_id='M2')
+            .client_request_token(), token)
+        self.assertIsNone(
+            StackUpdateParameter(self.input_message).client_request_token())
+
+    def test_invalid_message_error_is_a_value_error(self):
+        self.assertRaises(ValueError, StackUpdateParameter, {})
+
     def test_to_aws_format(self):
         expected_output = [{"ParameterKey": "PARAMETER1",
                             "ParameterValue": "VALUE1"},
@@ -284,6 +885,14 @@ class TestStackUpdateParameters(unittest.TestCase):
         sup = StackUpdateParameter(input_message)
         self.assertEqual(sup.merge(stack_parameter), expected_output)
 
+    def test_has_changes(self):
+        self.assertTrue(StackUpdateParameter.has_changes([
+            {"ParameterKey": "PARAMETER1", "ParameterValue": "VALUE1"},
+            {"ParameterKey": "PARAMETER2", "UsePreviousValue": True}]))
+        self.assertFalse(StackUpdateParameter.has_changes([
+            {"ParameterKey": "PARAMETER2", "UsePreviousValue": True}]))
+        self.assertFalse(StackUpdateParameter.has_changes([]))
+
     def test_merge_many_parameters(self):
         """
         Test that merging with many parameters work.
@@ -333,18 +942,18 @@ class TestStackUpdateParameters(unittest.TestCase):
 class TestOutputTopic(unittest.TestCase):
 
     def setUp(self):
-        self.patcher = patch('boto3.client')
-        self.boto3_client = self.patcher.start()
+        self.patcher = patch('crassus.utils.get_client')
+        self.mock_lambda = self.patcher.start().return_value
         self.context_mock = Mock(invoked_function_arn="any_arn",
                                  function_version="any_version")
         self.crassus = Crassus(None, self.context_mock)
+        invalidate_lambda_config_cache()
 
     def tearDown(self):
         self.patcher.stop()
 
-    @patch('crassus.utils.aws_lambda')
-    def test_output_topics_returns_arn_list(self, mock_lambda):
-        mock_lambda.get_function_configuration.return_value = {
+    def test_output_topics_returns_arn_list(self):
+        self.mock_lambda.get_function_configuration.return_value = {
             'Description': dedent("""
                 {"result_queue":[
                     "arn:aws:sns:eu-west-1:123456789012:crassus-output",
@@ -357,20 +966,18 @@ class TestOutputTopic(unittest.TestCase):
                     "arn:aws:sns:eu-west-1:123456789012:random-topic", ]
         self.assertEqual(expected, topic_list)
 
-    @patch('crassus.utils.aws_lambda')
     @patch('crassus.utils.logger')
-    def test_output_topics_handles_value_error(self, logger_mock, mock_lambda):
-        mock_lambda.get_function_configuration.return_value = {
+    def test_output_topics_handles_value_error(self, logger_mock):
+        self.mock_lambda.get_function_configuration.return_value = {
             'Description': "NO_SUCH_JSON"
         }
         topic_list = self.crassus.output_topics
         self.assertEqual(None, topic_list)
         logger_mock.error.assert_called_once_with(ANY)
 
-    @patch('crassus.utils.aws_lambda')
     @patch('crassus.utils.logger')
-    def test_output_topics_handles_key_error(self, logger_mock, mock_lambda):
-        mock_lambda.get_function_configuration.return_value = {
+    def test_output_topics_handles_key_error(self, logger_mock):
+        self.mock_lambda.get_function_configuration.return_value = {
             'Description': '{"key": "value"}'
         }
         topic_list = self.crassus.output_topics
@@ -390,3 +997,80 @@ class TestGaiusMessage(unittest.TestCase):
         self.assertEqual(result_message['timestamp'], 'timestamp')
         self.assertEqual(result_message['emitter'], 'emitter')
         self.assertNotEqual(result_message['message'], 'invalid message')
+
+
+KEYS = st.sampled_from(['param1', 'param2', 'param3', 'param4', 'param5'])
+VALUES = st.sampled_from(['value1', 'value2', 'value3'])
+STACK_PARAMETERS = st.lists(
+    st.fixed_dictionaries({'ParameterKey': KEYS, 'ParameterValue': VALUES}),
+    max_size=8)
+UPDATES = st.dictionaries(KEYS, VALUES, max_size=5)
+
+
+def reference_merge(update, stack_parameters):
+    """
+    The former filter based StackUpdateParameter.merge(), kept as
+    reference for the indexed implementation.
+    """
+    merged_stack_parameters = []
+
+    for update_key in update:
+        update_value = update[update_key]
+        filtered_list = list(filter(
+            lambda x: x.get('ParameterKey') == update_key,
+            stack_parameters))
+        if not filtered_list:
+            continue
+        if filtered_list[0].get('ParameterValue') != update_value:
+            merged_stack_parameters.append({
+                'ParameterKey': update_key,
+                'ParameterValue': update_value})
+            stack_parameters = list(filter(
+                lambda x: x.get('ParameterKey') != update_key,
+                stack_parameters))
+
+    merged_stack_parameters.extend(
+        {'ParameterKey': x.get('ParameterKey'), 'UsePreviousValue': True}
+        for x in stack_parameters)
+
+    return merged_stack_parameters
+
+
+def stack_update_parameter(parameters):
+    return StackUpdateParameter({
+        'version': 1,
+        'stackName': 'ANY_STACK',
+        'region': 'ANY_REGION',
+        'parameters': parameters})
+
+
+class TestMergeProperties(unittest.TestCase):
+
+    """
+    Property based tests for StackUpdateParameter.merge().
+    """
+
+    @given(UPDATES, STACK_PARAMETERS)
+    def test_merge_equals_reference(self, parameters, stack_parameters):
+        sup = stack_update_parameter(parameters)
+        self.assertEqual(
+            sup.merge(stack_parameters),
+            reference_merge(sup.parameters, stack_parameters))
+
+    @given(UPDATES, STACK_PARAMETERS)
+    def test_merge_does_not_modify_stack_parameters(
+            self, parameters, stack_parameters):
+        original = [dict(parameter) for parameter in stack_parameters]
+        stack_update_parameter(parameters).merge(stack_parameters)
+        self.assertEqual(stack_parameters, original)
+
+    @given(UPDATES, STACK_PARAMETERS)
+    def test_merge_keeps_order_of_unchanged_parameters(
+            self, parameters, stack_parameters):
+        merged = stack_update_parameter(parameters).merge(stack_parameters)
+        previous_keys = [
+            parameter['ParameterKey'] for parameter in merged
+            if parameter.get('UsePreviousValue')]
+        self.assertEqual(previous_keys, [
+            parameter['ParameterKey'] for parameter in stack_parameters
+            if parameter['ParameterKey'] in previous_keys])
@@ -0,0 +1,124 @@
+import json
+import unittest
+from StringIO import StringIO
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from crassus import metrics
+from crassus.metrics import (
+    EmfSink, MemorySink, flush_metrics, instrument_client,
+    set_metrics_sink, start_invocation_metrics, timed)
+from crassus.retry import RetryPolicy, client_config
+from mock import Mock
+
+
+@timed('AnyPhase')
+def any_phase(result):
+    return result
+
+
+class RawResponse(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class TestInvocationMetrics(unittest.TestCase):
+
+    """
+    Tests for the invocation metrics and their sinks.
+    """
+
+    def setUp(self):
+        self.sink = MemorySink()
+        set_metrics_sink(self.sink)
+
+    def tearDown(self):
+        flush_metrics()
+        set_metrics_sink(EmfSink())
+
+    def test_timed_records_every_call_of_the_invocation(self):
+        any_phase(1)
+        start_invocation_metrics(Mock(function_name='ANY_FUNCTION'))
+        self.assertEqual(any_phase(2), 2)
+        any_phase(3)
+        flush_metrics()
+        any_phase(4)
+        self.assertEqual(len(self.sink.emitted), 1)
+        self.assertEqual(len(self.sink.emitted[0].durations['AnyPhase']), 2)
+
+    def test_timed_records_failing_calls(self):
+        @timed('FailingPhase')
+        def failing_phase():
+            raise ValueError()
+
+        start_invocation_metrics(None)
+        self.assertRaises(ValueError, failing_phase)
+        self.assertEqual(
+            len(flush_metrics().durations['FailingPhase']), 1)
+
+    def test_flush_without_invocation_emits_nothing(self):
+        self.assertIsNone(flush_metrics())
+        self.assertEqual(self.sink.emitted, [])
+
+    def test_emf_sink_writes_embedded_metric_format(self):
+        stream = StringIO()
+        set_metrics_sink(EmfSink(stream))
+        start_invocation_metrics(Mock(function_name='ANY_FUNCTION'))
+        any_phase(1)
+        metrics._metrics.increment('AwsCalls', 2)
+        flush_metrics()
+
+        emf_entry = json.loads(stream.getvalue())
+        definition = emf_entry['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(definition['Namespace'], 'Crassus')
+        self.assertEqual(definition['Dimensions'], [['FunctionName']])
+        self.assertEqual(definition['Metrics'], [
+            {'Name': 'AnyPhase', 'Unit': 'Milliseconds'},
+            {'Name': 'AwsCalls', 'Unit': 'Count'}])
+        self.assertEqual(emf_entry['FunctionName'], 'ANY_FUNCTION')
+        self.assertEqual(len(emf_entry['AnyPhase']), 1)
+        self.assertEqual(emf_entry['AwsCalls'], 2)
+
+
+class TestAwsCallCounts(unittest.TestCase):
+
+    """
+    Tests for the AWS call counts of instrument_client() and the retry
+    counts of RetryPolicy.
+    """
+
+    def setUp(self):
+        set_metrics_sink(None)
+        self.client = instrument_client(boto3.client(
+            'lambda', region_name='eu-west-1', aws_access_key_id='ANY_KEY',
+            aws_secret_access_key='ANY_SECRET', config=client_config()))
+        self.responses = []
+        self.client.meta.events.register(
+            'before-send', lambda **kwargs: self.responses.pop(0))
+
+    def tearDown(self):
+        flush_metrics()
+
+    def _respond(self, status_code, body):
+        self.responses.append(AWSResponse(
+            'https://lambda.eu-west-1.amazonaws.com', status_code, {},
+            RawResponse(json.dumps(body).encode('utf-8'))))
+
+    def test_counts_calls_and_retries(self):
+        self._respond(500, {'Message': 'Internal error'})
+        self._respond(200, {'Description': ''})
+        self._respond(200, {'Description': ''})
+        invocation_metrics = start_invocation_metrics(None)
+        retry_policy = RetryPolicy(sleep=Mock())
+
+        retry_policy.call(
+            'lambda.GetFunctionConfiguration',
+            self.client.get_function_configuration, FunctionName='ANY')
+        self.client.get_function_configuration(FunctionName='ANY')
+
+        self.assertEqual(invocation_metrics.counts,
+                         {'AwsCalls': 2, 'AwsRetries': 1})
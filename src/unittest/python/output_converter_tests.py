@@ -1,9 +1,15 @@
+import datetime
 import json
+import sqlite3
 import unittest
 
 from crassus.deployment_response import DeploymentResponse
-from crassus.output_converter import OutputConverter
-from mock import call, patch
+from crassus.output_converter import (
+    ConversionError, OutputConverter, _pending_summaries, processed_records)
+from crassus.tracking import MemoryPendingUpdateStore
+from hypothesis import given
+from hypothesis import strategies as st
+from mock import ANY, call, patch
 from utils import load_fixture_json
 
 cfn_event = load_fixture_json('cfn_event.json')
@@ -11,6 +17,27 @@ cfn_event_different_termination = load_fixture_json(
     'cfn_event_different_termination.json')
 
 
+def reference_parse_sns_message(sns_message):
+    """
+    The former split based OutputConverter._parse_sns_message(), kept as
+    reference for the single pass parser.
+    """
+    splitted_list = sns_message.split('\'\n')
+    if splitted_list[-1] != '' and splitted_list[-1][-1] == '\'':
+        splitted_list[-1] = splitted_list[-1][:-1]
+    result_dict = {}
+    for line_item in splitted_list:
+        line_item = line_item.strip()
+        if '=\'' not in line_item:
+            continue
+        key, value = line_item.split('=\'', 1)
+        try:
+            result_dict[key] = json.loads(value)
+        except ValueError:
+            result_dict[key] = value
+    return result_dict
+
+
 class TestOutputConverter(unittest.TestCase):
 
     """
@@ -21,12 +48,16 @@ class TestOutputConverter(unittest.TestCase):
         self.event = cfn_event
         self.context = {}
         self.output_converter = OutputConverter(self.event, self.context)
+        processed_records.clear()
 
         # Patch get_lambda_config_property
         self.patch_getconfig = patch(
             'crassus.output_converter.get_lambda_config_property')
         self.mock_getconfig = self.patch_getconfig.start()
-        self.mock_getconfig.return_value = ['OUTPUT-SQS-QUEUE-1']
+        self.lambda_config = {'result_queue': ['OUTPUT-SQS-QUEUE-1']}
+        self.mock_getconfig.side_effect = \
+            lambda context, name, *default: self.lambda_config.get(
+                name, *default)
 
         # Patch logger
         self.patch_logger = patch('crassus.output_converter.logger')
@@ -37,7 +68,7 @@ class TestOutputConverter(unittest.TestCase):
             'crassus.output_converter.sqs_send_message')
         self.mock_sqs_send = self.patch_sqs_send.start()
 
-    def teardown(self):
+    def tearDown(self):
         self.patch_getconfig.stop()
         self.patch_logger.stop()
         self.patch_sqs_send.stop()
@@ -127,10 +158,42 @@ class TestOutputConverter(unittest.TestCase):
                 'version': '1.1',
                 'message': 'Resource creation Initiated',
                 'emitter': 'cloudformation',
-                'resourceType': 'AWS::Lambda::Permission'})
+                'resourceType': 'AWS::Lambda::Permission'},
+            batch=ANY, key=('ab90733f-2374-54e8-9d1a-3df265ae924a',))
         deployment_parameter = self.mock_sqs_send.call_args[0][1]
         self.assertIs(type(deployment_parameter), DeploymentResponse)
 
+    def test_converts_extra_fields(self):
+        """
+        convert() should add the configured extra fields.
+        """
+        self.lambda_config['cfn_extra_fields'] = [
+            'LogicalResourceId', 'Namespace', 'NoSuchField']
+        self.output_converter.convert()
+        deployment_response = self.mock_sqs_send.call_args[0][1]
+        self.assertEqual(
+            deployment_response['logicalResourceId'],
+            'cfnOutputConverterPermission')
+        self.assertEqual(deployment_response['namespace'], 123456789012)
+        self.assertNotIn('noSuchField', deployment_response)
+
+    def test_parser_parses_only_requested_fields(self):
+        """
+        With fields, only these should be parsed, and the parser should
+        stop when all of them were found.
+        """
+        with patch.object(self.output_converter, '_cast_type') as cast_mock:
+            cast_mock.side_effect = lambda value: value
+            return_value = self.output_converter._parse_sns_message(
+                self.event['Records'][0]['Sns']['Message'],
+                ['StackId', 'Namespace'])
+        self.assertEqual(return_value, {
+            'StackId': 'arn:aws:cloudformation:eu-west-1:123456789012:'
+                       'stack/crassus-karolyi-temp1/'
+                       'd1834770-91e8-11e5-98ba-50d5026f660a',
+            'Namespace': '123456789012'})
+        self.assertEqual(cast_mock.call_count, 2)
+
     def test_skips_empty_messages(self):
         """
         If there is no 'Sns' or 'Message' in the received event list,
@@ -142,3 +205,463 @@ class TestOutputConverter(unittest.TestCase):
         self.assertEqual(list(self.mock_logger.warning.call_args_list), [
             call('No \'Sns\' or \'Message\' in received event: {}'),
             call('No \'Sns\' or \'Message\' in received event: {\'foo\': 1}')])
+
+    @given(st.lists(
+        st.sampled_from([
+            'Key', '=', '\'', '\n', ' ', '{', '}', '[1]', '"', '12', '-3',
+            'true', 'null', 'NaN', 'x']),
+        max_size=30).map(''.join))
+    def test_parser_equals_reference(self, sns_message):
+        """
+        The single pass parser should give the same result as the former
+        split based one, including the workarounds.
+        """
+        self.assertEqual(
+            self.output_converter._parse_sns_message(sns_message),
+            reference_parse_sns_message(sns_message))
+
+    def test_cast_type_skips_values_that_cannot_be_json(self):
+        """
+        _cast_type() should not try to decode plain strings, but still
+        decode JSON after leading whitespace.
+        """
+        with patch('crassus.output_converter.json') as json_mock:
+            self.assertEqual(
+                self.output_converter._cast_type('CREATE_COMPLETE'),
+                'CREATE_COMPLETE')
+            self.assertFalse(json_mock.loads.called)
+        self.assertEqual(self.output_converter._cast_type(' 12'), 12)
+        self.assertEqual(self.output_converter._cast_type('"x"'), 'x')
+
+
+def cfn_record(resource_type, status, timestamp, stack_name='ANY_STACK'):
+    """Return an SNS record with a CloudFormation notification."""
+    return {'Sns': {'Message': (
+        "StackName='{0}'\n"
+        "Timestamp='{1}'\n"
+        "ResourceStatus='{2}'\n"
+        "ResourceStatusReason=''\n"
+        "ResourceType='{3}'\n").format(
+            stack_name, timestamp, status, resource_type)}}
+
+
+STACK_UPDATE_EVENT = {'Records': [
+    cfn_record('AWS::CloudFormation::Stack', 'UPDATE_IN_PROGRESS', 'T1'),
+    cfn_record('AWS::EC2::Instance', 'UPDATE_IN_PROGRESS', 'T2'),
+    cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T3'),
+    cfn_record('AWS::S3::Bucket', 'UPDATE_FAILED', 'T4'),
+    cfn_record('AWS::CloudFormation::Stack',
+               'UPDATE_ROLLBACK_IN_PROGRESS', 'T5'),
+    cfn_record('AWS::S3::Bucket', 'UPDATE_COMPLETE', 'T6'),
+    cfn_record('AWS::CloudFormation::Stack', 'UPDATE_ROLLBACK_COMPLETE', 'T7'),
+]}
+
+
+class TestEventModes(unittest.TestCase):
+
+    """
+    Tests for the event modes of OutputConverter.convert().
+    """
+
+    def setUp(self):
+        self.output_converter = OutputConverter(STACK_UPDATE_EVENT, {})
+        processed_records.clear()
+        _pending_summaries.clear()
+        self.patch_getconfig = patch(
+            'crassus.output_converter.get_lambda_config_property')
+        self.mock_getconfig = self.patch_getconfig.start()
+        self.lambda_config = {'result_queue': ['OUTPUT-SQS-QUEUE-1']}
+        self.mock_getconfig.side_effect = \
+            lambda context, name, *default: self.lambda_config.get(
+                name, *default)
+        self.patch_sqs_send = patch(
+            'crassus.output_converter.sqs_send_message')
+        self.mock_sqs_send = self.patch_sqs_send.start()
+
+    def tearDown(self):
+        self.patch_getconfig.stop()
+        self.patch_sqs_send.stop()
+        _pending_summaries.clear()
+
+    def _convert(self, event_mode):
+        self.lambda_config['cfn_event_mode'] = event_mode
+        self.output_converter.convert()
+        return [
+            (args[1]['timestamp'], args[1]['status'])
+            for args, _ in self.mock_sqs_send.call_args_list]
+
+    def test_all_mode_forwards_every_event(self):
+        self.assertEqual(len(self._convert('all')), 7)
+
+    @patch('crassus.output_converter.logger')
+    def test_unknown_mode_forwards_every_event(self, logger_mock):
+        self.assertEqual(len(self._convert('no_such_mode')), 7)
+        self.assertEqual(logger_mock.warning.call_count, 1)
+
+    def test_stack_mode_forwards_stack_events(self):
+        self.assertEqual(self._convert('stack'), [
+            ('T1', 'UPDATE_IN_PROGRESS'),
+            ('T5', 'UPDATE_ROLLBACK_IN_PROGRESS'),
+            ('T7', 'UPDATE_ROLLBACK_COMPLETE')])
+
+    def test_terminal_mode_forwards_terminal_statuses(self):
+        self.assertEqual(self._convert('terminal'), [
+            ('T3', 'UPDATE_COMPLETE'),
+            ('T4', 'UPDATE_FAILED'),
+            ('T6', 'UPDATE_COMPLETE'),
+            ('T7', 'UPDATE_ROLLBACK_COMPLETE')])
+
+    def test_summary_mode_rolls_up_resource_events(self):
+        self.assertEqual(self._convert('summary'), [
+            ('T1', 'UPDATE_IN_PROGRESS'),
+            ('T4', 'UPDATE_FAILED'),
+            ('T5', 'UPDATE_ROLLBACK_IN_PROGRESS'),
+            ('T6', 'UPDATE_COMPLETE'),
+            ('T7', 'UPDATE_ROLLBACK_COMPLETE')])
+        summary = self.mock_sqs_send.call_args_list[1][0][1]
+        self.assertEqual(summary['statusCounts'], {
+            'UPDATE_IN_PROGRESS': 1, 'UPDATE_COMPLETE': 1,
+            'UPDATE_FAILED': 1})
+        self.assertEqual(
+            summary['message'], '3 resource events: UPDATE_COMPLETE=1, '
+            'UPDATE_FAILED=1, UPDATE_IN_PROGRESS=1')
+
+    def test_summary_mode_summarizes_per_stack(self):
+        self.lambda_config['summary_interval'] = 0
+        self.output_converter.event = {'Records': [
+            cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T1', 'A'),
+            cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T2', 'B'),
+            cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T3', 'A'),
+        ]}
+        self.assertEqual(self._convert('summary'), [
+            ('T3', 'UPDATE_COMPLETE'), ('T2', 'UPDATE_COMPLETE')])
+
+    def _convert_records(self, *records):
+        """Convert one invocation per record, like SNS invokes."""
+        self.lambda_config['cfn_event_mode'] = 'summary'
+        for record in records:
+            OutputConverter({'Records': [record]}, {}).convert()
+        return [
+            (args[1]['timestamp'], args[1]['status'])
+            for args, _ in self.mock_sqs_send.call_args_list]
+
+    def test_summary_mode_collects_events_across_invocations(self):
+        self.assertEqual(self._convert_records(*STACK_UPDATE_EVENT[
+            'Records']), [
+                ('T1', 'UPDATE_IN_PROGRESS'),
+                ('T4', 'UPDATE_FAILED'),
+                ('T5', 'UPDATE_ROLLBACK_IN_PROGRESS'),
+                ('T6', 'UPDATE_COMPLETE'),
+                ('T7', 'UPDATE_ROLLBACK_COMPLETE')])
+        summary = self.mock_sqs_send.call_args_list[1][0][1]
+        self.assertEqual(summary['statusCounts'], {
+            'UPDATE_IN_PROGRESS': 1, 'UPDATE_COMPLETE': 1,
+            'UPDATE_FAILED': 1})
+
+    @patch('crassus.output_converter.time')
+    def test_summary_mode_sends_summary_after_interval(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.assertEqual(self._convert_records(
+            cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T1'),
+            cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T2')), [])
+        time_mock.time.return_value = 1060
+        self.assertEqual(self._convert_records(
+            cfn_record('AWS::EC2::Instance', 'UPDATE_FAILED', 'T3')),
+            [('T3', 'UPDATE_FAILED')])
+        summary = self.mock_sqs_send.call_args[0][1]
+        self.assertEqual(summary['statusCounts'], {
+            'UPDATE_COMPLETE': 2, 'UPDATE_FAILED': 1})
+        self.assertEqual(_pending_summaries, {})
+
+    def test_summary_that_could_not_be_sent_is_collected_again(self):
+        self.lambda_config['summary_interval'] = 0
+        with patch('crassus.output_converter.SqsMessageBatch') as batch_mock:
+            batch_mock.return_value.flush.return_value = [
+                ('summary:ANY_STACK',)]
+            report = self._convert_records(
+                cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T1'))
+        self.assertEqual(len(report), 1)
+        self._convert_records(
+            cfn_record('AWS::EC2::Instance', 'UPDATE_FAILED', 'T2'))
+        summary = self.mock_sqs_send.call_args[0][1]
+        self.assertEqual(summary['statusCounts'], {
+            'UPDATE_COMPLETE': 1, 'UPDATE_FAILED': 1})
+
+
+class TestPartialFailures(unittest.TestCase):
+
+    """
+    Tests for the per record error isolation of convert().
+    """
+
+    def setUp(self):
+        processed_records.clear()
+        self.patch_getconfig = patch(
+            'crassus.output_converter.get_lambda_config_property')
+        self.mock_getconfig = self.patch_getconfig.start()
+        self.mock_getconfig.side_effect = \
+            lambda context, name, *default: {
+                'result_queue': ['OUTPUT-SQS-QUEUE-1']}.get(name, *default)
+        self.patch_logger = patch('crassus.output_converter.logger')
+        self.mock_logger = self.patch_logger.start()
+        self.patch_sqs = patch('crassus.utils.get_client')
+        self.mock_aws_sqs = self.patch_sqs.start().return_value
+        self.mock_aws_sqs.send_message_batch.return_value = {'Failed': []}
+
+        malformed_record = cfn_record(
+            'AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T2')
+        malformed_record['Sns']['Message'] = malformed_record['Sns'][
+            'Message'].replace('ResourceStatus=', 'NoStatus=')
+        self.event = {'Records': [
+            cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T1'),
+            malformed_record,
+            cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE', 'T3'),
+        ]}
+        for number, record in enumerate(self.event['Records'], 1):
+            record['Sns']['MessageId'] = 'M{0}'.format(number)
+
+    def tearDown(self):
+        self.patch_getconfig.stop()
+        self.patch_logger.stop()
+        self.patch_sqs.stop()
+
+    def _sent_timestamps(self):
+        return [
+            json.loads(entry['MessageBody'])['timestamp']
+            for _, kwargs in
+            self.mock_aws_sqs.send_message_batch.call_args_list
+            for entry in kwargs['Entries']]
+
+    def test_malformed_record_does_not_stop_the_others(self):
+        report = OutputConverter(self.event, {}).convert()
+        self.assertEqual(self._sent_timestamps(), ['T1', 'T3'])
+        self.assertEqual(report['processed'], ['M1', 'M3'])
+        self.assertEqual(report['failed'], [{
+            'key': 'M2', 'error': "missing field 'ResourceStatus'",
+            'retryable': False}])
+        self.assertEqual(self.mock_logger.error.call_count, 1)
+
+    def test_retry_only_sends_records_that_failed(self):
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Failed': [{'Id': '1', 'SenderFault': False}]}
+        with self.assertRaises(ConversionError) as context:
+            OutputConverter(self.event, {}).convert()
+        self.assertEqual(context.exception.report['processed'], ['M1'])
+        self.assertEqual(
+            [failure['key'] for failure in context.exception.report['failed']
+             if failure['retryable']], ['M3'])
+
+        self.mock_aws_sqs.send_message_batch.reset_mock()
+        self.mock_aws_sqs.send_message_batch.return_value = {'Failed': []}
+        report = OutputConverter(self.event, {}).convert()
+        self.assertEqual(self._sent_timestamps(), ['T3'])
+        self.assertEqual(report['processed'], ['M3'])
+        self.assertEqual(report['skipped'], ['M1', 'M2'])
+
+    def _convert_with_completion_errors(self, *errors):
+        self.mock_getconfig.side_effect = \
+            lambda context, name, *default: {
+                'result_queue': ['OUTPUT-SQS-QUEUE-1'],
+                'tracking_store': 'memory'}.get(name, *default)
+        with patch('crassus.output_converter.OutputConverter.'
+                   '_completion_response', side_effect=errors + (None,)):
+            return OutputConverter(self.event, {}).convert()
+
+    def test_unavailable_tracking_store_fails_only_its_record(self):
+        with self.assertRaises(ConversionError) as context:
+            self._convert_with_completion_errors(
+                sqlite3.OperationalError('database is locked'))
+        report = context.exception.report
+        self.assertEqual(self._sent_timestamps(), ['T3'])
+        self.assertEqual(report['processed'], ['M3'])
+        self.assertEqual(report['failed'][0], {
+            'key': 'M1', 'error': 'database is locked', 'retryable': True})
+
+    def test_invalid_value_fails_its_record_for_good(self):
+        report = self._convert_with_completion_errors(
+            ValueError('Unknown string format'))
+        self.assertEqual(report['processed'], ['M3'])
+        self.assertEqual(report['failed'][0], {
+            'key': 'M1', 'error': 'malformed record: Unknown string format',
+            'retryable': False})
+
+
+STACK_ID = ('arn:aws:cloudformation:eu-west-1:123456789012:stack/'
+            'ANY_STACK/d1834770-91e8-11e5-98ba-50d5026f660a')
+
+
+def tracked_cfn_record(resource_type, status, timestamp, stack_id=STACK_ID):
+    """Return a cfn_record() with the fields needed for tracking."""
+    record = cfn_record(resource_type, status, timestamp)
+    physical_resource_id = (
+        stack_id if resource_type == 'AWS::CloudFormation::Stack'
+        else 'ANY_PHYSICAL_ID')
+    record['Sns']['Message'] += (
+        "StackId='{0}'\n"
+        "PhysicalResourceId='{1}'\n").format(stack_id, physical_resource_id)
+    return record
+
+
+class TestUpdateTracking(unittest.TestCase):
+
+    """
+    Tests for the final responses of Crassus updates.
+    """
+
+    def setUp(self):
+        processed_records.clear()
+        self.store = MemoryPendingUpdateStore()
+        self.store.put({
+            'stackId': STACK_ID, 'stackName': 'ANY_STACK',
+            'messageId': 'REQUEST_1', 'clientRequestToken': 'TOKEN_1',
+            'startTime': 1448297626.0})  # 2015-11-23T16:53:46Z
+        self.patch_getconfig = patch(
+            'crassus.output_converter.get_lambda_config_property')
+        self.mock_getconfig = self.patch_getconfig.start()
+        self.lambda_config = {
+            'result_queue': ['OUTPUT-SQS-QUEUE-1'],
+            'tracking_store': 'memory'}
+        self.mock_getconfig.side_effect = \
+            lambda context, name, *default: self.lambda_config.get(
+                name, *default)
+        self.patch_store = patch(
+            'crassus.output_converter.get_pending_update_store',
+            return_value=self.store)
+        self.patch_store.start()
+        self.patch_sqs_send = patch(
+            'crassus.output_converter.sqs_send_message')
+        self.mock_sqs_send = self.patch_sqs_send.start()
+        self.patch_get_client = patch(
+            'crassus.output_converter.get_client')
+        self.mock_get_client = self.patch_get_client.start()
+
+    def tearDown(self):
+        self.patch_getconfig.stop()
+        self.patch_store.stop()
+        self.patch_sqs_send.stop()
+        self.patch_get_client.stop()
+
+    def _convert(self, records):
+        OutputConverter({'Records': records}, {}).convert()
+        return [
+            args[1] for args, _ in self.mock_sqs_send.call_args_list
+            if args[1]['emitter'] == DeploymentResponse.EMITTER_CRASSUS]
+
+    def test_stack_end_emits_final_response(self):
+        completion_responses = self._convert([
+            tracked_cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE',
+                               '2015-11-23T16:55:00.000Z'),
+            tracked_cfn_record('AWS::CloudFormation::Stack',
+                               'UPDATE_COMPLETE',
+                               '2015-11-23T16:56:16.000Z')])
+        self.assertEqual(len(completion_responses), 1)
+        completion_response = completion_responses[0]
+        self.assertEqual(completion_response['status'],
+                         DeploymentResponse.STATUS_SUCCESS)
+        self.assertEqual(completion_response['stackStatus'],
+                         'UPDATE_COMPLETE')
+        self.assertEqual(completion_response['requestMessageId'],
+                         'REQUEST_1')
+        self.assertEqual(completion_response['durationSeconds'], 150)
+        self.assertEqual(completion_response['clientRequestToken'],
+                         'TOKEN_1')
+        self.assertIsNone(self.store.get(STACK_ID))
+
+    def test_end_of_other_operation_is_ignored(self):
+        record = tracked_cfn_record(
+            'AWS::CloudFormation::Stack', 'UPDATE_COMPLETE',
+            '2015-11-23T16:56:16.000Z')
+        record['Sns']['Message'] += "ClientRequestToken='TOKEN_2'\n"
+        self.assertEqual(self._convert([record]), [])
+        self.assertIsNotNone(self.store.get(STACK_ID))
+
+    def test_forwards_client_request_token_of_events(self):
+        record = tracked_cfn_record(
+            'AWS::EC2::Instance', 'UPDATE_COMPLETE',
+            '2015-11-23T16:55:00.000Z')
+        record['Sns']['Message'] += "ClientRequestToken='TOKEN_1'\n"
+        self._convert([record])
+        self.assertEqual(
+            self.mock_sqs_send.call_args[0][1]['clientRequestToken'],
+            'TOKEN_1')
+
+    def test_rollback_is_a_failure(self):
+        completion_responses = self._convert([
+            tracked_cfn_record('AWS::CloudFormation::Stack',
+                               'UPDATE_ROLLBACK_COMPLETE',
+                               '2015-11-23T16:56:16.000Z')])
+        self.assertEqual(completion_responses[0]['status'],
+                         DeploymentResponse.STATUS_FAILURE)
+
+    def test_events_of_untracked_or_unfinished_stacks_are_ignored(self):
+        completion_responses = self._convert([
+            tracked_cfn_record('AWS::CloudFormation::Stack',
+                               'UPDATE_IN_PROGRESS',
+                               '2015-11-23T16:53:46.000Z'),
+            tracked_cfn_record('AWS::CloudFormation::Stack',
+                               'UPDATE_COMPLETE',
+                               '2015-11-23T16:56:16.000Z', 'OTHER_STACK')])
+        self.assertEqual(completion_responses, [])
+        self.assertIsNotNone(self.store.get(STACK_ID))
+
+    def test_untracked_crassus_update_emits_final_response(self):
+        self.lambda_config.pop('tracking_store')
+        describe_stack_events = self.mock_get_client.return_value \
+            .describe_stack_events
+        describe_stack_events.return_value = {'StackEvents': [
+            {'PhysicalResourceId': STACK_ID,
+             'ResourceStatus': 'UPDATE_COMPLETE',
+             'ClientRequestToken': 'crassus-1',
+             'Timestamp': datetime.datetime(2015, 11, 23, 16, 56, 16)},
+            {'PhysicalResourceId': STACK_ID,
+             'ResourceStatus': 'UPDATE_IN_PROGRESS',
+             'ClientRequestToken': 'crassus-1',
+             'Timestamp': datetime.datetime(2015, 11, 23, 16, 53, 46)}]}
+        record = tracked_cfn_record(
+            'AWS::CloudFormation::Stack', 'UPDATE_COMPLETE',
+            '2015-11-23T16:56:16.000Z')
+        record['Sns']['Message'] += "ClientRequestToken='crassus-1'\n"
+        completion_responses = self._convert([record])
+        self.mock_get_client.assert_called_once_with(
+            'cloudformation', 'eu-west-1')
+        describe_stack_events.assert_called_once_with(StackName=STACK_ID)
+        self.assertEqual(len(completion_responses), 1)
+        self.assertEqual(completion_responses[0]['clientRequestToken'],
+                         'crassus-1')
+        self.assertEqual(completion_responses[0]['durationSeconds'], 150)
+        self.assertNotIn('requestMessageId', completion_responses[0])
+
+    def test_final_response_without_readable_start_has_no_duration(self):
+        self.lambda_config.pop('tracking_store')
+        self.mock_get_client.return_value.describe_stack_events \
+            .side_effect = ValueError('access denied')
+        record = tracked_cfn_record(
+            'AWS::CloudFormation::Stack', 'UPDATE_ROLLBACK_COMPLETE',
+            '2015-11-23T16:56:16.000Z')
+        record['Sns']['Message'] += "ClientRequestToken='crassus-1'\n"
+        completion_responses = self._convert([record])
+        self.assertEqual(completion_responses[0]['status'],
+                         DeploymentResponse.STATUS_FAILURE)
+        self.assertNotIn('durationSeconds', completion_responses[0])
+
+    def test_end_of_update_by_others_is_ignored(self):
+        self.lambda_config.pop('tracking_store')
+        record = tracked_cfn_record(
+            'AWS::CloudFormation::Stack', 'UPDATE_COMPLETE',
+            '2015-11-23T16:56:16.000Z')
+        record['Sns']['Message'] += "ClientRequestToken='Console-1'\n"
+        self.assertEqual(self._convert([record]), [])
+        self.assertFalse(self.mock_get_client.called)
+
+    def test_completion_mode_forwards_only_final_responses(self):
+        self.lambda_config['cfn_event_mode'] = 'completion'
+        self._convert([
+            tracked_cfn_record('AWS::EC2::Instance', 'UPDATE_COMPLETE',
+                               '2015-11-23T16:55:00.000Z'),
+            tracked_cfn_record('AWS::CloudFormation::Stack',
+                               'UPDATE_COMPLETE',
+                               '2015-11-23T16:56:16.000Z')])
+        self.assertEqual(
+            [args[1]['emitter']
+             for args, _ in self.mock_sqs_send.call_args_list],
+            [DeploymentResponse.EMITTER_CRASSUS])
@@ -0,0 +1,184 @@
+import time
+import unittest
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+from crassus import retry
+from crassus.retry import (
+    ERROR_NOT_FOUND, ERROR_OTHER, ERROR_THROTTLING, ERROR_TRANSIENT,
+    ERROR_VALIDATION, RetryPolicy, TokenBucket, classify_error,
+    deadline_from_context, decorrelated_jitter, get_token_bucket,
+    outcome_fields)
+from mock import Mock, patch
+
+
+def client_error(code, message='', status=400):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': message},
+         'ResponseMetadata': {'HTTPStatusCode': status}}, 'AnyOperation')
+
+
+class TestClassifyError(unittest.TestCase):
+
+    def test_throttling(self):
+        self.assertEqual(classify_error(client_error('Throttling')),
+                         ERROR_THROTTLING)
+        self.assertEqual(
+            classify_error(client_error(
+                'AWS.SimpleQueueService.RequestThrottled')),
+            ERROR_THROTTLING)
+
+    def test_transient(self):
+        self.assertEqual(classify_error(client_error('InternalFailure')),
+                         ERROR_TRANSIENT)
+        self.assertEqual(classify_error(client_error('Unknown', status=503)),
+                         ERROR_TRANSIENT)
+        self.assertEqual(
+            classify_error(EndpointConnectionError(endpoint_url='any')),
+            ERROR_TRANSIENT)
+
+    def test_validation(self):
+        self.assertEqual(
+            classify_error(client_error(
+                'ValidationError', 'No updates are to be performed.')),
+            ERROR_VALIDATION)
+
+    def test_missing_stack_is_not_found(self):
+        self.assertEqual(
+            classify_error(client_error(
+                'ValidationError', 'Stack with id ANY_STACK does not exist')),
+            ERROR_NOT_FOUND)
+        self.assertEqual(
+            classify_error(client_error('ResourceNotFoundException')),
+            ERROR_NOT_FOUND)
+
+    def test_other(self):
+        self.assertEqual(classify_error(client_error('AccessDenied')),
+                         ERROR_OTHER)
+        self.assertEqual(classify_error(ValueError()), ERROR_OTHER)
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_decorrelated_jitter_stays_within_bounds(self):
+        delay = 0.1
+        for _ in range(100):
+            next_delay = decorrelated_jitter(delay, base=0.1, cap=5)
+            self.assertGreaterEqual(next_delay, 0.1)
+            self.assertLessEqual(next_delay, min(5, delay * 3))
+            delay = next_delay
+
+    def test_deadline_from_context_keeps_reserve(self):
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 30000
+        deadline = deadline_from_context(context, reserve=5)
+        self.assertAlmostEqual(deadline, time.time() + 25, delta=1)
+
+    def test_no_deadline_without_remaining_time(self):
+        self.assertIsNone(deadline_from_context(None))
+        self.assertIsNone(deadline_from_context(Mock()))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_calls_are_not_paced_before_throttling(self):
+        bucket = TokenBucket(2, 2)
+        for _ in range(10):
+            self.assertEqual(bucket.acquire(), 0)
+            bucket.succeeded()
+        self.assertFalse(bucket.active)
+
+    @patch('crassus.retry.time')
+    def test_calls_wait_after_throttling(self, time_mock):
+        time_mock.time.return_value = 1000
+        bucket = TokenBucket(2, 2)
+        bucket.throttled()
+        self.assertEqual(bucket.acquire(), 1)
+        self.assertEqual(bucket.acquire(max_wait=0.2), 0.2)
+        time_mock.time.return_value = 1010
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 1)
+
+    def test_rate_adapts_to_throttling(self):
+        bucket = TokenBucket(10, 10)
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 5)
+        for _ in range(10):
+            bucket.throttled()
+        self.assertEqual(bucket.rate, 1)
+        bucket.succeeded()
+        self.assertAlmostEqual(bucket.rate, 1.1)
+
+    def test_bucket_stops_pacing_once_recovered(self):
+        bucket = TokenBucket(1, 1)
+        bucket.throttled()
+        for _ in range(5):
+            bucket.succeeded()
+        self.assertTrue(bucket.active)
+        for _ in range(5):
+            bucket.succeeded()
+        self.assertFalse(bucket.active)
+        self.assertEqual(bucket.acquire(), 0)
+
+    def test_bucket_is_shared_per_api(self):
+        self.assertIs(get_token_bucket('sqs.SendMessage'),
+                      get_token_bucket('sqs.SendMessage'))
+        self.assertIsNot(get_token_bucket('sqs.SendMessage'),
+                         get_token_bucket('cloudformation.UpdateStack'))
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        retry._buckets.clear()
+        self.sleep = Mock()
+        self.policy = RetryPolicy(sleep=self.sleep)
+
+    def tearDown(self):
+        retry._buckets.clear()
+
+    def test_throttled_call_is_retried(self):
+        function = Mock(side_effect=[
+            client_error('Throttling'), client_error('InternalFailure'),
+            'result'])
+        self.assertEqual(
+            self.policy.call('any.Api', function, 'value', key='value'),
+            'result')
+        self.assertEqual(function.call_count, 3)
+        function.assert_called_with('value', key='value')
+        self.assertEqual(self.policy.last_attempts, 3)
+        # Backoff before both retries, the throttled bucket paces too
+        self.assertGreaterEqual(self.sleep.call_count, 2)
+        self.assertTrue(get_token_bucket('any.Api').active)
+        self.assertLess(get_token_bucket('any.Api').rate, 10)
+
+    def test_validation_error_is_not_retried(self):
+        function = Mock(side_effect=client_error('ValidationError'))
+        with self.assertRaises(ClientError) as raised:
+            self.policy.call('any.Api', function)
+        self.assertEqual(function.call_count, 1)
+        self.assertEqual(outcome_fields(raised.exception),
+                         {'errorClass': ERROR_VALIDATION})
+
+    def test_retries_stop_after_max_attempts(self):
+        self.policy.max_attempts = 3
+        function = Mock(side_effect=client_error('Throttling'))
+        with self.assertRaises(ClientError) as raised:
+            self.policy.call('any.Api', function)
+        self.assertEqual(function.call_count, 3)
+        self.assertEqual(
+            outcome_fields(raised.exception),
+            {'errorClass': ERROR_THROTTLING, 'awsAttempts': 3})
+
+    def test_retries_stop_at_the_deadline(self):
+        self.policy.deadline = time.time() + 0.05
+        function = Mock(side_effect=client_error('Throttling'))
+        with patch('crassus.retry.decorrelated_jitter', return_value=1):
+            with self.assertRaises(ClientError):
+                self.policy.call('any.Api', function)
+        self.assertEqual(function.call_count, 1)
+        self.assertFalse(self.sleep.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from crassus.tracking import (
+    MemoryPendingUpdateStore, SqlitePendingUpdateStore, _stores,
+    get_pending_update_store)
+
+PENDING_UPDATE = {
+    'stackId': 'ANY_STACK_ID', 'stackName': 'ANY_STACK',
+    'messageId': 'ANY_MESSAGE_ID', 'clientRequestToken': 'ANY_TOKEN',
+    'startTime': 1000.0}
+
+
+class PendingUpdateStoreTests(object):
+
+    """
+    Tests shared by the pending update stores.
+    """
+
+    def test_returns_put_update(self):
+        self.store.put(PENDING_UPDATE)
+        self.assertEqual(self.store.get('ANY_STACK_ID'), PENDING_UPDATE)
+        self.assertIsNone(self.store.get('OTHER_STACK_ID'))
+
+    def test_later_update_replaces_pending_one(self):
+        self.store.put(PENDING_UPDATE)
+        self.store.put(dict(PENDING_UPDATE, messageId='OTHER_MESSAGE_ID'))
+        self.assertEqual(
+            self.store.get('ANY_STACK_ID')['messageId'], 'OTHER_MESSAGE_ID')
+
+    def test_removed_update_is_gone(self):
+        self.store.put(PENDING_UPDATE)
+        self.store.remove('ANY_STACK_ID')
+        self.store.remove('ANY_STACK_ID')
+        self.assertIsNone(self.store.get('ANY_STACK_ID'))
+
+
+class TestMemoryPendingUpdateStore(PendingUpdateStoreTests,
+                                   unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryPendingUpdateStore()
+
+
+class TestSqlitePendingUpdateStore(PendingUpdateStoreTests,
+                                   unittest.TestCase):
+
+    def setUp(self):
+        self.store = SqlitePendingUpdateStore(':memory:')
+
+    def test_adds_token_column_to_old_table(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'tracking.db')
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute(
+                'CREATE TABLE pending_updates '
+                '(stack_id TEXT PRIMARY KEY, stack_name TEXT, '
+                'message_id TEXT, start_time REAL NOT NULL)')
+            connection.execute(
+                'INSERT INTO pending_updates VALUES (?, ?, ?, ?)',
+                ('OLD_STACK_ID', 'OLD_STACK', 'OLD_MESSAGE_ID', 1000.0))
+        connection.close()
+        store = SqlitePendingUpdateStore(path)
+        self.assertIsNone(
+            store.get('OLD_STACK_ID')['clientRequestToken'])
+        store.put(PENDING_UPDATE)
+        self.assertEqual(store.get('ANY_STACK_ID'), PENDING_UPDATE)
+
+
+class TestGetPendingUpdateStore(unittest.TestCase):
+
+    def tearDown(self):
+        _stores.clear()
+
+    def test_returns_shared_store(self):
+        store = get_pending_update_store('memory')
+        self.assertIsInstance(store, MemoryPendingUpdateStore)
+        self.assertIs(get_pending_update_store('memory'), store)
+
+    def test_rejects_unknown_store(self):
+        self.assertRaises(ValueError, get_pending_update_store, 'unknown')
@@ -1,9 +1,27 @@
+import datetime
 import json
+import logging
+import threading
+import time
 import unittest
 
-from crassus.utils import sqs_send_message
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from crassus import utils
+from crassus.utils import (
+    JsonLogFormatter, LogFieldsFilter, SqsMessageBatch, clear_clients,
+    fan_out, get_client, get_lambda_config_property, get_resource,
+    get_role_session, invalidate_lambda_config_cache,
+    lambda_config_cache_stats, log_summary, set_log_fields,
+    sqs_send_message, start_invocation_logging)
+from crassus.retry import RetryPolicy, client_config
 from crassus.deployment_response import DeploymentResponse
-from mock import patch
+from mock import Mock, call, patch
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/crassus-target'
+
+DESCRIPTION = '{"result_queue": ["ANY_QUEUE"], "cfn_events": ["ANY_TOPIC"]}'
 
 
 class TestSqsSendMessage(unittest.TestCase):
@@ -16,10 +34,10 @@ class TestSqsSendMessage(unittest.TestCase):
         self.patch_logger = patch('crassus.utils.logger')
         self.mock_logger = self.patch_logger.start()
 
-        self.patch_sqs = patch('crassus.utils.aws_sqs')
-        self.mock_aws_sqs = self.patch_sqs.start()
+        self.patch_sqs = patch('crassus.utils.get_client')
+        self.mock_aws_sqs = self.patch_sqs.start().return_value
 
-    def teardown(self):
+    def tearDown(self):
         self.patch_logger.stop()
         self.patch_sqs.stop()
 
@@ -34,3 +52,430 @@ class TestSqsSendMessage(unittest.TestCase):
         sqs_send_message(['123'], message)
         self.mock_aws_sqs.send_message.assert_called_once_with(
             QueueUrl='123', MessageBody=message_json, DelaySeconds=0)
+
+    def test_message_is_buffered_in_batch(self):
+        message = DeploymentResponse(
+            'status', 'message', 'stack_name', 'timestamp', 'emitter')
+        batch = SqsMessageBatch()
+        sqs_send_message(['123'], message, batch=batch)
+        self.assertFalse(self.mock_aws_sqs.send_message.called)
+        self.assertFalse(self.mock_aws_sqs.send_message_batch.called)
+        batch.flush()
+        self.mock_aws_sqs.send_message_batch.assert_called_once_with(
+            QueueUrl='123', Entries=[{
+                'Id': '0', 'MessageBody': json.dumps(message),
+                'DelaySeconds': 0}])
+
+
+class TestSqsMessageBatch(unittest.TestCase):
+
+    """
+    Tests for SqsMessageBatch.
+    """
+
+    def setUp(self):
+        self.patch_logger = patch('crassus.utils.logger')
+        self.mock_logger = self.patch_logger.start()
+
+        self.patch_sqs = patch('crassus.utils.get_client')
+        self.mock_aws_sqs = self.patch_sqs.start().return_value
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Successful': [], 'Failed': []}
+        self.retry_policy = RetryPolicy(sleep=Mock())
+        self.batch = SqsMessageBatch(self.retry_policy)
+
+    def tearDown(self):
+        self.patch_logger.stop()
+        self.patch_sqs.stop()
+
+    def _sent_bodies(self):
+        return [
+            (kwargs['QueueUrl'],
+             [entry['MessageBody'] for entry in kwargs['Entries']])
+            for _, kwargs in
+            self.mock_aws_sqs.send_message_batch.call_args_list]
+
+    def test_buffers_per_queue_until_flush(self):
+        self.batch.add(['QUEUE_1', 'QUEUE_2'], 'message1')
+        self.batch.add(['QUEUE_1'], 'message2')
+        self.assertFalse(self.mock_aws_sqs.send_message_batch.called)
+        self.assertEqual(self.batch.flush(), [])
+        self.assertEqual(self._sent_bodies(), [
+            ('QUEUE_1', ['message1', 'message2']),
+            ('QUEUE_2', ['message1'])])
+
+    def test_sends_full_batches_of_ten(self):
+        for number in range(23):
+            self.batch.add(['QUEUE_1'], 'message{0}'.format(number))
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_count, 2)
+        self.batch.flush()
+        self.assertEqual(
+            [len(bodies) for _, bodies in self._sent_bodies()], [10, 10, 3])
+
+    @patch('crassus.utils.SQS_MAX_BATCH_BYTES', 10)
+    def test_sends_batch_when_size_limit_is_reached(self):
+        self.batch.add(['QUEUE_1'], '123456')
+        self.batch.add(['QUEUE_1'], '123456')
+        self.batch.flush()
+        self.assertEqual(self._sent_bodies(), [
+            ('QUEUE_1', ['123456']), ('QUEUE_1', ['123456'])])
+
+    def test_resends_only_failed_entries(self):
+        self.mock_aws_sqs.send_message_batch.side_effect = [
+            {'Failed': [{'Id': '1', 'SenderFault': False}]},
+            {'Failed': []}]
+        self.batch.add(['QUEUE_1'], 'message1', key='key1')
+        self.batch.add(['QUEUE_1'], 'message2', key='key2')
+        self.assertEqual(self.batch.flush(), [])
+        self.assertEqual(self._sent_bodies(), [
+            ('QUEUE_1', ['message1', 'message2']),
+            ('QUEUE_1', ['message2'])])
+
+    def test_reports_keys_of_messages_that_could_not_be_sent(self):
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Failed': [{'Id': '0', 'SenderFault': True, 'Message': 'bad'}]}
+        self.batch.add(['QUEUE_1'], 'message1', key='key1')
+        self.batch.add(['QUEUE_1'], 'message2', key='key2')
+        self.assertEqual(self.batch.flush(), ['key1'])
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_count, 1)
+        self.assertEqual(self.mock_logger.error.call_count, 1)
+
+    def test_gives_up_after_max_attempts_of_the_policy(self):
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Failed': [{'Id': '0', 'SenderFault': False}]}
+        self.batch.add(['QUEUE_1'], 'message1', key='key1')
+        self.assertEqual(self.batch.flush(), ['key1'])
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_count,
+            self.retry_policy.max_attempts)
+
+    def test_failed_entries_and_calls_share_the_attempts(self):
+        self.mock_aws_sqs.send_message_batch.side_effect = [
+            {'Failed': [{'Id': '1', 'SenderFault': False}]},
+            ClientError({'Error': {'Code': 'InternalError'}},
+                        'SendMessageBatch')]
+        self.retry_policy.max_attempts = 2
+        self.batch.add(['QUEUE_1'], 'message1', key='key1')
+        self.batch.add(['QUEUE_1'], 'message2', key='key2')
+        self.assertEqual(self.batch.flush(), ['key2'])
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_count, 2)
+
+    def test_no_resend_after_the_deadline(self):
+        self.retry_policy.deadline = time.time() - 1
+        self.mock_aws_sqs.send_message_batch.return_value = {
+            'Failed': [{'Id': '0', 'SenderFault': False}]}
+        self.batch.add(['QUEUE_1'], 'message1', key='key1')
+        self.assertEqual(self.batch.flush(), ['key1'])
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_count, 1)
+
+    def test_one_failing_queue_does_not_stop_the_others(self):
+        def send_message_batch(QueueUrl, Entries):
+            if QueueUrl == 'QUEUE_1':
+                raise Exception('unavailable')
+            return {'Failed': []}
+
+        self.mock_aws_sqs.send_message_batch.side_effect = send_message_batch
+        self.batch.add(['QUEUE_1', 'QUEUE_2'], 'message1', key='key1')
+        self.assertEqual(self.batch.flush(), ['key1'])
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_count, 2)
+        self.assertEqual(list(self.batch.queue_errors), ['QUEUE_1'])
+
+    def test_failure_of_a_full_batch_does_not_raise(self):
+        self.mock_aws_sqs.send_message_batch.side_effect = [
+            Exception('unavailable'), {'Failed': []}]
+        for number in range(11):
+            self.batch.add(['QUEUE_1'], 'message{0}'.format(number),
+                           key='key{0}'.format(number))
+        self.assertEqual(self.batch.flush(), [
+            'key{0}'.format(number) for number in range(10)])
+        self.assertEqual(list(self.batch.queue_errors), ['QUEUE_1'])
+
+    def test_closed_batch_refuses_messages(self):
+        self.batch.add(['QUEUE_1'], 'message1', key='key1')
+        self.assertEqual(self.batch.close(), [])
+        self.batch.add(['QUEUE_1'], 'message2', key='key2')
+        self.assertEqual(self.batch.flush(), ['key2'])
+        self.assertEqual(self._sent_bodies(), [('QUEUE_1', ['message1'])])
+
+    def test_full_batch_is_sent_outside_of_the_lock(self):
+        def send_message_batch(QueueUrl, Entries):
+            self.assertTrue(self.batch._lock.acquire(False))
+            self.batch._lock.release()
+            return {'Failed': []}
+
+        self.mock_aws_sqs.send_message_batch.side_effect = send_message_batch
+        for number in range(11):
+            self.batch.add(['QUEUE_1'], 'message{0}'.format(number))
+        self.assertEqual(
+            self.mock_aws_sqs.send_message_batch.call_count, 1)
+
+
+class TestFanOut(unittest.TestCase):
+
+    """
+    Tests for fan_out().
+    """
+
+    def test_calls_all_destinations_concurrently(self):
+        barrier = threading.Event()
+        started = []
+
+        def send(destination):
+            started.append(destination)
+            if len(started) == 3:
+                barrier.set()
+            # Only returns if all destinations run at the same time
+            if not barrier.wait(1):
+                raise Exception('not concurrent')
+
+        results = fan_out(send, ['QUEUE_1', 'QUEUE_2', 'QUEUE_3'])
+        self.assertEqual(results, {
+            'QUEUE_1': None, 'QUEUE_2': None, 'QUEUE_3': None})
+
+    def test_collects_failures_per_destination(self):
+        error = Exception('unavailable')
+
+        def send(destination):
+            if destination == 'QUEUE_2':
+                raise error
+
+        results = fan_out(send, ['QUEUE_1', 'QUEUE_2'])
+        self.assertEqual(list(results.items()), [
+            ('QUEUE_1', None), ('QUEUE_2', error)])
+
+    def test_does_not_wait_longer_than_timeout(self):
+        def send(destination):
+            if destination == 'SLOW_QUEUE':
+                time.sleep(2)
+
+        start = time.time()
+        results = fan_out(send, ['SLOW_QUEUE', 'QUEUE_1'], timeout=0.1)
+        self.assertLess(time.time() - start, 1)
+        self.assertIsNone(results['QUEUE_1'])
+        self.assertIsNotNone(results['SLOW_QUEUE'])
+
+    def test_single_destination_failure_is_collected(self):
+        error = Exception('unavailable')
+
+        def send(destination):
+            raise error
+
+        self.assertEqual(fan_out(send, ['QUEUE_1']), {'QUEUE_1': error})
+
+
+class TestLambdaConfigCache(unittest.TestCase):
+
+    """
+    Tests for the cached get_lambda_config_property().
+    """
+
+    def setUp(self):
+        invalidate_lambda_config_cache()
+        lambda_config_cache_stats.update(hits=0, misses=0)
+        self.context = Mock(invoked_function_arn='any_arn',
+                            function_version='any_version')
+        self.patcher = patch('crassus.utils.get_client')
+        self.aws_lambda = self.patcher.start().return_value
+        self.aws_lambda.get_function_configuration.return_value = {
+            'Description': DESCRIPTION}
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_should_fetch_description_once_for_all_properties(self):
+        self.assertEqual(get_lambda_config_property(
+            self.context, 'result_queue'), ['ANY_QUEUE'])
+        self.assertEqual(get_lambda_config_property(
+            self.context, 'cfn_events'), ['ANY_TOPIC'])
+        self.aws_lambda.get_function_configuration.assert_called_once_with(
+            FunctionName='any_arn', Qualifier='any_version')
+        self.assertEqual(lambda_config_cache_stats,
+                         {'hits': 1, 'misses': 1})
+
+    def test_should_cache_per_function_and_qualifier(self):
+        get_lambda_config_property(self.context, 'result_queue')
+        other_context = Mock(invoked_function_arn='any_arn',
+                             function_version='other_version')
+        get_lambda_config_property(other_context, 'result_queue')
+        self.assertEqual(
+            self.aws_lambda.get_function_configuration.call_count, 2)
+
+    @patch('crassus.utils.time')
+    def test_should_refetch_after_ttl(self, time_mock):
+        time_mock.time.return_value = 1000
+        get_lambda_config_property(self.context, 'result_queue')
+        time_mock.time.return_value = 1000 + utils.LAMBDA_CONFIG_CACHE_TTL
+        get_lambda_config_property(self.context, 'result_queue')
+        self.assertEqual(
+            self.aws_lambda.get_function_configuration.call_count, 2)
+
+    def test_should_refetch_after_invalidation(self):
+        get_lambda_config_property(self.context, 'result_queue')
+        invalidate_lambda_config_cache()
+        get_lambda_config_property(self.context, 'result_queue')
+        self.assertEqual(
+            self.aws_lambda.get_function_configuration.call_count, 2)
+
+    @patch('crassus.utils.logger')
+    def test_should_return_default_for_missing_property(self, logger_mock):
+        self.assertEqual(get_lambda_config_property(
+            self.context, 'no_such_property', 'DEFAULT'), 'DEFAULT')
+        self.assertFalse(logger_mock.error.called)
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    """
+    Tests for get_client() and get_resource().
+    """
+
+    def setUp(self):
+        clear_clients()
+
+    def tearDown(self):
+        clear_clients()
+
+    @patch('boto3.client')
+    def test_client_is_created_once_per_service_and_region(self, client_mock):
+        client_mock.side_effect = lambda *args, **kwargs: Mock()
+        sqs = get_client('sqs')
+        self.assertIs(get_client('sqs'), sqs)
+        self.assertIsNot(get_client('sqs', 'us-east-1'), sqs)
+        self.assertIsNot(get_client('lambda'), sqs)
+        self.assertEqual(client_mock.call_args_list, [
+            call('sqs', region_name=None, config=client_config()),
+            call('sqs', region_name='us-east-1', config=client_config()),
+            call('lambda', region_name=None, config=client_config())])
+
+    @patch('boto3.resource')
+    def test_resource_is_created_on_first_use(self, resource_mock):
+        self.assertFalse(resource_mock.called)
+        cloudformation = get_resource('cloudformation')
+        self.assertIs(get_resource('cloudformation'), cloudformation)
+        resource_mock.assert_called_once_with(
+            'cloudformation', region_name=None, config=client_config())
+
+
+class TestRoleSessions(unittest.TestCase):
+
+    """
+    Tests for get_role_session(), against a local STS stub.
+    """
+
+    def setUp(self):
+        clear_clients()
+        sts = boto3.client(
+            'sts', region_name='eu-west-1', aws_access_key_id='ANY_KEY',
+            aws_secret_access_key='ANY_SECRET')
+        self.stubber = Stubber(sts)
+        self.stubber.activate()
+        utils._clients[('sts', None)] = sts
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        clear_clients()
+
+    def stub_assume_role(self, access_key_id, expiration):
+        self.stubber.add_response('assume_role', {
+            'Credentials': {
+                'AccessKeyId': access_key_id,
+                'SecretAccessKey': 'ANY_SECRET_KEY',
+                'SessionToken': 'ANY_SESSION_TOKEN',
+                'Expiration': datetime.datetime.utcfromtimestamp(
+                    expiration)}}, {
+            'RoleArn': ROLE_ARN,
+            'RoleSessionName': 'crassus',
+            'DurationSeconds': 3600})
+
+    def access_key(self, session):
+        return session.get_credentials().access_key
+
+    @patch('crassus.utils.time')
+    def test_session_is_reused_until_shortly_before_expiry(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.stub_assume_role('ASIAACCESSKEYONE', 1000 + 3600)
+        self.stub_assume_role('ASIAACCESSKEYTWO', 1000 + 7200)
+
+        session = get_role_session(ROLE_ARN)
+        self.assertEqual(self.access_key(session), 'ASIAACCESSKEYONE')
+        time_mock.time.return_value = 1000 + 3299
+        self.assertIs(get_role_session(ROLE_ARN), session)
+        time_mock.time.return_value = 1000 + 3300
+        refreshed = get_role_session(ROLE_ARN)
+        self.assertEqual(self.access_key(refreshed), 'ASIAACCESSKEYTWO')
+        self.stubber.assert_no_pending_responses()
+
+    @patch('crassus.utils.time')
+    def test_role_resource_follows_refreshed_session(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.stub_assume_role('ASIAACCESSKEYONE', 1000 + 3600)
+        self.stub_assume_role('ASIAACCESSKEYTWO', 1000 + 7200)
+
+        cloudformation = get_resource(
+            'cloudformation', 'eu-west-1', role_arn=ROLE_ARN)
+        self.assertIs(get_resource(
+            'cloudformation', 'eu-west-1', role_arn=ROLE_ARN), cloudformation)
+        self.assertIsNot(get_resource('cloudformation', 'eu-west-1'),
+                         cloudformation)
+        time_mock.time.return_value = 1000 + 3600
+        self.assertIsNot(get_resource(
+            'cloudformation', 'eu-west-1', role_arn=ROLE_ARN), cloudformation)
+
+
+class TestStructuredLogging(unittest.TestCase):
+
+    """
+    Tests for log_summary(), the correlation fields and JsonLogFormatter.
+    """
+
+    def setUp(self):
+        start_invocation_logging(Mock(aws_request_id='ANY_REQUEST_ID'))
+
+    def tearDown(self):
+        start_invocation_logging(None)
+
+    def _record(self, message, *args):
+        record = logging.LogRecord(
+            'crassus', logging.INFO, __file__, 1, message, args, None)
+        LogFieldsFilter().filter(record)
+        return record
+
+    def test_log_summary_caps_long_values(self):
+        self.assertEqual(str(log_summary([1, 2])), '[1, 2]')
+        summary = str(log_summary('x' * 1000, limit=10))
+        self.assertEqual(summary, "'xxxxxxxxx... (1002 chars)")
+
+    def test_log_summary_is_lazy(self):
+        value = Mock()
+        value.__repr__ = Mock(return_value='value')
+        summary = log_summary(value)
+        self.assertFalse(value.__repr__.called)
+        self.assertEqual(str(summary), 'value')
+
+    def test_json_format_has_correlation_fields(self):
+        set_log_fields(messageId='ANY_MESSAGE_ID', stackName='ANY_STACK')
+        log_entry = json.loads(JsonLogFormatter().format(
+            self._record('Loaded %s', log_summary('stack'))))
+        self.assertEqual(log_entry['message'], "Loaded 'stack'")
+        self.assertEqual(log_entry['level'], 'INFO')
+        self.assertEqual(log_entry['requestId'], 'ANY_REQUEST_ID')
+        self.assertEqual(log_entry['messageId'], 'ANY_MESSAGE_ID')
+        self.assertEqual(log_entry['stackName'], 'ANY_STACK')
+
+    def test_fields_of_other_threads_are_not_added(self):
+        thread = threading.Thread(
+            target=lambda: set_log_fields(stackName='OTHER_STACK'))
+        thread.start()
+        thread.join()
+        self.assertEqual(self._record('message').log_fields,
+                         {'requestId': 'ANY_REQUEST_ID'})
+
+    def test_new_invocation_resets_fields(self):
+        set_log_fields(stackName='ANY_STACK')
+        start_invocation_logging(None)
+        self.assertEqual(self._record('message').log_fields, {})